@@ -0,0 +1,225 @@
+"""Admission control for model streams, shared by all sessions in the process.
+
+Requests wait in a bounded queue for a stream slot, and slots are handed out round-robin
+across users, so one busy user can't starve the others. The number of slots adapts to
+quota pressure: it is halved when the model returns 429 (at most once per cooldown period),
+and grows back by one slot per full window of successful requests (AIMD).
+While a request waits, its queue position and an estimated wait are reported."""
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Callable
+
+from config import logger
+from metrics import counter, gauge
+
+THROTTLE_CODES = frozenset((429,))  # Quota exhausted
+
+admission_rejections = counter(
+    "rickbot_admission_rejections_total",
+    "Requests rejected because the queue was full.",
+)
+admission_throttles = counter(
+    "rickbot_admission_throttles_total", "Throttling errors returned by the model."
+)
+
+
+class QueueFullError(Exception):
+    """Raised when a request can't be queued, because the queue is full."""
+
+
+@dataclass(frozen=True)
+class QueueStatus:
+    """Where a waiting request is in the queue."""
+
+    position: int  # Requests that will be admitted first
+    eta_seconds: float | None  # Estimated wait, if we have enough data to estimate it
+
+
+QueueCallback = Callable[[QueueStatus], None]
+
+
+class _Waiter:
+    def __init__(self, user: str):
+        self.user = user
+        self.admitted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+def is_throttled(e: BaseException) -> bool:
+    """Whether the model rejected a request because quota is exhausted."""
+    return getattr(e, "code", None) in THROTTLE_CODES
+
+
+class AdmissionController:
+    """A fair, bounded queue in front of the model, with an adaptive concurrency limit.
+    Must only be used from the generation engine's event loop."""
+
+    def __init__(
+        self,
+        max_concurrency: int = 32,
+        min_concurrency: int = 1,
+        max_queue: int = 100,
+        decrease_factor: float = 0.5,
+        decrease_cooldown: float = 5.0,
+        report_interval: float = 1.0,
+    ):
+        """
+        Args:
+            max_concurrency (int): Maximum concurrent model streams.
+            min_concurrency (int): The limit is never reduced below this.
+            max_queue (int): Maximum requests waiting for a slot. Beyond this, requests
+                are rejected. 0 means unbounded.
+            decrease_factor (float): The limit is multiplied by this on throttling.
+            decrease_cooldown (float): Seconds after a decrease before the next,
+                so that one burst of 429s only counts once.
+            report_interval (float): Seconds between queue position reports to a waiter.
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = max(1, min(min_concurrency, max_concurrency))
+        self.max_queue = max_queue
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.report_interval = report_interval
+        self._limit = float(max_concurrency)
+        self._active = 0
+        self._queued = 0
+        self._queues: OrderedDict[str, deque[_Waiter]] = OrderedDict()  # In turn order
+        self._last_decrease = 0.0
+        self._hold_seconds: float | None = None  # Moving average of slot hold times
+        gauge(
+            "rickbot_admission_limit",
+            "Current concurrency limit for model streams.",
+            function=lambda: self.limit,
+        )
+
+    @property
+    def limit(self) -> int:
+        """How many streams may run at once."""
+        return max(self.min_concurrency, int(self._limit))
+
+    @property
+    def active(self) -> int:
+        """Number of streams holding a slot."""
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        """Number of requests waiting for a slot."""
+        return self._queued
+
+    def _position(self, waiter: _Waiter) -> int:
+        """How many waiting requests will be admitted before this one, taking turns."""
+        users = list(self._queues)
+        turn = users.index(waiter.user)
+        index = self._queues[waiter.user].index(waiter)
+        position = index
+        for other_turn, user in enumerate(users):
+            if user != waiter.user:
+                others = len(self._queues[user])
+                position += min(others, index + 1 if other_turn < turn else index)
+        return position
+
+    def status(self, waiter: _Waiter) -> QueueStatus:
+        """The queue position of a waiting request, and its estimated wait."""
+        position = self._position(waiter)
+        eta = None
+        if self._hold_seconds is not None:  # A slot frees up every hold time / limit
+            eta = (position + 1) * self._hold_seconds / self.limit
+        return QueueStatus(position, eta)
+
+    async def acquire(self, user: str, on_queued: QueueCallback | None = None):
+        """Wait for a slot. Users take turns, in the order they first queued.
+
+        Args:
+            user (str): Identifies the user, for fairness.
+            on_queued (QueueCallback, optional): Called with the request's queue status
+                while it waits, if it has to.
+
+        Raises:
+            QueueFullError: If the queue is full.
+        """
+        if not self._queues and self._active < self.limit:
+            self._active += 1
+            return
+        if self.max_queue and self._queued >= self.max_queue:
+            admission_rejections.inc()
+            raise QueueFullError(f"{self._queued} requests are already waiting.")
+
+        waiter = _Waiter(user)
+        self._queues.setdefault(user, deque()).append(waiter)
+        self._queued += 1
+        try:
+            while True:
+                if on_queued:
+                    on_queued(self.status(waiter))
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(waiter.admitted), self.report_interval
+                    )
+                    return
+                except TimeoutError:
+                    continue
+        except BaseException:  # E.g. cancelled, or the request timed out
+            if waiter.admitted.done() and not waiter.admitted.cancelled():
+                self.release()  # Admitted just as we gave up
+            else:
+                waiter.admitted.cancel()
+                self._remove(waiter)
+            raise
+
+    def _remove(self, waiter: _Waiter):
+        waiters = self._queues.get(waiter.user)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del self._queues[waiter.user]
+
+    def release(self, hold_seconds: float | None = None):
+        """Give up a slot, admitting the next waiting request, if any.
+
+        Args:
+            hold_seconds (float, optional): How long the slot was held, for estimating waits.
+        """
+        self._active -= 1
+        if hold_seconds is not None:
+            self._hold_seconds = (
+                hold_seconds
+                if self._hold_seconds is None
+                else 0.8 * self._hold_seconds + 0.2 * hold_seconds
+            )
+        self._admit()
+
+    def _admit(self):
+        while self._queues and self._active < self.limit:
+            user, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._queues.move_to_end(user)  # The next user's turn
+            else:
+                del self._queues[user]
+            self._active += 1
+            waiter.admitted.set_result(None)
+
+    def record_success(self):
+        """A request succeeded, so allow a little more concurrency."""
+        self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+        self._admit()
+
+    def record_error(self, e: BaseException):
+        """A request failed. If the model is throttling us, reduce concurrency."""
+        if not is_throttled(e):
+            return
+        admission_throttles.inc()
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self._limit = max(self.min_concurrency, self._limit * self.decrease_factor)
+        logger.warning(
+            f"Model is throttling requests. Concurrency limit {previous} -> {self.limit}"
+        )
@@ -1,13 +1,34 @@
 """A Rick Sanchez (Rick and Morty) Rickbot agent,
 built using Google Gen AI SDK and Gemini."""
 
+from dataclasses import dataclass
 from functools import lru_cache
+from typing import TYPE_CHECKING
 from google import genai
-from google.genai.types import Content, GenerateContentConfig, GoogleSearch, Tool, Part
+from google.genai.types import GenerateContentConfig, GoogleSearch, Tool, Part
 
+from coalesce import FlushPolicy, coalesce
+from engine import StreamRequest, chunk_text
+from history import HistoryBuilder
+from metrics import (
+    instrument_fan_out,
+    instrument_stream,
+    span,
+    stream_chunks,
+    stream_errors,
+)
 from personality import Personality
 
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+    from admission import QueueCallback
+    from engine import GenerationEngine, UsageCallback
+    from prompt_cache import SystemPromptCache
+    from resilience import ClientPool
+
 MODEL = "gemini-2.5-flash"
+MAX_OUTPUT_TOKENS = 16384
 
 
 @lru_cache
@@ -37,9 +58,11 @@ def load_client(gcp_project_id, gcp_region):
 
 
 @lru_cache
-def initialise_model_config(personality: Personality) -> GenerateContentConfig:
+def initialise_model_config(
+    personality: Personality, grounded: bool = True
+) -> GenerateContentConfig:
     """Creates the configuration for the Gemini model. Sets up the system prompt that instructs the model to act as
-    Rick. Also configures the model's generation parameters and
+    Rick. Also configures the model's generation parameters and, if grounded,
     enables the Google Search tool for answering questions outside its
     knowledge base.
 
@@ -49,24 +72,105 @@ def initialise_model_config(personality: Personality) -> GenerateContentConfig:
 
     system_instruction = personality.system_instruction
 
+    generate_content_config = GenerateContentConfig(
+        temperature=personality.temperature,
+        top_p=1,
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        tools=get_tools() if grounded else None,
+        system_instruction=[Part.from_text(text=system_instruction)],
+    )
+
+    return generate_content_config
+
+
+def get_tools() -> list[Tool]:
+    """The tools made available to the model."""
+
     # Create tool to enable grounding with Google Search
-    tools = [
+    return [
         Tool(google_search=GoogleSearch()),
     ]
 
-    generate_content_config = GenerateContentConfig(
+
+@lru_cache(maxsize=64)
+def initialise_cached_model_config(
+    personality: Personality, cached_content: str
+) -> GenerateContentConfig:
+    """Creates the configuration for the Gemini model, where the system prompt and tools
+    are held in server-side cached content, rather than being sent with every request.
+
+    Args:
+        personality (Personality): The personality to respond as.
+        cached_content (str): The resource name of the cached content for this personality.
+
+    Returns:
+        GenerateContentConfig: The configuration object for the model.
+    """
+
+    return GenerateContentConfig(
         temperature=personality.temperature,
         top_p=1,
-        max_output_tokens=16384,
-        tools=tools,
-        system_instruction=[Part.from_text(text=system_instruction)],
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        cached_content=cached_content,
     )
 
-    return generate_content_config
+
+def invalidate_model_configs():
+    """Forget all model configurations, e.g. after personalities are reloaded.
+    Reloaded personalities have a new revision, so they never reuse stale configurations,
+    but this releases the memory of the old ones. Requests in progress keep theirs."""
+    initialise_model_config.cache_clear()
+    initialise_cached_model_config.cache_clear()
+
+
+def get_model(personality: Personality) -> str:
+    """The main model for this personality."""
+    return personality.model or MODEL
+
+
+def get_model_config(
+    client,
+    personality: Personality,
+    prompt_cache: "SystemPromptCache | None" = None,
+    model: str = MODEL,
+    grounded: bool = True,
+) -> GenerateContentConfig:
+    """Returns the model configuration for this personality, using the cached system prompt
+    if context caching is enabled and available, else falling back to sending the system prompt.
+
+    Args:
+        client (genai.Client): The authenticated Vertex AI client.
+        personality (Personality): The personality to respond as.
+        prompt_cache (SystemPromptCache, optional): The cache of personality system prompts.
+        model (str): The model the configuration is for, since cached content is per model.
+        grounded (bool): Whether to enable grounding with Google Search.
+
+    Returns:
+        GenerateContentConfig: The configuration object for the model.
+    """
+
+    if prompt_cache:
+        cached_content = prompt_cache.get(client, personality, model, grounded)
+        if cached_content:
+            return initialise_cached_model_config(personality, cached_content)
+
+    return initialise_model_config(personality, grounded)
 
 
 def get_rick_bot_response(
-    client, chat_history: list[dict], model_config: GenerateContentConfig
+    client,
+    chat_history: list[dict],
+    model_config: GenerateContentConfig,
+    history_builder: HistoryBuilder | None = None,
+    engine: "GenerationEngine | None" = None,
+    personality_name: str = "",
+    flush_policy: FlushPolicy | None = None,
+    client_pool: "ClientPool | None" = None,
+    fallback_config: GenerateContentConfig | None = None,
+    model: str = MODEL,
+    user: str = "",
+    on_queued: "QueueCallback | None" = None,
+    on_usage: "UsageCallback | None" = None,
 ):
     """
     Generates a streaming response from RickBot model.
@@ -81,45 +185,190 @@ def get_rick_bot_response(
             message is a dict with "role" and "content" keys.
         model_config (GenerateContentConfig): The configuration for the
             generative model, including the system prompt and tools.
+        history_builder (HistoryBuilder, optional): The session's history builder.
+            Reusing it across turns means only new messages are converted.
+            If not supplied, the whole history is converted without any budget.
+        engine (GenerationEngine, optional): The shared async generation engine.
+            If not supplied, the response is streamed synchronously in this thread.
+        personality_name (str, optional): Used to label metrics.
+        flush_policy (FlushPolicy, optional): Coalesce response chunks before they are
+            yielded, flushing by time and size. If not supplied, every chunk is yielded.
+        client_pool (ClientPool, optional): Clients to fail over to, in order of preference,
+            starting with the primary client. Only used with the engine.
+        fallback_config (GenerateContentConfig, optional): The configuration for fallback
+            clients, if model_config uses context caching, which is regional.
+        model (str, optional): The model to use. Defaults to MODEL.
+        user (str, optional): Identifies the user, so that users take turns when requests
+            are queued by the engine.
+        on_queued (QueueCallback, optional): Called with the request's queue status while
+            it waits for the engine, and with None once it's admitted.
+        on_usage (UsageCallback, optional): Called with the response's usage metadata,
+            once the response is complete.
 
     Yields:
         str: A stream of response text chunks from the AI model.
     """
 
-    contents = []
-    for message in chat_history:
-        role = "model" if message["role"] == "assistant" else message["role"]
+    if history_builder is None:
+        history_builder = HistoryBuilder()
+    with span("history_build", personality=personality_name, model=model):
+        contents = history_builder.build(chat_history)
 
-        if role not in (
-            "user",
-            "model",
-        ):  # Skip any roles that are not 'user' or 'model'
-            continue
+    try:
+        yield from instrument_stream(
+            _stream(
+                client,
+                model,
+                contents,
+                model_config,
+                engine,
+                flush_policy,
+                client_pool,
+                fallback_config,
+                user,
+                on_queued,
+                on_usage,
+            ),
+            personality_name,
+            model,
+        )
+    except Exception as e:
+        raise Exception("Error in generation") from e
 
-        parts_for_current_message = [Part.from_text(text=message["content"])]
 
-        # If there's an attachment, add it as a data part
-        if "attachment" in message and message["attachment"]:
-            attachment = message["attachment"]
-            parts_for_current_message.append(
-                Part.from_bytes(
-                    data=attachment["data"], mime_type=attachment["mime_type"]
-                )
-            )
+@dataclass(frozen=True)
+class Panelist:
+    """A personality on a panel, with the model and configuration it responds with."""
 
-        contents.append(Content(role=role, parts=parts_for_current_message))
+    personality: Personality
+    model: str
+    config: GenerateContentConfig
+    grounded: bool = True
 
-    try:
-        for chunk in client.models.generate_content_stream(
-            model=MODEL,
-            contents=contents,
-            config=model_config,
-        ):
-            if (
-                chunk.candidates
-                and chunk.candidates[0].content
-                and chunk.candidates[0].content.parts
-            ):
-                yield chunk.text
-    except Exception as e:
-        raise Exception("Error in generation") from e
+
+def get_panel_responses(
+    client,
+    chat_history: list[dict],
+    panel: list["Panelist"],
+    engine: "GenerationEngine",
+    history_builder: HistoryBuilder | None = None,
+    flush_policy: FlushPolicy | None = None,
+    client_pool: "ClientPool | None" = None,
+    user: str = "",
+    on_queued: "QueueCallback | None" = None,
+    on_usage: "Callable[[int, Any], None] | None" = None,
+    on_error: "Callable[[int, Exception], None] | None" = None,
+):
+    """
+    Generates streaming responses from several personalities to the same conversation,
+    concurrently. The history, including any attachments, is converted once for all of them.
+
+    Args:
+        client (genai.Client): The authenticated Vertex AI client.
+        chat_history (list[dict]): The conversation, shared by the panel.
+        panel (list[Panelist]): Each personality, with its model and configuration.
+        engine (GenerationEngine): The shared async generation engine.
+        history_builder (HistoryBuilder, optional): The session's history builder.
+        flush_policy (FlushPolicy, optional): Coalesce each response's chunks.
+        client_pool (ClientPool, optional): Clients to fail over to, in order of preference.
+        user (str, optional): Identifies the user, for fair queueing.
+        on_queued (QueueCallback, optional): Called with the queue status of any response
+            that is waiting for the engine, and with None once it's admitted.
+        on_usage (Callable, optional): Called with a panelist's index and usage metadata,
+            once its response is complete.
+        on_error (Callable, optional): Called with a panelist's index and error, if its
+            response fails. The other responses carry on.
+
+    Yields:
+        tuple[int, str]: The index of the panelist, and a text chunk of their response.
+    """
+
+    if history_builder is None:
+        history_builder = HistoryBuilder()
+    with span("history_build", personality="panel", model=""):
+        contents = history_builder.build(chat_history)
+
+    def panelist_failed(index: int, e: Exception):
+        stream_errors.inc(
+            personality=panel[index].personality.name, model=panel[index].model
+        )
+        if on_error:
+            on_error(index, e)
+
+    requests = [
+        StreamRequest(
+            model=panelist.model,
+            config=panelist.config,
+            # Context caches are regional, so fallback regions get the system prompt
+            fallback_config=(
+                initialise_model_config(panelist.personality, panelist.grounded)
+                if client_pool
+                else None
+            ),
+        )
+        for panelist in panel
+    ]
+    yield from instrument_fan_out(
+        engine.fan_out(
+            client_pool or client,
+            contents,
+            requests,
+            flush_policy=flush_policy,
+            user=user,
+            on_queued=on_queued,
+            on_usage=on_usage,
+            on_error=panelist_failed,
+        ),
+        [(panelist.personality.name, panelist.model) for panelist in panel],
+    )
+
+
+def _stream(
+    client,
+    model,
+    contents,
+    model_config,
+    engine,
+    flush_policy=None,
+    client_pool=None,
+    fallback_config=None,
+    user="",
+    on_queued=None,
+    on_usage=None,
+):
+    """Stream response text from the model, via the engine if we have one."""
+    if engine:
+        yield from engine.stream(
+            client_pool or client,
+            model,
+            contents,
+            model_config,
+            flush_policy=flush_policy,
+            fallback_config=fallback_config,
+            user=user,
+            on_queued=on_queued,
+            on_usage=on_usage,
+        )
+        return
+
+    stream = _sync_stream(client, model, contents, model_config, on_usage)
+    yield from coalesce(stream, flush_policy) if flush_policy else stream
+
+
+def _sync_stream(client, model, contents, model_config, on_usage=None):
+    """Stream response text from the model, blocking this thread."""
+    usage = None
+    chunks = 0
+    for chunk in client.models.generate_content_stream(
+        model=model,
+        contents=contents,
+        config=model_config,
+    ):
+        chunks += 1
+        text = chunk_text(chunk)
+        if text:
+            yield text
+        usage = chunk.usage_metadata or usage
+    stream_chunks.observe(chunks, model=model)
+    if on_usage and usage:
+        on_usage(usage)
@@ -0,0 +1,433 @@
+"""A headless, streaming HTTP API for Rickbot, alongside the Streamlit UI.
+
+Responses are streamed as Server-Sent Events. The API is stateless: clients hold the
+conversation, and send the whole history with each request. It uses the same personalities,
+model configuration, generation engine, rate limits and Google sign-in as the UI, without
+Streamlit's script reruns and websockets.
+
+Run from the src/rickbot directory:
+    python api.py
+
+Endpoints:
+    GET  /v1/personalities   The available personalities.
+    POST /v1/chat            {"personality": "Rick", "messages": [{"role": "user", "content": "Hi"}]}
+    GET  /healthz            Liveness check.
+
+Prometheus metrics aren't served by the API. They're served on METRICS_PORT, if it's set,
+which shouldn't be exposed publicly.
+
+When auth is required, requests need an `Authorization: Bearer <Google ID token>` header,
+with the app's OAuth client ID as the audience and a verified email. User credentials
+can't mint tokens for another audience, so test with a service account you can impersonate:
+    TOKEN=$(gcloud auth print-identity-token --impersonate-service-account=<sa_email> \
+        --audiences=<client_id> --include-email)
+    curl -N -H "Authorization: Bearer $TOKEN" ...
+"""
+
+import asyncio
+import json
+import time
+import tomllib
+from collections import OrderedDict
+
+import tornado.web
+from tornado.iostream import StreamClosedError
+
+from admission import AdmissionController, QueueFullError, QueueStatus
+from config import logger, get_config, Config
+from grounding import should_ground
+from metrics import instrument_astream, span, start_metrics_server
+from personality import configure_prompt_cache, personalities
+from rate_limit import RateLimiter, create_rate_limiter
+from resilience import ClientPool, RetryPolicy
+from usage import TokenAccountant
+from utils import configure_secret_cache
+
+MAX_BODY_BYTES = 1024 * 1024
+SECRETS_FILE = ".streamlit/secrets.toml"
+
+
+def load_client_id(secrets_file: str = SECRETS_FILE) -> str:
+    """The OAuth client ID of the app's Google sign-in, from Streamlit's secrets.
+
+    Raises:
+        ValueError: If there is no client ID.
+    """
+    try:
+        with open(secrets_file, "rb") as f:
+            auth = tomllib.load(f).get("auth", {})
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        raise ValueError(f"Unable to read {secrets_file}: {e}") from e
+    client_id = auth.get("client_id") or auth.get("google", {}).get("client_id")
+    if not client_id:
+        raise ValueError(f"No auth client_id in {secrets_file}")
+    return client_id
+
+
+class IdTokenVerifier:
+    """Verifies Google ID tokens, caching verified tokens until they expire."""
+
+    def __init__(self, client_id: str, cache_size: int = 1024):
+        self.client_id = client_id
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def _verify(self, token: str) -> dict:
+        # pylint: disable=import-outside-toplevel
+        from google.auth.transport import requests
+        from google.oauth2 import id_token
+
+        return id_token.verify_oauth2_token(token, requests.Request(), self.client_id)
+
+    async def verify(self, token: str) -> str:
+        """The verified email address of the token's user.
+
+        Raises:
+            ValueError: If the token is invalid or expired, or has no verified email.
+        """
+        cached = self._cache.get(token)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+        # May fetch Google's certs
+        claims = await asyncio.to_thread(self._verify, token)
+        if not claims.get("email") or not claims.get("email_verified"):
+            raise ValueError("Token has no verified email address.")
+        self._cache[token] = (claims["email"], float(claims["exp"]))
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return claims["email"]
+
+
+class Services:
+    """Everything the API handlers share."""
+
+    def __init__(
+        self,
+        config: Config,
+        rate_limiter: RateLimiter,
+        verifier: IdTokenVerifier | None = None,
+        client=None,
+    ):
+        # The Gen AI SDK and its dependents are imported once the server has started
+        # pylint: disable=import-outside-toplevel
+        from agent import load_client
+        from engine import GenerationEngine
+
+        self.config = config
+        self.rate_limiter = rate_limiter
+        self.verifier = verifier
+        self.client = client or load_client(config.project_id, config.region)
+        self.client_pool = None
+        fallback_regions = [
+            r.strip() for r in config.fallback_regions.split(",") if r.strip()
+        ]
+        if fallback_regions and client is None:
+            regions = [r for r in fallback_regions if r != config.region]
+            self.client_pool = ClientPool(
+                [(config.region, self.client)]
+                + [
+                    (region, load_client(config.project_id, region))
+                    for region in regions
+                ]
+            )
+        self.engine = GenerationEngine(
+            max_concurrency=config.generation_concurrency,
+            timeout_seconds=config.generation_timeout,
+            retry_policy=RetryPolicy(
+                max_attempts=config.generation_max_attempts,
+                hedge_after=config.generation_hedge_after,
+            ),
+            admission=AdmissionController(
+                max_concurrency=config.generation_concurrency,
+                min_concurrency=config.generation_min_concurrency,
+                max_queue=config.generation_queue_size,
+            ),
+        )
+        self.prompt_cache = None
+        if config.context_cache:
+            from prompt_cache import SystemPromptCache
+
+            self.prompt_cache = SystemPromptCache(ttl_seconds=config.context_cache_ttl)
+        self.tokens = TokenAccountant(rate_limiter=rate_limiter)
+        self.router = None
+        if config.routing_max_chars:
+            from router import ModelRouter
+
+            self.router = ModelRouter(max_chars=config.routing_max_chars)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    """Authentication and JSON errors, for all API handlers."""
+
+    services: Services
+    identity: str
+
+    def initialize(self, services: Services):  # pylint: disable=arguments-differ
+        self.services = services
+
+    async def prepare(self):
+        verifier = self.services.verifier
+        if verifier is None:
+            self.identity = f"ip:{self.request.remote_ip}"
+            return
+        auth = self.request.headers.get("Authorization", "")
+        if not auth.startswith("Bearer "):
+            raise tornado.web.HTTPError(401, reason="Missing bearer token")
+        try:
+            email = await verifier.verify(auth.removeprefix("Bearer ").strip())
+        except ValueError as e:
+            raise tornado.web.HTTPError(401, reason="Invalid token") from e
+        self.identity = f"user:{email}"  # The same key as the UI's rate limits
+
+    def write_error(self, status_code: int, **kwargs):
+        self.set_header("Content-Type", "application/json")
+        self.finish({"error": self._reason})
+
+
+class PersonalitiesHandler(BaseHandler):
+    def get(self):
+        self.write(
+            {
+                "personalities": [
+                    {
+                        "name": p.name,
+                        "title": p.title,
+                        "overview": p.overview,
+                        "welcome": p.welcome,
+                    }
+                    for p in personalities.values()
+                ]
+            }
+        )
+
+
+class ChatHandler(BaseHandler):
+    """Streams a response to a client-held conversation, as Server-Sent Events:
+    `queued` events while waiting for a slot, a `message` event per text chunk,
+    and finally a `done` event with the token usage, or an `error` event."""
+
+    def _parse(self) -> tuple:
+        try:
+            body = json.loads(self.request.body)
+            personality = personalities[body.get("personality", "Rick")]
+            messages = [
+                {"role": m["role"], "content": str(m["content"])}
+                for m in body["messages"]
+            ]
+        except (ValueError, KeyError, TypeError) as e:
+            raise tornado.web.HTTPError(400, reason=f"Invalid request: {e}") from e
+        if not messages or messages[-1]["role"] != "user":
+            raise tornado.web.HTTPError(
+                400, reason="The last message must be a user's."
+            )
+        if any(m["role"] not in ("user", "assistant") for m in messages):
+            raise tornado.web.HTTPError(400, reason="Roles must be user or assistant.")
+        return personality, messages
+
+    async def _send(self, event: str, data: dict):
+        if not self._headers_written:
+            self.set_header("Content-Type", "text/event-stream")
+            self.set_header("Cache-Control", "no-cache")
+            self.set_header("X-Accel-Buffering", "no")  # Don't buffer in proxies
+        prefix = f"event: {event}\n" if event != "message" else ""
+        self.write(f"{prefix}data: {json.dumps(data)}\n\n")
+        await self.flush()
+
+    async def post(self):
+        # pylint: disable=import-outside-toplevel
+        from agent import get_model, get_model_config, initialise_model_config
+        from history import HistoryBuilder
+
+        services, config = self.services, self.services.config
+        personality, messages = self._parse()
+        # The rate limits' storage may be remote, so don't block the loop on it
+        if not await asyncio.to_thread(services.rate_limiter.hit, self.identity):
+            remaining = await asyncio.to_thread(
+                services.rate_limiter.tokens_remaining, self.identity
+            )
+            if remaining == 0:
+                raise tornado.web.HTTPError(429, reason="Token budget used up")
+            raise tornado.web.HTTPError(429, reason="Rate limited")
+
+        prompt = messages[-1]["content"]
+        model = get_model(personality)
+        if services.router:
+            model = services.router.route(personality, model, prompt, messages).model
+        grounded = should_ground(personality, prompt)
+        with span("model_config", personality=personality.name, model=model):
+            # May load the system prompt, or create a context cache
+            model_config = await asyncio.to_thread(
+                get_model_config,
+                services.client,
+                personality,
+                services.prompt_cache,
+                model,
+                grounded,
+            )
+        with span("history_build", personality=personality.name, model=model):
+            contents = HistoryBuilder(
+                max_tokens=config.history_max_tokens, max_bytes=config.history_max_bytes
+            ).build(messages)
+
+        queue_updates: asyncio.Queue[QueueStatus | None] = asyncio.Queue()
+        usage_metadata = []
+        stream = instrument_astream(
+            services.engine.astream(
+                services.client_pool or services.client,
+                model,
+                contents,
+                model_config,
+                # Context caches are regional, so fallback regions get the system prompt
+                fallback_config=(
+                    initialise_model_config(personality, grounded)
+                    if services.client_pool
+                    else None
+                ),
+                user=self.identity,
+                on_queued=queue_updates.put_nowait,
+                on_usage=usage_metadata.append,
+            ),
+            personality.name,
+            model,
+        )
+        chars = 0
+        first_chunk = asyncio.ensure_future(anext(stream, None))
+        try:
+            await self._send_queue_updates(queue_updates, first_chunk)
+            text = first_chunk.result()
+            while text is not None:
+                chars += len(text)
+                await self._send("message", {"text": text})
+                text = await anext(stream, None)
+            done = {"personality": personality.name, "model": model}
+            if usage_metadata:
+                # The first response may count the system prompt's tokens, so not on the loop
+                usage = await asyncio.to_thread(
+                    services.tokens.record,
+                    services.client,
+                    personality,
+                    model,
+                    usage_metadata[-1],
+                    self.identity,
+                )
+                done["usage"] = {
+                    "prompt_tokens": usage.prompt,
+                    "system_prompt_tokens": usage.system_prompt,
+                    "cached_tokens": usage.cached,
+                    "output_tokens": usage.output,
+                    "thoughts_tokens": usage.thoughts,
+                }
+            await self._send("done", done)
+        except StreamClosedError:
+            logger.debug("API client disconnected.")
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            await self._fail(e)
+        finally:
+            if not first_chunk.done():
+                first_chunk.cancel()  # E.g. the client disconnected while queued
+                await asyncio.gather(first_chunk, return_exceptions=True)
+            await stream.aclose()
+        logger.debug(f"API response for {personality.name}: {chars} characters")
+
+    async def _send_queue_updates(
+        self, updates: asyncio.Queue, first_chunk: asyncio.Future
+    ):
+        """Send `queued` events as the queue status changes, until the first chunk arrives."""
+        while not first_chunk.done():
+            update = asyncio.ensure_future(updates.get())
+            await asyncio.wait(
+                (first_chunk, update), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not update.done():
+                update.cancel()
+                continue
+            status = update.result()
+            if status is not None:
+                await self._send(
+                    "queued",
+                    {"position": status.position, "eta_seconds": status.eta_seconds},
+                )
+
+    async def _fail(self, e: Exception):
+        if isinstance(e, QueueFullError):
+            status, reason = 503, "Too many requests are waiting. Try again later."
+        elif isinstance(e, TimeoutError):
+            status, reason = 504, "Timed out."
+        else:
+            logger.error(f"API generation failed: {e}")
+            status, reason = 502, f"Generation failed: {type(e).__name__}"
+        if not self._headers_written:
+            raise tornado.web.HTTPError(status, reason=reason)
+        try:
+            await self._send("error", {"status": status, "error": reason})
+        except StreamClosedError:
+            pass
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"status": "ok"})
+
+
+def make_app(services: Services) -> tornado.web.Application:
+    """The API's routes."""
+    return tornado.web.Application(
+        [
+            (r"/v1/personalities", PersonalitiesHandler, {"services": services}),
+            (r"/v1/chat", ChatHandler, {"services": services}),
+            (r"/healthz", HealthHandler),
+        ]
+    )
+
+
+async def main():
+    # pylint: disable=import-outside-toplevel
+    from streamlit import config as st_config
+    from streamlit.logger import set_log_level
+
+    # Config is shared with the Streamlit app. Silence its bare mode warnings.
+    st_config.get_config_options()
+    set_log_level("error")
+
+    config = get_config()
+    configure_secret_cache(config.secret_cache_ttl, config.secret_negative_cache_ttl)
+    configure_prompt_cache(config.prompt_cache_dir, config.prompt_cache_ttl)
+    verifier = None
+    if config.auth_required:
+        from create_auth_secrets import create_secrets_toml
+
+        create_secrets_toml(config.project_id)
+        verifier = IdTokenVerifier(load_client_id())
+
+    services = Services(config, create_rate_limiter(config), verifier)
+    if config.metrics_port:
+        start_metrics_server(config.metrics_port)
+    if config.personality_reload_interval:
+        from agent import invalidate_model_configs
+        from hot_reload import PersonalityReloader
+
+        def invalidate(names: list[str]):
+            invalidate_model_configs()
+            for name in names:
+                if services.prompt_cache:
+                    services.prompt_cache.invalidate(name)
+
+        reloader = PersonalityReloader(
+            personalities, interval=config.personality_reload_interval
+        )
+        reloader.on_reload(invalidate)
+        reloader.start()
+    # Behind a load balancer, e.g. Cloud Run's, take the client's address from
+    # X-Forwarded-For, so that anonymous users don't share one identity
+    make_app(services).listen(
+        config.api_port, max_body_size=MAX_BODY_BYTES, xheaders=True
+    )
+    logger.info(
+        f"Rickbot API listening on port {config.api_port}. Auth: {config.auth_required}"
+    )
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
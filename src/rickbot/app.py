@@ -1,14 +1,29 @@
 """A Rick Sanchez (Rick and Morty) Rickbot, rendered using Streamlit."""
 
+from startup import startup  # First, so that its timings include the other imports
+
 import streamlit as st
-from limits import storage, parse
-from limits.strategies import MovingWindowRateLimiter
 
+from admission import AdmissionController
+from attachments import create_attachment_store
+from compaction import HistoryCompactor
 from config import get_config, logger, APP_NAME
 from create_auth_secrets import create_secrets_toml
-from personality import personalities, get_avatar
+from engine import GenerationEngine
+from memory import MemoryAccountant
+from metrics import start_metrics_server
+from personality import configure_prompt_cache, personalities, get_avatar
+from preprocess import AttachmentPreprocessor, PreprocessSettings
+from rate_limit import create_rate_limiter
+from resilience import ClientPool, RetryPolicy
+from response_cache import ResponseCache
+from router import ModelRouter
+from usage import TokenAccountant
+from utils import configure_secret_cache
 from chat import render_chat  # Import the new chat renderer
 
+startup.mark("imports")
+
 # --- Page Configuration ---
 # This must be the first Streamlit command in your script.
 RICKBOT_AVATAR = get_avatar("rickbot-trans")
@@ -22,20 +37,196 @@ st.set_page_config(
 
 @st.cache_resource
 def get_rate_limiter():
-    """Simple in-memory storage for rate limiting."""
-    limits_mem_store = storage.MemoryStorage()
-    limiter = MovingWindowRateLimiter(limits_mem_store)
-    limit = parse(f"{config.rate_limit}/minute")
-    return limiter, limit
+    """Per-user and global rate limits, held in the configured storage.
+    With fast start, the storage is connected when the first message is sent."""
+    limiter = create_rate_limiter(config)
+    if not config.fast_start:
+        limiter.connect()
+    return limiter
+
+
+@st.cache_resource
+def get_attachment_store():
+    """Content-addressed attachment store, shared by all sessions."""
+    return create_attachment_store(
+        config.attachment_dir, config.attachment_max_bytes, config.attachment_bucket
+    )
+
+
+@st.cache_resource
+def get_memory_accountant():
+    """Tracks the memory held by each session, and enforces the memory caps."""
+    return MemoryAccountant(
+        session_max_bytes=config.session_memory_max_bytes,
+        max_bytes=config.memory_max_bytes,
+        attachment_store=attachment_store,
+        preprocessor=preprocessor,
+    )
+
+
+@st.cache_resource
+def get_attachment_preprocessor():
+    """Preprocesses uploads before they are stored, if enabled."""
+    if not config.preprocess_attachments:
+        return None
+    return AttachmentPreprocessor(
+        PreprocessSettings(
+            image_max_px=config.image_max_px,
+            media_max_seconds=config.media_max_seconds,
+            video_max_height=config.video_max_height,
+            pdf_max_pages=config.pdf_max_pages,
+        ),
+        max_workers=config.preprocess_workers,
+    )
+
+
+@st.cache_resource
+def get_prompt_cache():
+    """Server-side cache of personality system prompts, if context caching is enabled."""
+    if not config.context_cache:
+        return None
+    from prompt_cache import (  # pylint: disable=import-outside-toplevel
+        SystemPromptCache,
+    )
+
+    return SystemPromptCache(ttl_seconds=config.context_cache_ttl)
+
+
+@st.cache_resource
+def get_generation_engine():
+    """Async generation engine, shared by all sessions, with a fair admission queue."""
+    return GenerationEngine(
+        max_concurrency=config.generation_concurrency,
+        timeout_seconds=config.generation_timeout,
+        retry_policy=RetryPolicy(
+            max_attempts=config.generation_max_attempts,
+            hedge_after=config.generation_hedge_after,
+        ),
+        admission=AdmissionController(
+            max_concurrency=config.generation_concurrency,
+            min_concurrency=config.generation_min_concurrency,
+            max_queue=config.generation_queue_size,
+        ),
+    )
+
+
+@st.cache_resource
+def get_client_pool():
+    """Clients for the primary and fallback regions, if any fallback regions are configured.
+    Shared by all sessions, so that the health of each region is tracked across requests.
+    """
+    fallback_regions = [
+        r.strip() for r in config.fallback_regions.split(",") if r.strip()
+    ]
+    if not fallback_regions:
+        return None
+    from agent import load_client  # pylint: disable=import-outside-toplevel
+
+    regions = [config.region] + [r for r in fallback_regions if r != config.region]
+    return ClientPool(
+        [(region, load_client(config.project_id, region)) for region in regions]
+    )
+
+
+@st.cache_resource
+def get_response_cache():
+    """Cache of responses to repeated opening prompts, if enabled."""
+    if not config.response_cache_size:
+        return None
+    return ResponseCache(
+        max_entries=config.response_cache_size, ttl_seconds=config.response_cache_ttl
+    )
+
+
+@st.cache_resource
+def get_history_compactor():
+    """Summarises the older turns of long conversations, if compaction is enabled."""
+    if not config.compaction_tokens:
+        return None
+    return HistoryCompactor(
+        threshold_tokens=config.compaction_tokens,
+        keep_messages=config.compaction_keep_messages,
+    )
+
+
+@st.cache_resource
+def get_model_router():
+    """Sends simple prompts to fast models, if routing is enabled."""
+    if not config.routing_max_chars:
+        return None
+    return ModelRouter(max_chars=config.routing_max_chars)
+
+
+@st.cache_resource
+def get_token_accountant():
+    """Token usage by personality and model, charged to per-user token budgets.
+    Shared by all sessions, so each system prompt's tokens are only counted once."""
+    return TokenAccountant(rate_limiter=get_rate_limiter())
+
+
+@st.cache_resource
+def get_personality_reloader():
+    """Reloads changed personalities and prompts into the shared registry, if enabled,
+    and invalidates what was cached for them."""
+    if not config.personality_reload_interval:
+        return None
+    from hot_reload import (  # pylint: disable=import-outside-toplevel
+        PersonalityReloader,
+    )
+
+    def invalidate(names: list[str]):
+        from agent import (  # pylint: disable=import-outside-toplevel
+            invalidate_model_configs,
+        )
+
+        invalidate_model_configs()
+        for name in names:
+            if prompt_cache:
+                prompt_cache.invalidate(name)
+            if response_cache:
+                response_cache.invalidate(name)
+
+    reloader = PersonalityReloader(
+        personalities, interval=config.personality_reload_interval
+    )
+    reloader.on_reload(invalidate)
+    reloader.start()
+    return reloader
+
+
+@st.cache_resource
+def get_metrics_server():
+    """Serves Prometheus metrics, if a metrics port is configured."""
+    if not config.metrics_port:
+        return None
+    return start_metrics_server(config.metrics_port)
 
 
 # --- One-time Application Setup ---
 config = get_config()
-rate_limiter, rate_limit = get_rate_limiter()
+configure_secret_cache(config.secret_cache_ttl, config.secret_negative_cache_ttl)
+configure_prompt_cache(config.prompt_cache_dir, config.prompt_cache_ttl)
+get_metrics_server()
+rate_limiter = get_rate_limiter()
+attachment_store = get_attachment_store()
+preprocessor = get_attachment_preprocessor()
+memory = get_memory_accountant()
+prompt_cache = get_prompt_cache()
+engine = get_generation_engine()
+client_pool = get_client_pool()
+response_cache = get_response_cache()
+compactor = get_history_compactor()
+router = get_model_router()
+tokens = get_token_accountant()
+get_personality_reloader()
+startup.mark("resources")
 
 # Initialize session state for personality if it doesn't exist.
-if "current_personality" not in st.session_state:
-    st.session_state.current_personality = "Rick"
+# A reload may have removed the session's personality.
+if st.session_state.get("current_personality") not in personalities:
+    st.session_state.current_personality = (
+        "Rick" if "Rick" in personalities else next(iter(personalities))
+    )
 
 # Get the current personality object to display the correct header.
 # This will update if the personality is changed in the sidebar causing a rerun.
@@ -44,7 +235,20 @@ current_personality = personalities[st.session_state.current_personality]
 
 def authenticated_flow():
     """Defines the logic to run after successful authentication or if auth is not required."""
-    render_chat(config=config, rate_limiter=rate_limiter, rate_limit=rate_limit)
+    render_chat(
+        config=config,
+        rate_limiter=rate_limiter,
+        attachment_store=attachment_store,
+        prompt_cache=prompt_cache,
+        engine=engine,
+        response_cache=response_cache,
+        preprocessor=preprocessor,
+        compactor=compactor,
+        client_pool=client_pool,
+        router=router,
+        memory=memory,
+        tokens=tokens,
+    )
 
 
 # --- Authentication and Page Rendering ---
@@ -68,7 +272,7 @@ if config.auth_required:
             "Rickbot is a chat application. Chat with Rick, ask your questions, and feel free to upload content as part of your discussion. Rickbot also offers multiple other personalities to interact with."
         )
         st.markdown(
-            ":eyes: We do not store any user data, prompts or responses. Read our [Privacy Policy](/privacy_policy)."
+            ":eyes: We do not keep your conversations, and uploads are only held temporarily. Read our [Privacy Policy](/privacy_policy)."
         )
         st.divider()
         st.markdown(
@@ -80,3 +284,9 @@ if config.auth_required:
         authenticated_flow()
 else:
     authenticated_flow()
+
+startup.mark("first_render")
+if startup.report() and config.fast_start:
+    # Import the Gen AI SDK in the background once the first page has been served,
+    # so that the first message doesn't have to wait for it
+    startup.prewarm(["agent", "history"])
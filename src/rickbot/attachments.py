@@ -0,0 +1,198 @@
+"""Content-addressed storage for uploaded attachments.
+
+Attachment bytes are written once to local disk, keyed by their SHA-256 digest,
+and chat messages only hold a small `AttachmentRef`. Identical uploads are stored once,
+and the least recently used attachments are evicted when the store exceeds its size limit.
+Optionally, each attachment is also uploaded once to Cloud Storage, so that the model
+can be sent a `gs://` reference rather than the bytes themselves."""
+
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from PIL import Image  # Installed with Streamlit
+
+from config import logger
+from metrics import gauge
+
+Uploader = Callable[[str, bytes, str], str]  # (digest, data, mime_type) -> remote URI
+
+
+@dataclass(frozen=True)
+class AttachmentRef:
+    """A handle to an attachment held in the `AttachmentStore`."""
+
+    digest: str  # SHA-256 of the content
+    mime_type: str
+    size: int  # Bytes
+    remote_uri: str | None = None  # E.g. gs://bucket/object, if uploaded
+
+    @property
+    def kind(self) -> str:
+        """The top-level media type, e.g. 'image' or 'video'."""
+        return self.mime_type.split("/", 1)[0]
+
+
+def content_digest(data: bytes) -> str:
+    """The key under which content is stored."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_thumbnail(source: str | Path, max_px: int = 512) -> bytes:
+    """A JPEG of the image, no larger than max_px in either dimension.
+
+    Raises:
+        OSError: If the image can't be read.
+    """
+    with Image.open(source) as image:
+        image.thumbnail((max_px, max_px))
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class GcsUploader:
+    """Uploads attachments to a Cloud Storage bucket, once per digest.
+    google-cloud-storage is imported only if an upload bucket is configured.
+    Use a bucket lifecycle rule to delete old objects."""
+
+    def __init__(self, bucket_name: str, prefix: str = "attachments"):
+        from google.cloud import storage  # pylint: disable=import-outside-toplevel
+
+        self._bucket = storage.Client().bucket(bucket_name)
+        self._prefix = prefix
+
+    def __call__(self, digest: str, data: bytes, mime_type: str) -> str:
+        blob = self._bucket.blob(f"{self._prefix}/{digest}")
+        if not blob.exists():
+            blob.upload_from_string(data, content_type=mime_type)
+        return f"gs://{self._bucket.name}/{blob.name}"
+
+
+class AttachmentStore:
+    """A size-bounded, content-addressed attachment store on local disk.
+    Safe to share between sessions."""
+
+    def __init__(
+        self, root: str | Path, max_bytes: int, uploader: Uploader | None = None
+    ):
+        """
+        Args:
+            root (str | Path): Directory in which attachments are written.
+            max_bytes (int): Total size at which least recently used attachments are evicted.
+            uploader (Uploader, optional): Uploads attachments to remote storage and returns a URI.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._uploader = uploader
+        self._lock = threading.Lock()
+        # digest -> size, in LRU order
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._remote_uris: dict[str, str] = {}
+        self._total_bytes = 0
+        gauge(
+            "rickbot_attachment_store_bytes",
+            "Bytes of attachments held on local disk.",
+            function=lambda: self.total_bytes,
+        )
+
+    @property
+    def total_bytes(self) -> int:
+        """Bytes currently held on local disk."""
+        return self._total_bytes
+
+    def _path(self, digest: str) -> Path:
+        return self.root / digest
+
+    def put(self, data: bytes, mime_type: str) -> AttachmentRef:
+        """Store the content, if not already stored, and return a reference to it."""
+        digest = content_digest(data)
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+            else:
+                self._path(digest).write_bytes(data)
+                self._entries[digest] = len(data)
+                self._total_bytes += len(data)
+                self._evict(self.max_bytes, keep=digest)
+
+        remote_uri = self._remote_uris.get(digest)
+        if self._uploader and not remote_uri:
+            try:
+                remote_uri = self._uploader(digest, data, mime_type)
+                self._remote_uris[digest] = remote_uri
+            except Exception as e:
+                logger.warning(f"Unable to upload attachment {digest[:12]}: {e}")
+
+        return AttachmentRef(
+            digest=digest, mime_type=mime_type, size=len(data), remote_uri=remote_uri
+        )
+
+    def _evict(self, max_bytes: int, keep: str | None = None):
+        """Remove least recently used attachments until we're within max_bytes."""
+        while self._total_bytes > max_bytes and self._entries:
+            digest, size = next(iter(self._entries.items()))
+            if digest == keep:
+                break
+            del self._entries[digest]
+            self._total_bytes -= size
+            self._path(digest).unlink(missing_ok=True)
+            logger.debug(f"Evicted attachment {digest[:12]} ({size} bytes)")
+
+    def shrink(self, max_bytes: int) -> int:
+        """Evict least recently used attachments until no more than max_bytes are held,
+        e.g. to free memory where local disk is in memory.
+
+        Returns:
+            int: The bytes evicted.
+        """
+        with self._lock:
+            before = self._total_bytes
+            self._evict(max_bytes)
+            return before - self._total_bytes
+
+    def path(self, ref: AttachmentRef) -> Path | None:
+        """The local path of the attachment, or None if it has been evicted."""
+        with self._lock:
+            if ref.digest not in self._entries:
+                return None
+            self._entries.move_to_end(ref.digest)
+        return self._path(ref.digest)
+
+    def get(self, ref: AttachmentRef) -> bytes | None:
+        """The attachment bytes, or None if they have been evicted."""
+        path = self.path(ref)
+        try:
+            return path.read_bytes() if path else None
+        except FileNotFoundError:
+            return None
+
+    def clear(self):
+        """Remove all attachments from local disk."""
+        with self._lock:
+            for digest in self._entries:
+                self._path(digest).unlink(missing_ok=True)
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+def create_attachment_store(
+    root: str | Path, max_bytes: int, bucket: str | None = None
+) -> AttachmentStore:
+    """Create an attachment store, with Cloud Storage uploads if a bucket is given."""
+    uploader = None
+    if bucket:
+        try:
+            uploader = GcsUploader(bucket)
+            logger.info(f"Attachments will be uploaded to gs://{bucket}")
+        except Exception as e:
+            logger.warning(
+                f"Attachment uploads disabled. Unable to use bucket '{bucket}': {e}"
+            )
+
+    return AttachmentStore(root, max_bytes, uploader)
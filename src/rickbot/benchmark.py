@@ -0,0 +1,350 @@
+"""Offline benchmarks for Rickbot, using a fake streaming Gemini client.
+
+Measures time to first token and total stream time, the cost of building the model history
+as conversations grow, memory per session, the cost of rendering the chat history,
+and the cold start time of a new process.
+Results are written as JSON, so that they can be compared between commits.
+
+Run from the src/rickbot directory:
+    python benchmark.py --output benchmark_results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from utils import FakeSecretBackend, set_secret_backend
+
+# Don't call Secret Manager for any prompts that aren't available locally
+set_secret_backend(FakeSecretBackend(default="You are a benchmark personality."))
+
+# pylint: disable=wrong-import-position
+from agent import get_rick_bot_response, initialise_model_config
+from attachments import AttachmentStore
+from coalesce import FlushPolicy
+from config import logger, SCRIPT_DIR
+from engine import GenerationEngine
+from fake_client import FakeGenaiClient, FakeStreamSettings
+from history import HistoryBuilder
+from personality import personalities
+
+
+# Modules the app imports before rendering its first page
+APP_MODULES = (
+    "startup",
+    "attachments",
+    "compaction",
+    "config",
+    "create_auth_secrets",
+    "engine",
+    "metrics",
+    "personality",
+    "preprocess",
+    "rate_limit",
+    "resilience",
+    "response_cache",
+    "router",
+    "chat",
+)
+
+
+def summarise(samples: list[float]) -> dict:
+    """Summary statistics for a list of timings, in milliseconds."""
+    ordered = sorted(samples)
+    return {
+        "n": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def make_history(
+    message_count: int, attachment_bytes: int, store: AttachmentStore | None
+) -> list[dict]:
+    """A synthetic conversation, with an attachment on every 5th user message."""
+    messages = []
+    for i in range(message_count):
+        if i % 2 == 0:
+            message = {"role": "user", "content": f"Question {i}? " * 10}
+            if attachment_bytes and store and i % 10 == 0:
+                data = os.urandom(attachment_bytes)
+                message["attachment"] = store.put(data, "image/png")
+            messages.append(message)
+        else:
+            messages.append({"role": "assistant", "content": f"Answer {i}. " * 50})
+    return messages
+
+
+def bench_stream(settings: FakeStreamSettings, repeat: int) -> list[dict]:
+    """Time to first token and total stream time, via the sync and engine paths,
+    with and without coalescing of chunks."""
+    client = FakeGenaiClient(settings=settings)
+    model_config = initialise_model_config(personalities["Rick"])
+    history = [{"role": "user", "content": "Who are you?"}]
+    engine = GenerationEngine(max_concurrency=4)
+
+    results = []
+    paths = (
+        ("sync", None, None),
+        ("engine", engine, None),
+        ("engine_coalesced", engine, FlushPolicy()),
+    )
+    for path, path_engine, flush_policy in paths:
+        ttfts, totals, chunks = [], [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            first = None
+            chunks = 0
+            for _chunk in get_rick_bot_response(
+                client,
+                history,
+                model_config,
+                engine=path_engine,
+                flush_policy=flush_policy,
+            ):
+                if first is None:
+                    first = time.perf_counter() - start
+                chunks += 1
+            totals.append(time.perf_counter() - start)
+            ttfts.append(first or 0.0)
+
+        results.append(
+            {
+                "name": "stream",
+                "params": {"path": path, **settings.__dict__},
+                "metrics": {
+                    "ttft": summarise(ttfts),
+                    "total": summarise(totals),
+                    "chunks": chunks,
+                    # Time we add, on top of the fake model's own latency
+                    "ttft_overhead_ms": (
+                        statistics.fmean(ttfts) - settings.first_chunk_latency
+                    )
+                    * 1000,
+                },
+            }
+        )
+    return results
+
+
+def bench_history(
+    message_counts: list[int], attachment_sizes: list[int], repeat: int
+) -> list[dict]:
+    """Cost of building the model history: from scratch, and incrementally per turn."""
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        store = AttachmentStore(root, max_bytes=2**40)
+        for attachment_bytes in attachment_sizes:
+            for message_count in message_counts:
+                messages = make_history(message_count, attachment_bytes, store)
+                full, incremental = [], []
+                for _ in range(repeat):
+                    builder = HistoryBuilder(attachment_store=store)
+                    start = time.perf_counter()
+                    builder.build(messages[:-2])
+                    full.append(time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    builder.build(messages)  # The next turn
+                    incremental.append(time.perf_counter() - start)
+
+                results.append(
+                    {
+                        "name": "history_build",
+                        "params": {
+                            "messages": message_count,
+                            "attachment_bytes": attachment_bytes,
+                        },
+                        "metrics": {
+                            "full": summarise(full),
+                            "incremental": summarise(incremental),
+                            "request_bytes": builder.size_bytes,
+                            "estimated_tokens": builder.tokens,
+                        },
+                    }
+                )
+                store.clear()
+    return results
+
+
+def bench_session_memory(
+    message_counts: list[int], attachment_bytes: int
+) -> list[dict]:
+    """Python heap held by a session's messages and history builder."""
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        store = AttachmentStore(root, max_bytes=2**40)
+        for message_count in message_counts:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            messages = make_history(message_count, attachment_bytes, store)
+            builder = HistoryBuilder(attachment_store=store)
+            builder.build(messages)
+            after, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append(
+                {
+                    "name": "session_memory",
+                    "params": {
+                        "messages": message_count,
+                        "attachment_bytes": attachment_bytes,
+                    },
+                    "metrics": {
+                        "session_bytes": after - before,
+                        "peak_bytes": peak - before,
+                        "held_attachment_bytes": builder.held_bytes,
+                        "attachment_store_bytes": store.total_bytes,
+                    },
+                }
+            )
+            del messages, builder
+            store.clear()
+    return results
+
+
+def bench_render(
+    message_counts: list[int], windows: list[int], repeat: int
+) -> list[dict]:
+    """Server-side cost of rendering the chat history, with Streamlit in bare mode,
+    in full and windowed."""
+    # pylint: disable=import-outside-toplevel
+    from streamlit import config as st_config
+    from streamlit.logger import set_log_level
+
+    # Silence the "missing ScriptRunContext" warnings of bare mode,
+    # once Streamlit has loaded its config and set its own log level
+    st_config.get_config_options()
+    set_log_level("error")
+    from chat import render_history
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        store = AttachmentStore(root, max_bytes=2**40)
+        for message_count in message_counts:
+            messages = make_history(message_count, 0, store)
+            for window in windows:
+                rick = personalities["Rick"]
+                render_history(messages, rick, store, window)  # Warm up
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    render_history(messages, rick, store, window)
+                    timings.append(time.perf_counter() - start)
+                results.append(
+                    {
+                        "name": "render_history",
+                        "params": {"messages": message_count, "window": window},
+                        "metrics": {"render": summarise(timings)},
+                    }
+                )
+    return results
+
+
+def bench_cold_start(repeat: int) -> list[dict]:
+    """Time for a new process to import what the app needs to render its first page,
+    and then to import the agent and Gen AI SDK, which are deferred to the first message.
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {', '.join(APP_MODULES)}\n"
+        "first_render = time.perf_counter() - start\n"
+        "genai = 'google.genai' in sys.modules\n"
+        "start = time.perf_counter()\n"
+        "import agent\n"
+        "print(first_render, time.perf_counter() - start, genai, "
+        "personality._bundle is not None)"
+    )
+    startups, deferred = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=SCRIPT_DIR,
+        ).stdout.split()
+        startups.append(float(output[0]))
+        deferred.append(float(output[1]))
+    return [
+        {
+            "name": "cold_start",
+            "params": {"bundle": output[3] == "True"},
+            "metrics": {
+                "imports": summarise(startups),
+                "deferred_imports": summarise(deferred),
+                "genai_imported_at_startup": output[2] == "True",
+            },
+        }
+    ]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--quick", action="store_true", help="Smaller, faster run")
+    parser.add_argument("--first-chunk-latency", type=float, default=0.3)
+    parser.add_argument("--chunk-latency", type=float, default=0.02)
+    parser.add_argument("--chunk-count", type=int, default=50)
+    parser.add_argument("--chunk-chars", type=int, default=20)
+    args = parser.parse_args()
+
+    settings = FakeStreamSettings(
+        first_chunk_latency=args.first_chunk_latency,
+        chunk_latency=args.chunk_latency,
+        chunk_count=args.chunk_count,
+        chunk_chars=args.chunk_chars,
+    )
+    message_counts = [10, 100] if args.quick else [10, 100, 1000]
+    attachment_sizes = [0, 100_000] if args.quick else [0, 100_000, 1_000_000]
+    repeat = 3 if args.quick else args.repeat
+
+    started = time.perf_counter()
+    results = []
+    results += bench_stream(settings, repeat)
+    results += bench_history(message_counts, attachment_sizes, repeat)
+    results += bench_session_memory(message_counts, attachment_sizes[-1])
+    results += bench_render(message_counts, [0, 20], repeat)
+    results += bench_cold_start(repeat)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "duration_s": time.perf_counter() - started,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {len(results)} benchmark results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
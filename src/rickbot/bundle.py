@@ -0,0 +1,97 @@
+"""A prebuilt bundle of the personalities and their local system prompts.
+
+Parsing personalities.yaml and reading each prompt file is done once, when the container
+image is built, and the result is written as JSON. At startup, the bundle is read instead,
+if it is still up to date with its source files. Otherwise the sources are used.
+
+Build the bundle from the src/rickbot directory:
+    python bundle.py
+"""
+
+import json
+import os
+from pathlib import Path
+
+from config import logger, SCRIPT_DIR
+
+BUNDLE_VERSION = 1
+BUNDLE_FILE = SCRIPT_DIR / "data/personalities.bundle.json"
+PERSONALITIES_FILE = SCRIPT_DIR / "data/personalities.yaml"
+SYSTEM_PROMPTS_DIR = SCRIPT_DIR / "data/system_prompts"
+
+
+def _source_files(yaml_file: Path, prompts_dir: Path) -> list[Path]:
+    prompts = sorted(prompts_dir.glob("*.txt")) if prompts_dir.is_dir() else []
+    return [yaml_file] + prompts
+
+
+def source_mtimes(
+    yaml_file: Path = PERSONALITIES_FILE, prompts_dir: Path = SYSTEM_PROMPTS_DIR
+) -> dict[str, int]:
+    """The modification time of the personalities file and each local prompt, by file name.
+
+    Raises:
+        OSError: If the personalities file can't be read.
+    """
+    return {
+        str(path.name): path.stat().st_mtime_ns
+        for path in _source_files(yaml_file, prompts_dir)
+    }
+
+
+def build_bundle(
+    yaml_file: Path = PERSONALITIES_FILE, prompts_dir: Path = SYSTEM_PROMPTS_DIR
+) -> dict:
+    """Parse the personalities and read their local prompts.
+    Prompts held in Secret Manager aren't bundled."""
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    with open(yaml_file, "r", encoding="utf-8") as f:
+        peeps = yaml.safe_load(f)
+    sources = _source_files(yaml_file, prompts_dir)
+    return {
+        "version": BUNDLE_VERSION,
+        "sources": source_mtimes(yaml_file, prompts_dir),
+        "personalities": peeps,
+        "prompts": {
+            path.stem: path.read_text(encoding="utf-8") for path in sources[1:]
+        },
+    }
+
+
+def write_bundle(bundle: dict, bundle_file: Path = BUNDLE_FILE):
+    """Write the bundle atomically, so that a running app never reads half of it."""
+    temp_file = bundle_file.with_suffix(".tmp")
+    temp_file.write_text(json.dumps(bundle), encoding="utf-8")
+    os.replace(temp_file, bundle_file)
+
+
+def read_bundle(
+    bundle_file: Path = BUNDLE_FILE,
+    yaml_file: Path = PERSONALITIES_FILE,
+    prompts_dir: Path = SYSTEM_PROMPTS_DIR,
+) -> dict | None:
+    """Read the bundle, if it exists and is up to date with its source files."""
+    try:
+        with open(bundle_file, "r", encoding="utf-8") as f:
+            bundle = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        current = source_mtimes(yaml_file, prompts_dir)
+    except OSError:
+        return None
+    if bundle.get("version") != BUNDLE_VERSION or bundle.get("sources") != current:
+        logger.info(f"{bundle_file.name} is out of date. Using the source files.")
+        return None
+    return bundle
+
+
+if __name__ == "__main__":
+    new_bundle = build_bundle()
+    write_bundle(new_bundle)
+    logger.info(
+        f"Wrote {len(new_bundle['personalities'])} personalities and "
+        f"{len(new_bundle['prompts'])} prompts to {BUNDLE_FILE}"
+    )
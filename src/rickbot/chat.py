@@ -2,54 +2,334 @@
 This module contains the chat interface for the Ricbot Streamlit application.
 """
 
+import math
+from functools import partial
 from typing import Any
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 from config import logger, SCRIPT_DIR
-from agent import load_client, get_rick_bot_response, initialise_model_config
+from admission import QueueFullError, QueueStatus
+from attachments import AttachmentRef, AttachmentStore, make_thumbnail
+from coalesce import FlushPolicy
+from grounding import default_grounding, should_ground
+from metrics import span
 from personality import personalities
+from usage import TokenUsage
 
 USER_AVATAR = str(SCRIPT_DIR / "media/morty.png")
 
 
-def get_rick_response(
-    client,
-    model_conf,
-    prompt,
-    uploaded_file,
-    rate_limiter,
-    rate_limit,
-    current_personality,
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_thumbnail(digest: str, path: str) -> bytes:
+    """A thumbnail of an image attachment, cached by digest across reruns and sessions."""
+    logger.debug(f"Creating thumbnail for {digest[:12]}")
+    return make_thumbnail(path)
+
+
+def render_attachment(
+    attachment: AttachmentRef,
+    source: AttachmentStore | bytes,
+    key: str = "",
+    placeholder: bool = False,
 ):
+    """Display an image or video attachment, from the store or from bytes we already hold.
+
+    Stored images are shown as cached thumbnails, and stored videos are only loaded when played.
+    With placeholder=True, the attachment is only described.
     """
-    Handles user input, rate limiting, and generating the bot's response.
+    if attachment.kind not in ("image", "video"):
+        return
+
+    if isinstance(source, bytes):
+        if attachment.kind == "image":
+            st.image(source)
+        else:
+            st.video(source)
+        return
+
+    description = f"{attachment.mime_type}, {attachment.size / 1024:,.0f} KB"
+    path = None if placeholder else source.path(attachment)
+    if not path:
+        unavailable = "" if placeholder else " (no longer available)"
+        st.caption(f":paperclip: {description}{unavailable}")
+        return
+
+    if attachment.kind == "image":
+        try:
+            st.image(cached_thumbnail(attachment.digest, str(path)))
+        except OSError:
+            st.image(str(path))  # Not an image Pillow can read
+    elif attachment.digest in st.session_state.setdefault("played_videos", set()):
+        st.video(str(path))
+    else:
+        st.button(
+            f":movie_camera: Play video ({description})",
+            key=f"play_{key}",
+            on_click=st.session_state.played_videos.add,
+            args=(attachment.digest,),
+        )
+
+
+def render_message(
+    message: dict, index: int, personality, attachment_store, placeholder=False
+):
+    """Display one message of the chat history."""
+    if message.get("panel"):
+        render_panel_message(message["panel"])
+        return
+    avatar = USER_AVATAR if message["role"] == "user" else personality.avatar
+    with st.chat_message(message["role"], avatar=avatar):
+        if "attachment" in message and message["attachment"]:
+            render_attachment(
+                message["attachment"],
+                attachment_store,
+                key=str(index),
+                placeholder=placeholder,
+            )
+        st.markdown(message["content"])
+
+
+def render_panel_message(responses: dict[str, str]):
+    """Display the responses of a panel of personalities, side by side."""
+    for column, (name, text) in zip(st.columns(len(responses)), responses.items()):
+        personality = personalities.get(name)
+        avatar = personality.avatar if personality else None
+        with column, st.chat_message("assistant", avatar=avatar):
+            st.caption(name)
+            st.markdown(text)
+
+
+def render_history(
+    messages: list[dict], personality, attachment_store, window: int = 0
+):
+    """Display the chat history.
+
+    Only the last `window` messages are rendered on every rerun. Earlier messages are
+    rendered a page at a time, on request, with their attachments only described.
+    A window of 0 renders every message.
     """
-    # --- Rate Limiting Check ---
-    # Perform this check *before* modifying session state or displaying the user's prompt
-    if not rate_limiter.hit(rate_limit, "request_lim"):
+    earlier = len(messages) - window if window else 0
+    if earlier > 0:
+        pages = math.ceil(earlier / window)
+        if st.toggle(f"Show {earlier} earlier messages", key="show_earlier_messages"):
+            page = st.number_input(
+                f"Page (of {pages})", min_value=1, max_value=pages, value=pages
+            )
+            start = (page - 1) * window
+            for index in range(start, min(start + window, earlier)):
+                render_message(
+                    messages[index],
+                    index,
+                    personality,
+                    attachment_store,
+                    placeholder=True,
+                )
+            st.divider()
+
+    for index in range(max(earlier, 0), len(messages)):
+        render_message(messages[index], index, personality, attachment_store)
+
+
+def get_session_id() -> str:
+    """Identifies the current browser session."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "unknown"
+
+
+def get_user_identity(config) -> str:
+    """Identifies the user for rate limiting: their email if logged in, else their session."""
+    if config.auth_required and st.user.is_logged_in and st.user.email:
+        return f"user:{st.user.email}"
+    return f"session:{get_session_id()}"
+
+
+def get_flush_policy(config) -> FlushPolicy | None:
+    """How response chunks are coalesced before they are written, if at all."""
+    if not config.stream_flush_min_interval:
+        return None
+    return FlushPolicy(
+        min_interval=config.stream_flush_min_interval,
+        max_interval=max(
+            config.stream_flush_min_interval, config.stream_flush_max_interval
+        ),
+    )
+
+
+def show_queue_status(bot_status, status: QueueStatus | None):
+    """Show a waiting request's place in the generation queue in the status box."""
+    if status is None:  # Admitted
+        bot_status.update(label="Thinking...", state="running")
+        return
+    eta = (
+        f" About {status.eta_seconds:.0f}s to go."
+        if status.eta_seconds is not None
+        else ""
+    )
+    bot_status.update(
+        label=f"Everyone wants a piece of me. You're number {status.position + 1} in line.{eta}",
+        state="running",
+    )
+
+
+def init_model(config, personality, prompt_cache=None) -> tuple[Any, Any]:
+    """Create the model client, and the model configuration for this personality.
+    Stops the script with an error if either fails.
+
+    Returns:
+        tuple: The client, and the default model configuration for the personality.
+    """
+    # The Gen AI SDK is slow to import, and isn't needed to render the page
+    # pylint: disable=import-outside-toplevel
+    from agent import load_client, get_model, get_model_config
+
+    try:
+        with span("client_init"):
+            client = load_client(config.project_id, config.region)
+        with span("model_config", personality=personality.name):
+            model = get_model(personality)
+            model_config = get_model_config(
+                client, personality, prompt_cache, model, default_grounding(personality)
+            )
+            if personality.grounding == "auto":  # Precompute both variants
+                get_model_config(
+                    client, personality, prompt_cache, model, grounded=False
+                )
+    except Exception as e:
+        logger.error(f"Failed to initialize AI client: {e}", exc_info=True)
+        st.error(
+            f"⚠️ Could not initialize the application. Please check your configuration. Error: {e}"
+        )
+        st.stop()
+    return client, model_config
+
+
+def init_history_builder(config, attachment_store):
+    """Create the session's history builder, if it doesn't have one yet.
+    It converts the chat history for the model incrementally, within the configured budget.
+    """
+    if "history_builder" not in st.session_state:
+        from history import HistoryBuilder  # pylint: disable=import-outside-toplevel
+
+        st.session_state.history_builder = HistoryBuilder(
+            max_tokens=config.history_max_tokens,
+            max_bytes=config.history_max_bytes,
+            attachment_store=attachment_store,
+        )
+
+
+def check_rate_limit(rate_limiter, user_identity: str):
+    """Stop the script with a warning if the user is rate limited, or out of tokens.
+    Checked *before* modifying session state or displaying the user's prompt."""
+    if rate_limiter.hit(user_identity):
+        return
+    if rate_limiter.tokens_remaining(user_identity) == 0:
+        st.warning(
+            "You've burned through all your tokens, Morty. That stuff isn't free, you know. Come back later."
+        )
+    else:
         st.warning(
             "Whoa, slow down there, Morty! You Morties are asking waaaay too many questions. Give me a minute."
         )
-        st.stop()  # Stop execution to prevent the message from being processed
+    st.stop()  # Stop execution to prevent the message from being processed
 
-    # Create the user message object, including any attachments
+
+def add_user_message(
+    prompt: str, uploaded_file, attachment_store, preprocessor=None
+) -> dict[str, Any]:
+    """Add the user's message and any attachment to the chat history, and display it.
+    The session only holds a reference to the attachment, not its bytes."""
     user_message: dict[str, Any] = {"role": "user", "content": prompt}
+    attachment_data = None
     if uploaded_file:
-        user_message["attachment"] = {
-            "data": uploaded_file.getvalue(),
-            "mime_type": uploaded_file.type or "",
-        }
+        attachment_data = uploaded_file.getvalue()  # Read the bytes once
+        mime_type = uploaded_file.type or ""
+        if preprocessor:
+            processed = preprocessor.process(attachment_data, mime_type)
+            attachment_data, mime_type = processed.data, processed.mime_type
+        user_message["attachment"] = attachment_store.put(attachment_data, mime_type)
     st.session_state.messages.append(user_message)
 
     # Display the user's message and attachment in the chat
     with st.chat_message("user", avatar=USER_AVATAR):
-        if uploaded_file:
-            mime_type = uploaded_file.type or ""
-            if "image" in mime_type:
-                st.image(uploaded_file.getvalue())
-            elif "video" in mime_type:
-                st.video(uploaded_file.getvalue())
+        if attachment_data:
+            render_attachment(user_message["attachment"], attachment_data)
         st.markdown(prompt)
+    return user_message
+
+
+def select_model(
+    client, personality, prompt: str, router=None, prompt_cache=None, model_conf=None
+) -> tuple[str, bool, Any]:
+    """The model, grounding and model configuration to respond to this prompt with.
+
+    Simple prompts are sent to the personality's fast model, if it has one,
+    and responses are only grounded with Google Search if the personality's policy says so.
+    The personality's default configuration, if given, is reused when it still applies.
+    """
+    from agent import (  # pylint: disable=import-outside-toplevel
+        get_model,
+        get_model_config,
+    )
+
+    model = main_model = get_model(personality)
+    if router:
+        with span("route", personality=personality.name):
+            model = router.route(
+                personality, model, prompt, st.session_state.messages
+            ).model
+    grounded = should_ground(personality, prompt)
+    if (
+        model_conf is None
+        or model != main_model
+        or grounded != default_grounding(personality)
+    ):
+        with span("model_config", personality=personality.name):
+            model_conf = get_model_config(
+                client, personality, prompt_cache, model, grounded
+            )
+    return model, grounded, model_conf
+
+
+def get_rick_response(
+    client,
+    model_conf,
+    prompt,
+    uploaded_file,
+    rate_limiter,
+    user_identity,
+    current_personality,
+    attachment_store,
+    engine=None,
+    response_cache=None,
+    preprocessor=None,
+    compactor=None,
+    flush_policy=None,
+    client_pool=None,
+    router=None,
+    prompt_cache=None,
+    memory=None,
+    tokens=None,
+):
+    """
+    Handles user input, rate limiting, and generating the bot's response.
+    """
+    # pylint: disable=import-outside-toplevel
+    from agent import get_rick_bot_response, initialise_model_config
+
+    check_rate_limit(rate_limiter, user_identity)
+    add_user_message(prompt, uploaded_file, attachment_store, preprocessor)
+    model, grounded, model_conf = select_model(
+        client, current_personality, prompt, router, prompt_cache, model_conf
+    )
+
+    def record_usage(metadata):
+        usage = tokens.record(
+            client, current_personality, model, metadata, user_identity
+        )
+        st.session_state.token_usage = (
+            st.session_state.get("token_usage", TokenUsage()) + usage
+        )
 
     # Generate and display Rick's response
     with st.status("Thinking...", expanded=True) as bot_status:
@@ -59,7 +339,27 @@ def get_rick_response(
                     client=client,
                     chat_history=st.session_state.messages,
                     model_config=model_conf,
+                    history_builder=st.session_state.history_builder,
+                    engine=engine,
+                    personality_name=current_personality.name,
+                    flush_policy=flush_policy,
+                    client_pool=client_pool,
+                    # Context caches are regional, so fallback regions get the system prompt
+                    fallback_config=(
+                        initialise_model_config(current_personality, grounded)
+                        if client_pool
+                        else None
+                    ),
+                    model=model,
+                    user=user_identity,
+                    on_queued=partial(show_queue_status, bot_status),
+                    on_usage=record_usage if tokens else None,
                 )
+                if response_cache:
+                    cache_key = response_cache.key_for(
+                        current_personality, st.session_state.messages, model, grounded
+                    )
+                    response_stream = response_cache.stream(cache_key, response_stream)
 
                 full_response = st.write_stream(response_stream)
                 bot_status.update(label="Done.", state="complete")
@@ -68,14 +368,166 @@ def get_rick_response(
                 st.session_state.messages.append(
                     {"role": "assistant", "content": full_response}
                 )
+
+                # Summarise older turns in the background, once the history is long
+                if compactor:
+                    compactor.maybe_compact(
+                        client,
+                        st.session_state.history_builder,
+                        st.session_state.messages,
+                        current_personality,
+                    )
+
+                # Account for the memory this session holds, releasing attachments if needed
+                if memory:
+                    memory.update(
+                        get_session_id(),
+                        st.session_state.messages,
+                        st.session_state.history_builder,
+                    )
             except Exception as e:
                 logger.error(e.__cause__)
+                if isinstance(e.__cause__, QueueFullError):
+                    bot_status.update(label="Too busy.", state="error")
+                    st.warning(
+                        "Listen, Morty, there's a line out the door of the garage. Try again in a minute."
+                    )
+                    return
                 st.error(
                     f"Ugh, great. I think I'm too drunk to respond. Are you even connected right now? Error: {type(e.__cause__)}"
                 )
 
 
-def render_chat(config, rate_limiter, rate_limit):
+def panel_content(responses: dict[str, str]) -> str:
+    """The panel's responses as one labelled message, for the model's history."""
+    return "\n\n".join(f"**{name}:** {text}" for name, text in responses.items())
+
+
+def get_panel_response(
+    client,
+    prompt,
+    uploaded_file,
+    rate_limiter,
+    user_identity,
+    panel,
+    attachment_store,
+    engine,
+    preprocessor=None,
+    compactor=None,
+    flush_policy=None,
+    client_pool=None,
+    router=None,
+    prompt_cache=None,
+    memory=None,
+    tokens=None,
+):
+    """
+    Sends the user's prompt to several personalities at once, and streams their responses
+    side by side. The fan-out counts once against the rate limit.
+    """
+    from agent import (  # pylint: disable=import-outside-toplevel
+        Panelist,
+        get_panel_responses,
+    )
+
+    check_rate_limit(rate_limiter, user_identity)
+    add_user_message(prompt, uploaded_file, attachment_store, preprocessor)
+    panelists = []
+    for personality in panel:
+        model, grounded, model_conf = select_model(
+            client, personality, prompt, router, prompt_cache
+        )
+        panelists.append(Panelist(personality, model, model_conf, grounded))
+
+    def record_usage(index: int, metadata):
+        panelist = panelists[index]
+        usage = tokens.record(
+            client, panelist.personality, panelist.model, metadata, user_identity
+        )
+        st.session_state.token_usage = (
+            st.session_state.get("token_usage", TokenUsage()) + usage
+        )
+
+    texts = [""] * len(panel)
+    errors: dict[int, Exception] = {}
+    with st.status("Thinking...", expanded=True) as bot_status:
+        placeholders = []
+        for column, personality in zip(st.columns(len(panel)), panel):
+            with column, st.chat_message("assistant", avatar=personality.avatar):
+                st.caption(personality.name)
+                placeholders.append(st.empty())
+
+        try:
+            for index, text in get_panel_responses(
+                client=client,
+                chat_history=st.session_state.messages,
+                panel=panelists,
+                engine=engine,
+                history_builder=st.session_state.history_builder,
+                flush_policy=flush_policy,
+                client_pool=client_pool,
+                user=user_identity,
+                on_queued=partial(show_queue_status, bot_status),
+                on_usage=record_usage if tokens else None,
+                on_error=errors.__setitem__,
+            ):
+                texts[index] += text
+                placeholders[index].markdown(texts[index])
+        except Exception as e:  # E.g. the history couldn't be built
+            logger.error(e)
+            bot_status.update(label="Failed.", state="error")
+            st.error(f"Ugh, the whole panel passed out. Error: {type(e)}")
+            return
+
+        for index, e in errors.items():
+            logger.error(f"{panel[index].name} failed: {e}")
+            if isinstance(e, QueueFullError):
+                placeholders[index].warning("Too busy. Try again in a minute.")
+            else:
+                placeholders[index].error(f"Too drunk to respond. Error: {type(e)}")
+        if len(errors) == len(panel):
+            bot_status.update(label="Failed.", state="error")
+            return
+        bot_status.update(label="Done.", state="complete")
+
+    # Keep the responses for display, and as one labelled message for the model
+    responses = {
+        personality.name: texts[index]
+        for index, personality in enumerate(panel)
+        if index not in errors
+    }
+    st.session_state.messages.append(
+        {"role": "assistant", "content": panel_content(responses), "panel": responses}
+    )
+    if compactor:
+        compactor.maybe_compact(
+            client,
+            st.session_state.history_builder,
+            st.session_state.messages,
+            panel[0],
+        )
+    if memory:
+        memory.update(
+            get_session_id(),
+            st.session_state.messages,
+            st.session_state.history_builder,
+        )
+
+
+def render_chat(
+    config,
+    rate_limiter,
+    attachment_store,
+    prompt_cache=None,
+    engine=None,
+    response_cache=None,
+    preprocessor=None,
+    compactor=None,
+    client_pool=None,
+    router=None,
+    memory=None,
+    tokens=None,
+):
     """
     Renders the main chat interface, including sidebar and chat history.
     """
@@ -116,6 +568,25 @@ def render_chat(config, rate_limiter, rate_limit):
 
         st.info(current_personality.overview)
 
+        # --- Panel Selection ---
+        # Ask several personalities at once, without resetting the conversation
+        panel = []
+        if config.panel_max_size > 1 and engine:
+            st.session_state.panel = [
+                name
+                for name in st.session_state.get("panel", [])
+                if name in personalities
+            ]  # A reload may have removed a panelist
+            panel_names = st.multiselect(
+                "Ask a panel:",
+                options=list(personalities),
+                format_func=lambda name: personalities[name].menu_name,
+                max_selections=config.panel_max_size,
+                key="panel",
+                help="Send each message to all of these personalities at once.",
+            )
+            panel = [personalities[name] for name in panel_names]
+
         # --- File Uploader ---
         uploaded_file = st.file_uploader(
             "Upload a file.",
@@ -126,6 +597,12 @@ def render_chat(config, rate_limiter, rate_limit):
             st.session_state.messages = []
             st.rerun()
 
+        if "token_usage" in st.session_state:
+            usage = st.session_state.token_usage
+            st.caption(
+                f"Tokens this session: {usage.total:,} in {usage.requests} responses"
+            )
+
         st.info(
             """
             ### Info
@@ -137,38 +614,61 @@ def render_chat(config, rate_limiter, rate_limit):
         )
 
     # --- Main Chat Interface ---
-    try:
-        client = load_client(config.project_id, config.region)
-        model_config = initialise_model_config(current_personality)
-    except Exception as e:
-        logger.error(f"Failed to initialize AI client: {e}", exc_info=True)
-        st.error(
-            f"⚠️ Could not initialize the application. Please check your configuration. Error: {e}"
-        )
-        st.stop()
+    # With fast start, the model is only set up when the first message is sent
+    client = model_config = None
+    if not config.fast_start:
+        client, model_config = init_model(config, current_personality, prompt_cache)
 
     # Display previous messages from history
-    for message in st.session_state.messages:
-        avatar = (
-            USER_AVATAR if message["role"] == "user" else current_personality.avatar
-        )
-        with st.chat_message(message["role"], avatar=avatar):
-            if "attachment" in message and message["attachment"]:
-                attachment = message["attachment"]
-                if "image" in attachment["mime_type"]:
-                    st.image(attachment["data"])
-                elif "video" in attachment["mime_type"]:
-                    st.video(attachment["data"])
-            st.markdown(message["content"])
+    render_history(
+        st.session_state.messages,
+        current_personality,
+        attachment_store,
+        window=config.history_render_window,
+    )
 
     # Handle new user input
     if prompt := st.chat_input(current_personality.prompt_question):
-        get_rick_response(
-            client,
-            model_config,
-            prompt,
-            uploaded_file,
-            rate_limiter,
-            rate_limit,
-            current_personality,
-        )
+        if client is None:
+            client, model_config = init_model(config, current_personality, prompt_cache)
+        init_history_builder(config, attachment_store)
+        if len(panel) > 1:
+            get_panel_response(
+                client,
+                prompt,
+                uploaded_file,
+                rate_limiter,
+                get_user_identity(config),
+                panel,
+                attachment_store,
+                engine,
+                preprocessor,
+                compactor,
+                get_flush_policy(config),
+                client_pool,
+                router,
+                prompt_cache,
+                memory,
+                tokens,
+            )
+        else:
+            get_rick_response(
+                client,
+                model_config,
+                prompt,
+                uploaded_file,
+                rate_limiter,
+                get_user_identity(config),
+                current_personality,
+                attachment_store,
+                engine,
+                response_cache,
+                preprocessor,
+                compactor,
+                get_flush_policy(config),
+                client_pool,
+                router,
+                prompt_cache,
+                memory,
+                tokens,
+            )
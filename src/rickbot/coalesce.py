@@ -0,0 +1,107 @@
+"""Coalescing of streamed response chunks, before they are written to the UI.
+
+Every chunk written with `st.write_stream` is a websocket message and a markdown re-render
+in the browser. Chunks are buffered and flushed by time and size instead. The first chunk
+is flushed immediately, so time to first token is unchanged, and the flush interval
+grows as the response gets longer, where re-rendering the whole response costs more."""
+
+import time
+from dataclasses import dataclass
+from typing import Iterator
+
+from config import logger
+from metrics import counter
+
+coalesced_chunks_in = counter(
+    "rickbot_coalesce_chunks_in_total", "Response chunks received from the model."
+)
+coalesced_flushes_out = counter(
+    "rickbot_coalesce_flushes_out_total", "Coalesced chunks written to the UI."
+)
+
+
+@dataclass(frozen=True)
+class FlushPolicy:
+    """When buffered text is flushed."""
+
+    min_interval: float = 0.05  # Seconds between flushes, at the start of a response
+    max_interval: float = 0.25  # Seconds between flushes, for long responses
+    ramp_chars: int = 2000  # Response length over which the interval grows
+    max_chars: int = 1000  # Flush as soon as this much text is buffered
+
+
+class ChunkCoalescer:
+    """Buffers the text of one response stream, deciding when to flush it."""
+
+    def __init__(self, policy: FlushPolicy):
+        self.policy = policy
+        self.chunks_in = 0
+        self.flushes_out = 0
+        self._buffer: list[str] = []
+        self._buffered_chars = 0
+        self._total_chars = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def interval(self) -> float:
+        """The current flush interval, which grows with the length of the response."""
+        policy = self.policy
+        ramp = (
+            min(1.0, self._total_chars / policy.ramp_chars) if policy.ramp_chars else 1
+        )
+        return policy.min_interval + (policy.max_interval - policy.min_interval) * ramp
+
+    def add(self, text: str) -> str | None:
+        """Buffer a chunk. Returns the text to write now, if it's time to flush."""
+        self.chunks_in += 1
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+        if (
+            self.flushes_out == 0
+            or self._buffered_chars >= self.policy.max_chars
+            or self.time_to_flush() == 0
+        ):
+            return self.flush()
+        return None
+
+    def time_to_flush(self) -> float | None:
+        """Seconds until the buffer is due to be flushed, or None if it's empty."""
+        if not self._buffer:
+            return None
+        return max(0.0, self._last_flush + self.interval - time.monotonic())
+
+    def flush(self) -> str | None:
+        """Return all buffered text, if any."""
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffered_chars = 0
+        self._total_chars += len(text)
+        self.flushes_out += 1
+        return text
+
+    def report(self):
+        """Record how many chunks were coalesced into how many flushes."""
+        coalesced_chunks_in.inc(self.chunks_in)
+        coalesced_flushes_out.inc(self.flushes_out)
+        logger.debug(
+            f"Coalesced {self.chunks_in} chunks into {self.flushes_out} flushes."
+        )
+
+
+def coalesce(stream: Iterator[str], policy: FlushPolicy) -> Iterator[str]:
+    """Coalesce a stream of text chunks. Buffered text is flushed when the next chunk
+    arrives, so a stalled stream may hold it for up to the gap between chunks."""
+    coalescer = ChunkCoalescer(policy)
+    try:
+        for chunk in stream:
+            text = coalescer.add(chunk)
+            if text:
+                yield text
+        text = coalescer.flush()
+        if text:
+            yield text
+    finally:
+        coalescer.report()
@@ -0,0 +1,157 @@
+"""Compaction of long conversations into rolling summaries.
+
+Once a session's history exceeds a token threshold, the older messages are summarised
+by the model, in the background after a response has finished. The session's
+`HistoryBuilder` then sends the summary in place of those messages, and keeps the
+most recent messages verbatim. Each new summary builds on the previous one."""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from config import logger
+from metrics import counter, span
+from personality import Personality
+
+if TYPE_CHECKING:
+    from history import HistoryBuilder
+
+SUMMARY_MODEL = "gemini-2.5-flash-lite"
+SUMMARY_MAX_TOKENS = 1024
+
+compactions = counter(
+    "rickbot_compactions_total",
+    "Conversations compacted into a summary.",
+    ("personality",),
+)
+
+
+def summary_prompt(
+    personality: Personality, previous_summary: str, messages: list[dict]
+) -> str:
+    """The request to summarise these messages, in the context of this personality."""
+    lines = []
+    for message in messages:
+        speaker = "User" if message["role"] == "user" else personality.name
+        attachment = message.get("attachment")
+        if attachment:
+            lines.append(f"{speaker}: [attached {attachment.mime_type}]")
+        lines.append(f"{speaker}: {message['content']}")
+    previous = (
+        f"Summary of the conversation before this point:\n{previous_summary}\n\n"
+        if previous_summary
+        else ""
+    )
+    return (
+        f"You are summarising a conversation between a user and {personality.name}, "
+        f"a chatbot described as: {personality.overview.strip()}\n\n"
+        f"{previous}Conversation:\n" + "\n".join(lines) + "\n\n"
+        "Write a concise summary of the whole conversation so far, so that "
+        f"{personality.name} can carry on in character. Keep facts, names, decisions, "
+        "the user's preferences and any open questions, and note the tone and any "
+        "running jokes. Describe any attachments briefly. Don't add anything new."
+    )
+
+
+class HistoryCompactor:
+    """Summarises the older messages of sessions whose history exceeds a token threshold.
+    Summaries are built on a small worker pool shared by all sessions, off the hot path.
+    """
+
+    def __init__(
+        self,
+        threshold_tokens: int,
+        keep_messages: int = 6,
+        model: str = SUMMARY_MODEL,
+        max_workers: int = 2,
+    ):
+        """
+        Args:
+            threshold_tokens (int): Estimated history tokens above which we compact.
+            keep_messages (int): How many of the most recent messages are kept verbatim.
+            model (str): The model used to write summaries.
+            max_workers (int): Summaries built concurrently, across all sessions.
+        """
+        self.threshold_tokens = threshold_tokens
+        self.keep_messages = keep_messages
+        self.model = model
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="compaction"
+        )
+        self._running: set[int] = set()  # Builders being compacted
+        self._lock = threading.Lock()
+
+    def maybe_compact(
+        self,
+        client,
+        builder: "HistoryBuilder",
+        chat_history: list[dict],
+        personality: Personality,
+    ) -> Future | None:
+        """Start summarising the older messages, if the history is over the threshold.
+
+        Returns:
+            Future | None: The background job, or None if there's nothing to do.
+        """
+        if builder.tokens <= self.threshold_tokens:
+            return None
+
+        # Keep the recent messages starting with a response, so that turns still
+        # alternate after the summary, which is sent as a user turn
+        covers = len(chat_history) - self.keep_messages
+        while covers > builder.summarised and chat_history[covers]["role"] == "user":
+            covers -= 1
+        if covers <= builder.summarised:
+            return None
+
+        with self._lock:
+            if id(builder) in self._running:
+                return None
+            self._running.add(id(builder))
+
+        return self._executor.submit(
+            self._compact,
+            client,
+            builder,
+            builder.generation,
+            summary_prompt(
+                personality, builder.summary, chat_history[builder.summarised : covers]
+            ),
+            covers,
+            personality,
+        )
+
+    def _compact(
+        self,
+        client,
+        builder: "HistoryBuilder",
+        generation: int,
+        prompt: str,
+        covers: int,
+        personality: Personality,
+    ):
+        from google.genai.types import (  # pylint: disable=import-outside-toplevel
+            GenerateContentConfig,
+        )
+
+        try:
+            with span("history_compaction", personality=personality.name):
+                response = client.models.generate_content(
+                    model=self.model,
+                    contents=prompt,
+                    config=GenerateContentConfig(
+                        temperature=0.2, max_output_tokens=SUMMARY_MAX_TOKENS
+                    ),
+                )
+            if response.text:
+                builder.set_summary(response.text, covers, generation)
+                compactions.inc(personality=personality.name)
+                logger.info(
+                    f"Compacted {covers} messages for {personality.name} "
+                    f"into a {len(response.text)} character summary."
+                )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning(f"Unable to compact conversation history: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(id(builder))
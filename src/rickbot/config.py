@@ -2,6 +2,7 @@
 
 import logging
 import os
+import tempfile
 from pathlib import Path
 from dataclasses import dataclass
 import streamlit as st
@@ -43,7 +44,54 @@ class Config:
     project_id: str
     region: str
     auth_required: bool  # Whether we require logon
-    rate_limit: int  # How many model requests we can make
+    rate_limit: int  # How many model requests we can make per minute, across all users
+    user_rate_limit: str = ""  # Per-user limits, e.g. "10/minute;100/hour"
+    user_token_limit: str = ""  # Per-user token budgets, e.g. "200000/hour;1000000/day"
+    rate_limit_storage_uri: str = "memory://"  # E.g. redis://host:6379 to share limits
+    history_max_tokens: int = 32000  # Token budget for history sent. 0 = no limit
+    # Byte budget for history, inc attachments. 0 = no limit
+    history_max_bytes: int = 16 * 1024 * 1024
+    history_render_window: int = 20  # Messages rendered on each rerun. 0 = all
+    compaction_tokens: int = 0  # Summarise older turns above this. 0 = disabled
+    compaction_keep_messages: int = 6  # Recent messages never summarised
+    # Attachments held per session. 0 = no limit
+    session_memory_max_bytes: int = 8 * 1024 * 1024
+    memory_max_bytes: int = 0  # Held by all sessions and attachments. 0 = no limit
+    # Local directory for the attachment store
+    attachment_dir: str = os.path.join(tempfile.gettempdir(), "rickbot-attachments")
+    secret_cache_ttl: int = 3600  # Seconds to cache secrets read from Secret Manager
+    secret_negative_cache_ttl: int = 60  # Seconds to cache failures to read a secret
+    # Disk cache of system prompts read from Secret Manager
+    prompt_cache_dir: str = os.path.join(tempfile.gettempdir(), "rickbot-prompts")
+    prompt_cache_ttl: int = 3600  # Seconds before a cached prompt is read again
+    attachment_max_bytes: int = 256 * 1024 * 1024  # Evict attachments beyond this size
+    attachment_bucket: str = ""  # Optional GCS bucket to upload attachments to, once
+    preprocess_attachments: bool = True  # Downscale, trim and page-limit uploads
+    image_max_px: int = 1536  # Longest side of uploaded images. 0 = no limit
+    media_max_seconds: int = 0  # Trim uploaded video/audio (needs ffmpeg). 0 = no limit
+    video_max_height: int = 0  # Downscale uploaded videos (needs ffmpeg). 0 = no limit
+    pdf_max_pages: int = 0  # Pages of uploaded PDFs (needs pypdf). 0 = no limit
+    preprocess_workers: int = 2  # Attachments preprocessed concurrently
+    context_cache: bool = False  # Whether to cache system prompts server-side
+    context_cache_ttl: int = 3600  # Seconds
+    generation_concurrency: int = 32  # Max concurrent model streams per instance
+    generation_timeout: float = 300  # Seconds, including waiting for a stream slot
+    generation_min_concurrency: int = 1  # Floor when the model throttles us (429s)
+    generation_queue_size: int = 100  # Requests waiting for a slot. 0 = unbounded
+    generation_max_attempts: int = 3  # Tries per request, before the first chunk
+    generation_hedge_after: float = 0  # Seconds before a hedged request. 0 = never
+    fallback_regions: str = ""  # Comma-separated regions to fail over to, in order
+    stream_flush_min_interval: float = 0.05  # Seconds. 0 = write every chunk
+    stream_flush_max_interval: float = 0.25  # Seconds, for long responses
+    routing_max_chars: int = 0  # Longest prompt for a fast model. 0 = no routing
+    # Max cached responses to opening prompts. 0 = disabled
+    response_cache_size: int = 0
+    response_cache_ttl: int = 3600  # Seconds
+    metrics_port: int = 0  # Port to serve Prometheus metrics on. 0 = disabled
+    api_port: int = 8081  # Port for the headless streaming API, when run with api.py
+    fast_start: bool = False  # Defer model setup to the first message, for cold starts
+    personality_reload_interval: float = 0  # Seconds between checks. 0 = no hot reload
+    panel_max_size: int = 3  # Personalities asked at once in panel mode. 0 = disabled
 
 
 @st.cache_resource
@@ -57,6 +105,60 @@ def get_config() -> Config:
     region = os.environ.get("GOOGLE_CLOUD_REGION")
     auth_required = os.environ.get("AUTH_REQUIRED", "True").lower() == "true"
     limit = int(os.environ.get("RATE_LIMIT", "20"))
+    user_rate_limit = os.environ.get("USER_RATE_LIMIT", "")
+    user_token_limit = os.environ.get("USER_TOKEN_LIMIT", "")
+    rate_limit_storage_uri = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+    history_max_tokens = int(os.environ.get("HISTORY_MAX_TOKENS", "32000"))
+    history_max_bytes = int(os.environ.get("HISTORY_MAX_BYTES", str(16 * 1024 * 1024)))
+    history_render_window = int(os.environ.get("HISTORY_RENDER_WINDOW", "20"))
+    compaction_tokens = int(os.environ.get("COMPACTION_TOKENS", "0"))
+    compaction_keep_messages = int(os.environ.get("COMPACTION_KEEP_MESSAGES", "6"))
+    session_memory_max_bytes = int(
+        os.environ.get("SESSION_MEMORY_MAX_BYTES", str(8 * 1024 * 1024))
+    )
+    memory_max_bytes = int(os.environ.get("MEMORY_MAX_BYTES", "0"))
+    secret_cache_ttl = int(os.environ.get("SECRET_CACHE_TTL", "3600"))
+    secret_negative_cache_ttl = int(os.environ.get("SECRET_NEGATIVE_CACHE_TTL", "60"))
+    prompt_cache_dir = os.environ.get("PROMPT_CACHE_DIR", Config.prompt_cache_dir)
+    prompt_cache_ttl = int(os.environ.get("PROMPT_CACHE_TTL", "3600"))
+    attachment_dir = os.environ.get("ATTACHMENT_DIR", Config.attachment_dir)
+    attachment_max_bytes = int(
+        os.environ.get("ATTACHMENT_MAX_BYTES", str(256 * 1024 * 1024))
+    )
+    attachment_bucket = os.environ.get("ATTACHMENT_BUCKET", "")
+    preprocess_attachments = (
+        os.environ.get("PREPROCESS_ATTACHMENTS", "True").lower() == "true"
+    )
+    image_max_px = int(os.environ.get("IMAGE_MAX_PX", "1536"))
+    media_max_seconds = int(os.environ.get("MEDIA_MAX_SECONDS", "0"))
+    video_max_height = int(os.environ.get("VIDEO_MAX_HEIGHT", "0"))
+    pdf_max_pages = int(os.environ.get("PDF_MAX_PAGES", "0"))
+    preprocess_workers = int(os.environ.get("PREPROCESS_WORKERS", "2"))
+    context_cache = os.environ.get("CONTEXT_CACHE", "False").lower() == "true"
+    context_cache_ttl = int(os.environ.get("CONTEXT_CACHE_TTL", "3600"))
+    generation_concurrency = int(os.environ.get("GENERATION_CONCURRENCY", "32"))
+    generation_timeout = float(os.environ.get("GENERATION_TIMEOUT", "300"))
+    generation_min_concurrency = int(os.environ.get("GENERATION_MIN_CONCURRENCY", "1"))
+    generation_queue_size = int(os.environ.get("GENERATION_QUEUE_SIZE", "100"))
+    generation_max_attempts = int(os.environ.get("GENERATION_MAX_ATTEMPTS", "3"))
+    generation_hedge_after = float(os.environ.get("GENERATION_HEDGE_AFTER", "0"))
+    fallback_regions = os.environ.get("FALLBACK_REGIONS", "")
+    stream_flush_min_interval = float(
+        os.environ.get("STREAM_FLUSH_MIN_INTERVAL", "0.05")
+    )
+    stream_flush_max_interval = float(
+        os.environ.get("STREAM_FLUSH_MAX_INTERVAL", "0.25")
+    )
+    routing_max_chars = int(os.environ.get("ROUTING_MAX_CHARS", "0"))
+    response_cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+    response_cache_ttl = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+    metrics_port = int(os.environ.get("METRICS_PORT", "0"))
+    api_port = int(os.environ.get("API_PORT", "8081"))
+    fast_start = os.environ.get("FAST_START", "False").lower() == "true"
+    personality_reload_interval = float(
+        os.environ.get("PERSONALITY_RELOAD_INTERVAL", "0")
+    )
+    panel_max_size = int(os.environ.get("PANEL_MAX_SIZE", "3"))
 
     if not project_id:
         logger.error("Configuration Error: GOOGLE_CLOUD_PROJECT not set.")
@@ -72,10 +174,112 @@ def get_config() -> Config:
     logger.info(f"Using Google Cloud Region: {region}")
     logger.info(f"Auth required: {auth_required}")
     logger.info(f"Rate limit: {limit}")
+    logger.info(f"Per-user rate limit: {user_rate_limit or 'none'}")
+    logger.info(f"Per-user token budget: {user_token_limit or 'none'}")
+    logger.info(
+        f"History budget: {history_max_tokens} tokens, {history_max_bytes} bytes"
+    )
+    logger.info(
+        f"Compaction: {compaction_tokens or 'disabled'} tokens, "
+        f"keeping {compaction_keep_messages} messages"
+    )
+    logger.info(f"History render window: {history_render_window or 'all'} messages")
+    logger.info(
+        f"Memory caps: {session_memory_max_bytes or 'none'} bytes per session, "
+        f"{memory_max_bytes or 'none'} bytes in total"
+    )
+    logger.info(
+        f"Secret cache TTL: {secret_cache_ttl}s, failures: {secret_negative_cache_ttl}s"
+    )
+    logger.info(
+        f"System prompt disk cache: {prompt_cache_dir}, TTL: {prompt_cache_ttl}s"
+    )
+    logger.info(
+        f"Attachment store: {attachment_dir}, max {attachment_max_bytes} bytes, "
+        f"bucket: {attachment_bucket or 'none'}"
+    )
+    logger.info(
+        f"Preprocess attachments: {preprocess_attachments}, image max {image_max_px}px, "
+        f"media max {media_max_seconds}s, video max {video_max_height}px, "
+        f"PDF max {pdf_max_pages} pages, "
+        f"{preprocess_workers} workers"
+    )
+    logger.info(f"Context cache: {context_cache}, TTL: {context_cache_ttl}s")
+    logger.info(
+        f"Generation concurrency: {generation_concurrency}, timeout: {generation_timeout}s"
+    )
+    logger.info(
+        f"Generation queue: {generation_queue_size or 'unbounded'}, "
+        f"min concurrency: {generation_min_concurrency}"
+    )
+    logger.info(
+        f"Generation attempts: {generation_max_attempts}, "
+        f"hedge after: {generation_hedge_after or 'never'}s, "
+        f"fallback regions: {fallback_regions or 'none'}"
+    )
+    logger.info(
+        f"Stream flush interval: {stream_flush_min_interval}-{stream_flush_max_interval}s"
+    )
+    logger.info(f"Model routing: {routing_max_chars or 'disabled'} chars")
+    logger.info(
+        f"Response cache size: {response_cache_size}, TTL: {response_cache_ttl}s"
+    )
+    logger.info(f"Metrics port: {metrics_port or 'disabled'}")
+    logger.info(f"API port: {api_port}")
+    logger.info(f"Fast start: {fast_start}")
+    logger.info(
+        f"Personality hot reload: "
+        f"{f'every {personality_reload_interval}s' if personality_reload_interval else 'disabled'}"
+    )
+    logger.info(
+        f"Panel mode: {f'up to {panel_max_size}' if panel_max_size > 1 else 'disabled'}"
+    )
 
     return Config(
         project_id=project_id,
         region=region,
         auth_required=auth_required,
         rate_limit=limit,
+        user_rate_limit=user_rate_limit,
+        user_token_limit=user_token_limit,
+        rate_limit_storage_uri=rate_limit_storage_uri,
+        history_max_tokens=history_max_tokens,
+        history_max_bytes=history_max_bytes,
+        history_render_window=history_render_window,
+        compaction_tokens=compaction_tokens,
+        compaction_keep_messages=compaction_keep_messages,
+        session_memory_max_bytes=session_memory_max_bytes,
+        memory_max_bytes=memory_max_bytes,
+        secret_cache_ttl=secret_cache_ttl,
+        secret_negative_cache_ttl=secret_negative_cache_ttl,
+        prompt_cache_dir=prompt_cache_dir,
+        prompt_cache_ttl=prompt_cache_ttl,
+        attachment_dir=attachment_dir,
+        attachment_max_bytes=attachment_max_bytes,
+        attachment_bucket=attachment_bucket,
+        preprocess_attachments=preprocess_attachments,
+        image_max_px=image_max_px,
+        media_max_seconds=media_max_seconds,
+        video_max_height=video_max_height,
+        pdf_max_pages=pdf_max_pages,
+        preprocess_workers=preprocess_workers,
+        context_cache=context_cache,
+        context_cache_ttl=context_cache_ttl,
+        generation_concurrency=generation_concurrency,
+        generation_timeout=generation_timeout,
+        generation_min_concurrency=generation_min_concurrency,
+        generation_queue_size=generation_queue_size,
+        generation_max_attempts=generation_max_attempts,
+        generation_hedge_after=generation_hedge_after,
+        fallback_regions=fallback_regions,
+        stream_flush_min_interval=stream_flush_min_interval,
+        stream_flush_max_interval=stream_flush_max_interval,
+        routing_max_chars=routing_max_chars,
+        response_cache_size=response_cache_size,
+        response_cache_ttl=response_cache_ttl,
+        metrics_port=metrics_port,
+        api_port=api_port,
+        fast_start=fast_start,
+        personality_reload_interval=personality_reload_interval,
+        panel_max_size=panel_max_size,
     )
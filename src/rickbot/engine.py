@@ -0,0 +1,436 @@
+"""An asyncio generation engine, shared by all sessions in the process.
+
+Model streams run on a single event loop in a background thread, using the Gen AI async client,
+rather than as blocking streams in each Streamlit script thread. Each request has a timeout.
+If the consumer goes away (e.g. the user reruns the script or navigates away), the request
+is cancelled. Requests are admitted by an `AdmissionController`: a fair, bounded queue whose
+concurrency limit adapts to throttling by the model. Waiting requests report their position.
+Transient errors before the first chunk are retried, optionally on fallback clients.
+Chunks can be coalesced before they are handed to the consumer, flushing on a timer.
+Several responses to the same history, e.g. from a panel of personalities, can be
+generated concurrently and consumed as one stream of tagged chunks."""
+
+import asyncio
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Iterator
+
+from admission import AdmissionController, QueueCallback
+from coalesce import ChunkCoalescer, FlushPolicy
+from config import logger
+from metrics import gauge, stream_chunks
+from resilience import ClientPool, RetryPolicy, open_stream
+
+_CHUNK, _DONE, _ERROR, _QUEUED, _USAGE = range(5)
+
+UsageCallback = Callable[[Any], None]  # Called with a response's usage metadata
+
+
+@dataclass(frozen=True)
+class StreamRequest:
+    """One of several responses to generate concurrently, from the same history."""
+
+    model: str
+    config: Any  # GenerateContentConfig
+    fallback_config: Any = None  # For fallback clients, e.g. without context caching
+
+
+def chunk_text(chunk) -> str | None:
+    """The text of a streamed response chunk, or None if the chunk has no content."""
+    if (
+        chunk.candidates
+        and chunk.candidates[0].content
+        and chunk.candidates[0].content.parts
+    ):
+        return chunk.text
+    return None
+
+
+def _put_chunk(out, chunk):
+    text = chunk_text(chunk)
+    if text:
+        out.put((_CHUNK, text))
+    if chunk.usage_metadata:  # The last chunk's usage covers the whole response
+        out.put((_USAGE, chunk.usage_metadata))
+
+
+class _LoopQueue:
+    """Hands items put on the engine's loop to an asyncio queue on another event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, item):
+        self._loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+class _TaggedQueue:
+    """Tags the items of one of several concurrent requests with the request's index."""
+
+    def __init__(self, out: queue.Queue, index: int):
+        self._out = out
+        self._index = index
+
+    def put(self, item):
+        self._out.put((self._index, *item))
+
+
+class GenerationEngine:
+    """Runs model streams on a shared event loop, with a global concurrency limit."""
+
+    def __init__(
+        self,
+        max_concurrency: int = 32,
+        timeout_seconds: float = 300,
+        retry_policy: RetryPolicy | None = None,
+        admission: AdmissionController | None = None,
+    ):
+        """
+        Args:
+            max_concurrency (int): Maximum number of concurrent model streams in this process.
+            timeout_seconds (float): Maximum time for a request, including waiting for a slot.
+            retry_policy (RetryPolicy, optional): How requests are retried and hedged.
+            admission (AdmissionController, optional): How requests are queued and admitted.
+                Defaults to a queue with max_concurrency slots.
+        """
+        self.admission = admission or AdmissionController(max_concurrency)
+        self.max_concurrency = self.admission.max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="rickbot-engine", daemon=True
+        )
+        self._thread.start()
+        gauge(
+            "rickbot_engine_active_streams",
+            "Model streams currently running.",
+            function=lambda: self.active,
+        )
+        gauge(
+            "rickbot_engine_waiting_requests",
+            "Requests waiting for a stream slot.",
+            function=lambda: self.waiting,
+        )
+        logger.info(
+            f"Generation engine started. Max concurrency: {self.max_concurrency}"
+        )
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    @property
+    def active(self) -> int:
+        """Number of streams currently running."""
+        return self.admission.active
+
+    @property
+    def waiting(self) -> int:
+        """Number of requests waiting for a slot."""
+        return self.admission.queued
+
+    async def _produce(
+        self,
+        pool: ClientPool,
+        model,
+        contents,
+        config,
+        fallback_config,
+        out: queue.Queue,
+        timeout,
+        user: str,
+        report_queue: bool,
+    ):
+        admission = self.admission
+        queued = False
+
+        def on_queued(status):
+            nonlocal queued
+            queued = True
+            out.put((_QUEUED, status))
+
+        try:
+            async with asyncio.timeout(timeout):
+                await admission.acquire(user, on_queued if report_queue else None)
+                if queued:
+                    out.put((_QUEUED, None))  # Admitted
+                started = time.monotonic()
+                try:
+                    first, stream = await open_stream(
+                        pool,
+                        self.retry_policy,
+                        model,
+                        contents,
+                        config,
+                        fallback_config,
+                        on_error=admission.record_error,
+                    )
+                    admission.record_success()
+                    chunks = 0
+                    if first is not None:
+                        _put_chunk(out, first)
+                        chunks += 1
+                        async for chunk in stream:
+                            _put_chunk(out, chunk)
+                            chunks += 1
+                    stream_chunks.observe(chunks, model=model)
+                finally:
+                    admission.release(time.monotonic() - started)
+            out.put((_DONE, None))
+        except asyncio.CancelledError:
+            logger.debug("Generation cancelled.")
+            raise
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            out.put((_ERROR, e))
+
+    def stream(
+        self,
+        client,
+        model: str,
+        contents,
+        config,
+        timeout: float | None = None,
+        flush_policy: FlushPolicy | None = None,
+        fallback_config=None,
+        user: str = "",
+        on_queued: QueueCallback | None = None,
+        on_usage: UsageCallback | None = None,
+    ) -> Iterator[str]:
+        """Generate a response on the engine's loop, yielding text chunks to the calling thread.
+        Closing the iterator cancels the request.
+
+        Args:
+            client (genai.Client | ClientPool): The client, or clients in order of preference.
+            model (str): The model to use.
+            contents (list[Content]): The conversation history.
+            config (GenerateContentConfig): The configuration for the model.
+            timeout (float, optional): Overrides the engine's request timeout.
+            flush_policy (FlushPolicy, optional): Coalesce chunks, flushing by time and size.
+            fallback_config (GenerateContentConfig, optional): The configuration for
+                fallback clients, e.g. without regional context caching.
+            user (str, optional): Identifies the user, so that users take turns for slots.
+            on_queued (QueueCallback, optional): Called in this thread with the request's
+                queue status while it waits for a slot, and with None once it's admitted.
+            on_usage (UsageCallback, optional): Called in this thread with the response's
+                usage metadata, once the response is complete.
+
+        Yields:
+            str: Response text chunks.
+
+        Raises:
+            TimeoutError: If the request doesn't complete within the timeout.
+            QueueFullError: If too many requests are already waiting.
+        """
+        pool = client if isinstance(client, ClientPool) else ClientPool.single(client)
+        out: queue.Queue = queue.Queue()
+        future = self._run(
+            self._produce(
+                pool,
+                model,
+                contents,
+                config,
+                fallback_config,
+                out,
+                timeout or self.timeout_seconds,
+                user,
+                on_queued is not None,
+            )
+        )
+        coalescer = ChunkCoalescer(flush_policy) if flush_policy else None
+        usage = None
+        try:
+            while True:
+                try:
+                    kind, value = out.get(
+                        timeout=coalescer.time_to_flush() if coalescer else None
+                    )
+                except queue.Empty:  # Buffered text is due, even if the model stalls
+                    assert coalescer
+                    value = coalescer.flush()
+                    if value:
+                        yield value
+                    continue
+
+                if kind == _CHUNK:
+                    value = coalescer.add(value) if coalescer else value
+                    if value:
+                        yield value
+                elif kind == _QUEUED:
+                    if on_queued:
+                        on_queued(value)
+                elif kind == _USAGE:
+                    usage = value
+                elif kind == _ERROR:
+                    raise value
+                else:
+                    value = coalescer.flush() if coalescer else None
+                    if value:
+                        yield value
+                    if on_usage and usage:
+                        on_usage(usage)
+                    return
+        finally:
+            if not future.done():
+                future.cancel()  # E.g. the script was rerun or stopped while streaming
+            if coalescer:
+                coalescer.report()
+
+    async def astream(
+        self,
+        client,
+        model: str,
+        contents,
+        config,
+        timeout: float | None = None,
+        fallback_config=None,
+        user: str = "",
+        on_queued: QueueCallback | None = None,
+        on_usage: UsageCallback | None = None,
+    ) -> AsyncIterator[str]:
+        """Generate a response on the engine's loop, yielding text chunks to the calling
+        event loop, e.g. an async web server's. Closing the iterator cancels the request.
+        Takes the same arguments as `stream`, except that chunks aren't coalesced.
+
+        Raises:
+            TimeoutError: If the request doesn't complete within the timeout.
+            QueueFullError: If too many requests are already waiting.
+        """
+        pool = client if isinstance(client, ClientPool) else ClientPool.single(client)
+        out = _LoopQueue(asyncio.get_running_loop())
+        future = self._run(
+            self._produce(
+                pool,
+                model,
+                contents,
+                config,
+                fallback_config,
+                out,  # type: ignore
+                timeout or self.timeout_seconds,
+                user,
+                on_queued is not None,
+            )
+        )
+        usage = None
+        try:
+            while True:
+                kind, value = await out.queue.get()
+                if kind == _CHUNK:
+                    yield value
+                elif kind == _QUEUED:
+                    if on_queued:
+                        on_queued(value)
+                elif kind == _USAGE:
+                    usage = value
+                elif kind == _ERROR:
+                    raise value
+                else:
+                    if on_usage and usage:
+                        on_usage(usage)
+                    return
+        finally:
+            if not future.done():
+                future.cancel()  # E.g. the client disconnected while streaming
+
+    def fan_out(
+        self,
+        client,
+        contents,
+        requests: list[StreamRequest],
+        timeout: float | None = None,
+        flush_policy: FlushPolicy | None = None,
+        user: str = "",
+        on_queued: QueueCallback | None = None,
+        on_usage: Callable[[int, Any], None] | None = None,
+        on_error: Callable[[int, Exception], None] | None = None,
+    ) -> Iterator[tuple[int, str]]:
+        """Generate several responses to the same contents concurrently, yielding each
+        text chunk with the index of its request, as chunks arrive from any of them.
+        Closing the iterator cancels all the requests.
+
+        Args:
+            client (genai.Client | ClientPool): The client, or clients in order of preference.
+            contents (list[Content]): The conversation history, shared by all requests.
+            requests (list[StreamRequest]): The model and configuration of each response.
+            timeout (float, optional): Overrides the engine's request timeout.
+            flush_policy (FlushPolicy, optional): Coalesce each response's chunks.
+            user (str, optional): Identifies the user, so that users take turns for slots.
+            on_queued (QueueCallback, optional): Called with the queue status of any request
+                that is waiting for a slot, and with None once it's admitted.
+            on_usage (Callable, optional): Called with a request's index and usage metadata,
+                once its response is complete.
+            on_error (Callable, optional): Called with a request's index and error, if it
+                fails. The other responses carry on. If not supplied, the error is raised.
+
+        Yields:
+            tuple[int, str]: The index of the request, and a text chunk of its response.
+        """
+        pool = client if isinstance(client, ClientPool) else ClientPool.single(client)
+        out: queue.Queue = queue.Queue()
+        futures = [
+            self._run(
+                self._produce(
+                    pool,
+                    request.model,
+                    contents,
+                    request.config,
+                    request.fallback_config,
+                    _TaggedQueue(out, index),  # type: ignore
+                    timeout or self.timeout_seconds,
+                    user,
+                    on_queued is not None,
+                )
+            )
+            for index, request in enumerate(requests)
+        ]
+        coalescers = [
+            ChunkCoalescer(flush_policy) if flush_policy else None for _ in requests
+        ]
+        usage: list[Any] = [None] * len(requests)
+        remaining = len(requests)
+        try:
+            while remaining:
+                due = [c.time_to_flush() for c in coalescers if c]
+                due = [seconds for seconds in due if seconds is not None]
+                try:
+                    index, kind, value = out.get(timeout=min(due) if due else None)
+                except queue.Empty:  # Buffered text is due, even if the model stalls
+                    for index, coalescer in enumerate(coalescers):
+                        if coalescer and coalescer.time_to_flush() == 0:
+                            value = coalescer.flush()
+                            if value:
+                                yield index, value
+                    continue
+
+                coalescer = coalescers[index]
+                if kind == _CHUNK:
+                    value = coalescer.add(value) if coalescer else value
+                    if value:
+                        yield index, value
+                elif kind == _QUEUED:
+                    if on_queued:
+                        on_queued(value)
+                elif kind == _USAGE:
+                    usage[index] = value
+                elif kind == _ERROR:
+                    remaining -= 1
+                    if not on_error:
+                        raise value
+                    on_error(index, value)
+                else:
+                    remaining -= 1
+                    value = coalescer.flush() if coalescer else None
+                    if value:
+                        yield index, value
+                    if on_usage and usage[index]:
+                        on_usage(index, usage[index])
+        finally:
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+            for coalescer in coalescers:
+                if coalescer:
+                    coalescer.report()
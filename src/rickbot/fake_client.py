@@ -0,0 +1,181 @@
+"""A deterministic fake of the Gen AI client, for benchmarks and local development
+without calling Vertex AI.
+
+Responses are streamed as real `GenerateContentResponse` chunks, with configurable
+latency to the first chunk, latency between chunks, and chunk sizes.
+Failures can be injected, to exercise retries and failover."""
+
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from itertools import count
+
+from google.genai.errors import ClientError, ServerError
+from google.genai.types import (
+    CachedContent,
+    Candidate,
+    Content,
+    CountTokensResponse,
+    GenerateContentResponse,
+    GenerateContentResponseUsageMetadata,
+    Part,
+)
+
+from history import estimate_tokens
+
+WORDS = (
+    "wubba lubba dub dub morty listen science portal gun schwifty plumbus "
+    "dimension multiverse burp citadel council ricks genius universe"
+).split()
+
+
+@dataclass
+class FakeStreamSettings:
+    """How the fake model responds."""
+
+    first_chunk_latency: float = 0.3  # Seconds before the first chunk
+    chunk_latency: float = 0.02  # Seconds between chunks
+    chunk_count: int = 50
+    chunk_chars: int = 20  # Approximate characters per chunk
+    seed: int = 42
+    failures: int = 0  # Requests that fail before any succeed
+    failure_rate: float = 0.0  # Chance that any later request fails
+    failure_code: int = 503  # E.g. 429 or 503
+
+
+def make_chunk(text: str, usage=None) -> GenerateContentResponse:
+    """A response chunk containing this text."""
+    return GenerateContentResponse(
+        candidates=[Candidate(content=Content(role="model", parts=[Part(text=text)]))],
+        usage_metadata=usage,
+    )
+
+
+def fake_texts(settings: FakeStreamSettings) -> list[str]:
+    """The deterministic text chunks of a fake response."""
+    rng = random.Random(settings.seed)
+    texts = []
+    for _ in range(settings.chunk_count):
+        text = ""
+        while len(text) < settings.chunk_chars:
+            text += rng.choice(WORDS) + " "
+        texts.append(text)
+    return texts
+
+
+class _FakeModels:
+    def __init__(self, client: "FakeGenaiClient"):
+        self._client = client
+
+    def _chunks(self, contents, config) -> list[GenerateContentResponse]:
+        self._client.requests += 1
+        self._client.maybe_fail()
+        texts = fake_texts(self._client.settings)
+        prompt_tokens = sum(
+            estimate_tokens(part.text or "")
+            for content in contents or []
+            for part in content.parts or []
+        )
+        system_parts = getattr(config, "system_instruction", None) or []
+        system_tokens = sum(estimate_tokens(part.text or "") for part in system_parts)
+        cached_tokens = 0
+        if getattr(config, "cached_content", None):  # Stands in for the system prompt
+            cached_tokens = system_tokens = 2048
+        prompt_tokens += system_tokens
+        usage = GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens or None,
+            candidates_token_count=estimate_tokens("".join(texts)),
+            total_token_count=prompt_tokens + estimate_tokens("".join(texts)),
+        )
+        return [
+            make_chunk(text, usage if i == len(texts) - 1 else None)
+            for i, text in enumerate(texts)
+        ]
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        settings = self._client.settings
+        chunks = self._chunks(contents, config)
+        time.sleep(settings.first_chunk_latency)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(settings.chunk_latency)
+            yield chunk
+
+    def generate_content(self, *, model, contents, config=None):
+        """The whole response as one chunk, after the first chunk latency."""
+        if isinstance(contents, str):
+            contents = [Content(role="user", parts=[Part(text=contents)])]
+        chunks = self._chunks(contents, config)
+        time.sleep(self._client.settings.first_chunk_latency)
+        return make_chunk(
+            "".join(chunk.text or "" for chunk in chunks), chunks[-1].usage_metadata
+        )
+
+    def count_tokens(self, *, model, contents, config=None):
+        text = contents if isinstance(contents, str) else str(contents)
+        return CountTokensResponse(total_tokens=estimate_tokens(text))
+
+
+class _FakeAsyncModels(_FakeModels):
+    async def generate_content_stream(self, *, model, contents, config=None):
+        settings = self._client.settings
+        chunks = self._chunks(contents, config)
+
+        async def stream():
+            await asyncio.sleep(settings.first_chunk_latency)
+            for i, chunk in enumerate(chunks):
+                if i:
+                    await asyncio.sleep(settings.chunk_latency)
+                yield chunk
+
+        return stream()
+
+
+class _FakeCaches:
+    def __init__(self):
+        self._ids = count(1)
+
+    def create(self, *, model, config=None):
+        return CachedContent(name=f"cachedContents/{next(self._ids)}", model=model)
+
+    def update(self, *, name, config=None):
+        return CachedContent(name=name)
+
+
+class _FakeAio:
+    def __init__(self, client: "FakeGenaiClient"):
+        self.models = _FakeAsyncModels(client)
+
+
+@dataclass
+class FakeGenaiClient:
+    """Stands in for `genai.Client`, with the sync and async streaming APIs."""
+
+    settings: FakeStreamSettings = field(default_factory=FakeStreamSettings)
+    requests: int = 0  # Number of generation requests made, including failures
+
+    def __post_init__(self):
+        self._rng = random.Random(self.settings.seed)
+        self.models = _FakeModels(self)
+        self.aio = _FakeAio(self)
+        self.caches = _FakeCaches()
+
+    def maybe_fail(self):
+        """Raise the configured error, if this request should fail."""
+        settings = self.settings
+        if (
+            self.requests <= settings.failures
+            or self._rng.random() < settings.failure_rate
+        ):
+            error = ServerError if settings.failure_code >= 500 else ClientError
+            raise error(
+                settings.failure_code,
+                {
+                    "error": {
+                        "code": settings.failure_code,
+                        "message": "Injected failure",
+                    }
+                },
+            )
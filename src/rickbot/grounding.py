@@ -0,0 +1,43 @@
+"""Whether to ground a response with Google Search.
+
+Each personality has a grounding policy: "always", "never", or "auto".
+With "auto", a cheap local heuristic decides per prompt, so that prompts which don't
+need fresh facts (e.g. "insult me, Rick") don't pay the latency and cost of search."""
+
+import re
+
+from config import logger
+from metrics import counter
+from personality import Personality
+
+# Prompts that ask about current events, or facts that change, or that mention a URL
+NEEDS_SEARCH_PATTERN = re.compile(
+    r"https?://|www\.|\b(latest|today|tonight|tomorrow|yesterday|news|current(ly)?|"
+    r"recent(ly)?|this (week|month|year)|right now|price|cost|weather|forecast|"
+    r"score|results?|who (is|was|won)|when (is|was|does|did)|where is|release[ds]?|"
+    r"version|stock|election|search|look up|google|according to|20[0-9]{2})\b",
+    re.IGNORECASE,
+)
+
+grounding_decisions = counter(
+    "rickbot_grounding_decisions_total",
+    "Whether responses were grounded with Google Search.",
+    ("personality", "grounded"),
+)
+
+
+def default_grounding(personality: Personality) -> bool:
+    """Whether responses are grounded when we know nothing about the prompt."""
+    return personality.grounding != "never"
+
+
+def should_ground(personality: Personality, prompt: str) -> bool:
+    """Whether to ground the response to this prompt, according to the personality's policy."""
+    if personality.grounding == "auto":
+        grounded = NEEDS_SEARCH_PATTERN.search(prompt) is not None
+    else:
+        grounded = personality.grounding == "always"
+
+    grounding_decisions.inc(personality=personality.name, grounded=str(grounded))
+    logger.debug(f"Grounding for {personality.name}: {grounded}")
+    return grounded
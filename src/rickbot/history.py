@@ -0,0 +1,383 @@
+"""Incremental, budgeted conversion of the chat history into Gemini `Content` objects.
+
+Rather than rebuilding every `Content`/`Part` for the whole conversation on every turn,
+a `HistoryBuilder` is kept per session. It converts only messages it hasn't seen before,
+and trims the oldest attachments and turns once the history exceeds its budget.
+The oldest turns can also be replaced by a summary, built elsewhere.
+To limit memory, the attachment bytes of cached turns can be spilled, in which case
+they're read back from the attachment store whenever they're sent."""
+
+import threading
+from dataclasses import dataclass
+from google.genai.types import Content, Part
+
+from attachments import AttachmentRef, AttachmentStore
+from config import logger
+
+CHARS_PER_TOKEN = 4  # Rough estimate, good enough for budgeting
+# Nominal token cost of an attachment (Gemini's cost for one image)
+ATTACHMENT_TOKENS = 258
+SUMMARY_PREFIX = "Summary of our conversation so far:\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap estimate of the number of tokens in a piece of text."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def to_model_role(role: str) -> str:
+    """Map a Streamlit chat role to a Gemini role."""
+    return "model" if role == "assistant" else role
+
+
+@dataclass
+class _Turn:
+    """A message that has already been converted to a `Content`."""
+
+    message: dict  # The source message, used to detect when the history is replaced
+    content: Content
+    text_bytes: int
+    text_tokens: int
+    attachment_bytes: int = 0
+    index: int = 0  # Position of the message in the chat history
+    spilled: AttachmentRef | None = None  # Attachment read from the store when sent
+
+    @property
+    def has_attachment(self) -> bool:
+        assert self.content.parts
+        return len(self.content.parts) > 1 or self.spilled is not None
+
+    @property
+    def held_bytes(self) -> int:
+        """Attachment bytes held in memory by this turn."""
+        return 0 if self.spilled else self.attachment_bytes
+
+    @property
+    def size_bytes(self) -> int:
+        return self.text_bytes + self.attachment_bytes
+
+    @property
+    def tokens(self) -> int:
+        return self.text_tokens + (ATTACHMENT_TOKENS if self.has_attachment else 0)
+
+    def strip_attachment(self):
+        """Drop the attachment, keeping only the text part."""
+        assert self.content.parts
+        self.content = Content(role=self.content.role, parts=self.content.parts[:1])
+        self.attachment_bytes = 0
+        self.spilled = None
+
+    def spill(self) -> int:
+        """Release the inline attachment bytes, to be read from the store when next sent.
+
+        Returns:
+            int: The bytes released.
+        """
+        held = self.held_bytes
+        if held:
+            assert self.content.parts
+            self.spilled = self.message["attachment"]
+            self.content = Content(role=self.content.role, parts=self.content.parts[:1])
+        return held
+
+    def load(self, store: AttachmentStore | None) -> Content | None:
+        """The content to send, with any spilled attachment read back from the store.
+        None if the spilled attachment has since been evicted from the store."""
+        if not self.spilled:
+            return self.content
+        assert self.content.parts
+        part, _ = attachment_to_part(self.spilled, store)
+        if part is None:
+            return None
+        return Content(role=self.content.role, parts=[self.content.parts[0], part])
+
+
+def attachment_to_part(
+    ref: AttachmentRef, store: AttachmentStore | None
+) -> tuple[Part | None, int]:
+    """Convert an attachment to a `Part`, preferring its remote URI over inline bytes.
+
+    Returns:
+        tuple[Part | None, int]: The part, or None if the attachment is no longer available,
+            and the number of bytes it adds to the request.
+    """
+    if ref.remote_uri:
+        return Part.from_uri(file_uri=ref.remote_uri, mime_type=ref.mime_type), 0
+
+    data = store.get(ref) if store else None
+    if data is None:
+        logger.warning(
+            f"Attachment {ref.digest[:12]} is no longer available. Sending text only."
+        )
+        return None, 0
+    return Part.from_bytes(data=data, mime_type=ref.mime_type), len(data)
+
+
+def message_to_turn(
+    message: dict, store: AttachmentStore | None = None
+) -> _Turn | None:
+    """Convert a single chat message to a `_Turn`, or None if the role isn't sent to the model."""
+    role = to_model_role(message["role"])
+    if role not in ("user", "model"):  # Skip any roles that are not 'user' or 'model'
+        return None
+
+    text = message["content"]
+    parts = [Part.from_text(text=text)]
+    attachment_bytes = 0
+
+    # If there's an attachment, add it as a data part
+    if "attachment" in message and message["attachment"]:
+        part, attachment_bytes = attachment_to_part(message["attachment"], store)
+        if part:
+            parts.append(part)
+
+    return _Turn(
+        message=message,
+        content=Content(role=role, parts=parts),
+        text_bytes=len(text.encode("utf-8")),
+        text_tokens=estimate_tokens(text),
+        attachment_bytes=attachment_bytes,
+    )
+
+
+class HistoryBuilder:
+    """Builds the `contents` for a model request from the chat history of one session.
+
+    Messages are converted once and cached. When the history exceeds the token or byte budget,
+    attachments are stripped from the oldest turns first, then the oldest turns are dropped.
+    The latest turn is always sent. Trimming is permanent, since history only ever grows.
+
+    A summary of the oldest messages can be set with `set_summary`, from any thread.
+    From the next build, it is sent in place of the messages it covers.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 0,
+        max_bytes: int = 0,
+        attachment_store: AttachmentStore | None = None,
+    ):
+        """
+        Args:
+            max_tokens (int): Estimated token budget for the history. 0 means unlimited.
+            max_bytes (int): Byte budget for text and inline attachments. 0 means unlimited.
+            attachment_store (AttachmentStore, optional): Where attachment bytes are held.
+        """
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.attachment_store = attachment_store
+        self._generation = 0  # Incremented whenever the history is replaced
+        self._lock = threading.Lock()
+        self._pending_summary: tuple[int, str, int] | None = None
+        self._build_lock = threading.Lock()  # Builds and spills
+        self.reset()
+
+    def reset(self):
+        """Forget all cached turns."""
+        self._turns: list[_Turn] = []
+        self._seen = 0  # How many messages of the chat history have been processed
+        self._last_message: dict | None = None
+        self._start = 0  # Index of the oldest turn still sent to the model
+        # Turns before this index have had their attachments stripped
+        self._stripped = 0
+        self._tokens = 0  # Totals across turns[_start:], and the summary
+        self._bytes = 0
+        self._summary: _Turn | None = None
+        self._summarised = 0  # Messages of the chat history covered by the summary
+        self._generation += 1
+
+    @property
+    def tokens(self) -> int:
+        """Estimated tokens in the current history."""
+        return self._tokens
+
+    @property
+    def size_bytes(self) -> int:
+        """Bytes of text and attachments in the current history."""
+        return self._bytes
+
+    @property
+    def held_bytes(self) -> int:
+        """Attachment bytes held in memory by the cached turns."""
+        return sum(turn.held_bytes for turn in self._turns)
+
+    def spill(self, max_held_bytes: int = 0) -> int:
+        """Release the attachment bytes of the oldest turns, until no more than
+        `max_held_bytes` are held. Spilled attachments are still sent, read back from
+        the attachment store, unless they've since been evicted from it.
+        Safe to call from any thread.
+
+        Returns:
+            int: The bytes released.
+        """
+        if self.attachment_store is None:  # Nowhere to read them back from
+            return 0
+        released = 0
+        with self._build_lock:
+            held = self.held_bytes
+            for turn in self._turns:
+                if held <= max_held_bytes:
+                    break
+                freed = turn.spill()
+                held -= freed
+                released += freed
+        if released:
+            logger.debug(f"Spilled {released} bytes of attachments.")
+        return released
+
+    @property
+    def summary(self) -> str:
+        """The summary of the oldest messages, if any."""
+        if not self._summary:
+            return ""
+        assert self._summary.content.parts
+        return (self._summary.content.parts[0].text or "")[len(SUMMARY_PREFIX) :]
+
+    @property
+    def summarised(self) -> int:
+        """How many messages of the chat history are covered by the summary."""
+        return self._summarised
+
+    @property
+    def generation(self) -> int:
+        """Identifies the current history. Changes when the chat history is replaced."""
+        return self._generation
+
+    def set_summary(self, summary: str, covers: int, generation: int):
+        """Replace the first `covers` messages of the chat history with a summary,
+        from the next build. Ignored if the history has been replaced since `generation`.
+        """
+        with self._lock:
+            self._pending_summary = (generation, summary, covers)
+
+    def _apply_summary(self):
+        with self._lock:
+            pending, self._pending_summary = self._pending_summary, None
+        if not pending:
+            return
+        generation, summary, covers = pending
+        if generation != self._generation or not (
+            self._summarised < covers <= self._seen
+        ):
+            return
+
+        if self._summary:
+            self._remove(self._summary)
+        self._summary = message_to_turn(
+            {"role": "user", "content": SUMMARY_PREFIX + summary}
+        )
+        assert self._summary
+        self._add(self._summary)
+
+        covered = sum(1 for turn in self._turns if turn.index < covers)
+        for turn in self._turns[:covered]:
+            self._remove(turn)
+        del self._turns[:covered]
+        self._stripped = max(0, self._stripped - covered)
+        self._summarised = covers
+        logger.debug(
+            f"Summarised {covers} messages. History is now ~{self._tokens} tokens."
+        )
+
+    def _is_continuation(self, chat_history: list[dict]) -> bool:
+        """Whether chat_history extends the history we've already processed."""
+        if len(chat_history) < self._seen:
+            return False
+        if self._seen == 0:
+            return True
+        return chat_history[self._seen - 1] is self._last_message
+
+    def _over_budget(self) -> bool:
+        return (self.max_tokens > 0 and self._tokens > self.max_tokens) or (
+            self.max_bytes > 0 and self._bytes > self.max_bytes
+        )
+
+    def _remove(self, turn: _Turn):
+        self._tokens -= turn.tokens
+        self._bytes -= turn.size_bytes
+
+    def _add(self, turn: _Turn):
+        self._tokens += turn.tokens
+        self._bytes += turn.size_bytes
+
+    def _enforce_budget(self):
+        last = len(self._turns) - 1
+        while self._over_budget() and self._start < last:
+            # First strip attachments from the oldest turns...
+            self._stripped = max(self._stripped, self._start)
+            while (
+                self._stripped < last and not self._turns[self._stripped].has_attachment
+            ):
+                self._stripped += 1
+            if self._stripped < last:
+                turn = self._turns[self._stripped]
+                self._remove(turn)
+                turn.strip_attachment()
+                self._add(turn)
+                continue
+
+            # ... then drop the oldest turns
+            self._remove(self._turns[self._start])
+            self._start += 1
+
+        # The history must start with a user turn, unless it starts with the summary
+        while (
+            not self._summary
+            and self._start < last
+            and self._turns[self._start].content.role != "user"
+        ):
+            self._remove(self._turns[self._start])
+            self._start += 1
+
+        # Release turns that will never be sent again
+        if self._start:
+            del self._turns[: self._start]
+            self._stripped = max(0, self._stripped - self._start)
+            self._start = 0
+
+        if self._over_budget():
+            logger.warning(
+                f"Latest turn alone exceeds the history budget: ~{self._tokens} tokens, {self._bytes} bytes."
+            )
+
+    def build(self, chat_history: list[dict]) -> list[Content]:
+        """Return the contents to send to the model for this chat history.
+
+        Args:
+            chat_history (list[dict]): The session's messages, where each
+                message is a dict with "role" and "content" keys, and an optional "attachment".
+
+        Returns:
+            list[Content]: The trimmed history, oldest first.
+        """
+        with self._build_lock:
+            return self._build(chat_history)
+
+    def _build(self, chat_history: list[dict]) -> list[Content]:
+        if not self._is_continuation(chat_history):
+            logger.debug("Chat history replaced. Rebuilding history.")
+            self.reset()
+        self._apply_summary()
+
+        for index in range(self._seen, len(chat_history)):
+            turn = message_to_turn(chat_history[index], self.attachment_store)
+            if turn:
+                turn.index = index
+                self._turns.append(turn)
+                self._add(turn)
+
+        if len(chat_history) > self._seen:
+            self._seen = len(chat_history)
+            self._last_message = chat_history[-1]
+            self._enforce_budget()
+
+        contents = [self._summary.content] if self._summary else []
+        for turn in self._turns[self._start :]:
+            content = turn.load(self.attachment_store)
+            if content is None:  # A spilled attachment that is no longer available
+                self._remove(turn)
+                turn.strip_attachment()
+                self._add(turn)
+                content = turn.content
+            contents.append(content)
+        return contents
@@ -0,0 +1,175 @@
+"""Hot reloading of personalities and their local system prompts, without a restart.
+
+The modification times of personalities.yaml and the local prompt files are checked
+periodically. When they change, only the personalities whose definition or prompt changed
+are rebuilt, and their prompts are loaded, before they're swapped into the registry
+all at once. If a changed personality can't be loaded, the old one is kept.
+Anything cached for a reloaded personality is then invalidated by callbacks.
+
+Requests already in progress keep the personality and model configuration they started with.
+Prompts held in Secret Manager are refreshed by the prompt disk cache's TTL instead."""
+
+import itertools
+import threading
+from pathlib import Path
+from typing import Callable
+
+from bundle import PERSONALITIES_FILE, SYSTEM_PROMPTS_DIR, source_mtimes
+from config import logger
+from metrics import counter
+from personality import (
+    Personality,
+    PersonalityRegistry,
+    load_personalities,
+    load_system_prompt,
+)
+
+personality_reloads = counter(
+    "rickbot_personality_reloads_total",
+    "Personalities rebuilt or removed because their definition or prompt changed.",
+    ("personality",),
+)
+
+ReloadCallback = Callable[[list[str]], None]  # Called with the names that changed
+
+_revisions = itertools.count(1)  # Never reused, so stale cache keys are never hit
+
+
+class PersonalityReloader:
+    """Reloads changed personalities into a registry, checking in a background thread."""
+
+    def __init__(
+        self,
+        registry: PersonalityRegistry,
+        yaml_file: Path = PERSONALITIES_FILE,
+        prompts_dir: Path = SYSTEM_PROMPTS_DIR,
+        interval: float = 5.0,
+    ):
+        """
+        Args:
+            registry (PersonalityRegistry): The personalities to keep up to date.
+            yaml_file (Path): The personalities file.
+            prompts_dir (Path): The directory of local system prompts.
+            interval (float): Seconds between checks for changes.
+        """
+        self.registry = registry
+        self.yaml_file = yaml_file
+        self.prompts_dir = prompts_dir
+        self.interval = interval
+        self._mtimes: dict[str, int] = {}
+        self._mtimes = self._source_mtimes()
+        self._callbacks: list[ReloadCallback] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _source_mtimes(self) -> dict[str, int]:
+        try:
+            return source_mtimes(self.yaml_file, self.prompts_dir)
+        except OSError as e:
+            logger.warning(f"Unable to check personalities for changes: {e}")
+            return self._mtimes
+
+    def on_reload(self, callback: ReloadCallback):
+        """Call this with the names of changed personalities, after each reload."""
+        self._callbacks.append(callback)
+
+    def check(self) -> list[str]:
+        """Reload the personalities, if their sources have changed.
+
+        Returns:
+            list[str]: The names of personalities that were rebuilt, added or removed.
+        """
+        with self._lock:
+            mtimes = self._source_mtimes()
+            if mtimes == self._mtimes:
+                return []
+            changed_files = {
+                name
+                for name in mtimes.keys() | self._mtimes.keys()
+                if mtimes.get(name) != self._mtimes.get(name)
+            }
+            self._mtimes = mtimes  # Don't retry a broken file until it changes again
+            changed = self._reload(
+                self.yaml_file.name in changed_files,
+                {Path(name).stem for name in changed_files if name.endswith(".txt")},
+            )
+
+        if changed:
+            logger.info(f"Reloaded personalities: {', '.join(changed)}")
+            for callback in self._callbacks:
+                try:
+                    callback(changed)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    logger.error(f"Unable to invalidate reloaded personalities: {e}")
+        return changed
+
+    def _reload(
+        self, definitions_changed: bool, prompts_changed: set[str]
+    ) -> list[str]:
+        current = self.registry.snapshot()
+        if definitions_changed:
+            try:
+                definitions = load_personalities(str(self.yaml_file))
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error(f"Unable to reload {self.yaml_file.name}. Keeping it. {e}")
+                return []
+        else:
+            definitions = current
+
+        peeps: dict[str, Personality] = {}
+        changed = []
+        for name, personality in definitions.items():
+            old = current.get(name)
+            if (
+                old
+                and old.definition == personality.definition
+                and name.lower() not in prompts_changed
+            ):
+                peeps[name] = old  # Unchanged, so keep its loaded prompt and caches
+                continue
+
+            fresh = Personality(**personality.definition)
+            fresh.revision = next(_revisions)
+            try:
+                # Load the prompt now, rather than on a user's request
+                # pylint: disable=protected-access
+                fresh._system_instruction = load_system_prompt(name, self.prompts_dir)
+            except ValueError as e:
+                logger.error(f"Unable to reload {name}. Keeping the old version. {e}")
+                if old:
+                    peeps[name] = old
+                continue
+            peeps[name] = fresh
+            changed.append(name)
+
+        removed = [name for name in current if name not in peeps]
+        if not peeps:
+            logger.error("No personalities left after reloading. Keeping them all.")
+            return []
+        self.registry.replace(peeps)
+        for name in changed + removed:
+            personality_reloads.inc(personality=name)
+        return changed + removed
+
+    def start(self):
+        """Check for changes every interval, in a background thread."""
+        if self._thread:
+            return
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.check()
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    logger.error(f"Personality reload failed: {e}")
+
+        self._thread = threading.Thread(
+            target=run, name="rickbot-personality-reload", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Checking for personality changes every {self.interval}s")
+
+    def stop(self):
+        """Stop checking for changes."""
+        self._stop.set()
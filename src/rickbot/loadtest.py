@@ -0,0 +1,364 @@
+"""Load test of concurrent chat sessions, against a fake streaming Gemini client.
+
+Each simulated session follows the app's own flow for every message: the rate limit check,
+the rerun that renders the chat history, building the model history, streaming the response
+through the shared generation engine, and accounting for the session's memory.
+Sessions run in their own threads, as Streamlit script runs do, and think between messages.
+
+The load is ramped up in stages of increasing concurrent sessions. For each stage we report
+throughput, time to first token and response latency percentiles, the error rate,
+and the CPU and memory used by this process, so that Cloud Run's concurrency setting
+can be chosen from measurements. Results are written as JSON.
+
+Run from the src/rickbot directory:
+    python loadtest.py --sessions 1,10,25,50,100 --stage-seconds 30 --output loadtest.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from benchmark import git_revision, summarise  # Also fakes the Secret Manager backend
+
+# pylint: disable=wrong-import-position
+from admission import AdmissionController
+from agent import get_rick_bot_response, initialise_model_config
+from attachments import AttachmentStore
+from coalesce import FlushPolicy
+from config import logger
+from engine import GenerationEngine
+from fake_client import FakeGenaiClient, FakeStreamSettings
+from history import HistoryBuilder
+from memory import MemoryAccountant, process_resident_bytes
+from personality import personalities
+from rate_limit import RateLimiter
+
+
+@dataclass
+class LoadSettings:
+    """The shape of the load."""
+
+    stages: list[int]  # Concurrent sessions in each stage
+    stage_seconds: float = 30.0
+    think_seconds: float = 2.0  # Mean pause between a response and the next message
+    turns: int = 10  # Messages per session, before it is replaced by a new session
+    render: bool = True  # Render the chat history on each message, as reruns do
+    render_window: int = 20  # Messages rendered. 0 = all
+    personality: str = "Rick"
+    seed: int = 42
+
+
+@dataclass
+class Sample:
+    """The outcome of one message."""
+
+    stage: int
+    started: float
+    ttft: float | None = None
+    latency: float | None = None
+    chars: int = 0
+    queued: bool = False
+    error: str = ""  # The error type, if the response failed
+
+
+class LoadTest:
+    """Runs simulated sessions against a shared engine, adding sessions stage by stage."""
+
+    def __init__(
+        self,
+        settings: LoadSettings,
+        client: FakeGenaiClient,
+        engine: GenerationEngine,
+        rate_limiter: RateLimiter,
+        attachment_store: AttachmentStore,
+        memory: MemoryAccountant,
+        flush_policy: FlushPolicy | None,
+    ):
+        self.settings = settings
+        self.client = client
+        self.engine = engine
+        self.rate_limiter = rate_limiter
+        self.attachment_store = attachment_store
+        self.memory = memory
+        self.flush_policy = flush_policy
+        self.personality = personalities[settings.personality]
+        self.model_config = initialise_model_config(self.personality)
+        self.samples: list[Sample] = []
+        self.stage = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _render(self, messages: list[dict]):
+        # pylint: disable=import-outside-toplevel
+        from chat import render_history
+
+        render_history(
+            messages,
+            self.personality,
+            self.attachment_store,
+            self.settings.render_window,
+        )
+
+    def _message(self, session_id: str, messages: list[dict], builder) -> Sample:
+        """Send one message and read the whole response, as `get_rick_response` does."""
+        sample = Sample(stage=self.stage, started=time.perf_counter())
+        identity = f"session:{session_id}"
+        if not self.rate_limiter.hit(identity):
+            sample.error = "RateLimited"
+            return sample
+
+        messages.append({"role": "user", "content": f"Question {len(messages)}?"})
+        if self.settings.render:
+            self._render(messages)
+
+        def on_queued(status):
+            sample.queued = sample.queued or status is not None
+
+        response = ""
+        try:
+            for text in get_rick_bot_response(
+                self.client,
+                messages,
+                self.model_config,
+                history_builder=builder,
+                engine=self.engine,
+                personality_name=self.personality.name,
+                flush_policy=self.flush_policy,
+                user=identity,
+                on_queued=on_queued,
+            ):
+                if sample.ttft is None:
+                    sample.ttft = time.perf_counter() - sample.started
+                response += text
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            cause = e.__cause__ or e
+            sample.error = type(cause).__name__
+            return sample
+
+        sample.latency = time.perf_counter() - sample.started
+        sample.chars = len(response)
+        messages.append({"role": "assistant", "content": response})
+        self.memory.update(session_id, messages, builder)
+        return sample
+
+    def _session(self, index: int):
+        rng = random.Random(self.settings.seed + index)
+        generation = 0
+        while not self._stop.is_set():
+            session_id = f"load-{index}-{generation}"
+            messages: list[dict] = []
+            builder = HistoryBuilder(attachment_store=self.attachment_store)
+            for _ in range(self.settings.turns):
+                sample = self._message(session_id, messages, builder)
+                with self._lock:
+                    self.samples.append(sample)
+                think = self.settings.think_seconds
+                if self._stop.wait(rng.expovariate(1 / think) if think else 0):
+                    return
+            generation += 1  # A new chatter takes over the session slot
+
+    def run(self) -> list[dict]:
+        """Ramp up the load, stage by stage, and report each stage."""
+        if self.settings.render:
+            self._render([])  # Import and warm up the chat page outside the timings
+
+        threads: list[threading.Thread] = []
+        results = []
+        try:
+            for stage, sessions in enumerate(self.settings.stages):
+                self.stage = stage
+                while len(threads) < sessions:
+                    thread = threading.Thread(
+                        target=self._session,
+                        args=(len(threads),),
+                        name=f"rickbot-load-{len(threads)}",
+                        daemon=True,
+                    )
+                    thread.start()
+                    threads.append(thread)
+                results.append(self._measure_stage(stage, sessions))
+                logger.info(f"Stage {stage}: {_stage_summary(results[-1])}")
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join(timeout=self.engine.timeout_seconds)
+        return results
+
+    def _measure_stage(self, stage: int, sessions: int) -> dict:
+        """Sample CPU and memory while the stage runs, then summarise its messages."""
+        started, cpu_started = time.perf_counter(), time.process_time()
+        peak_rss = process_resident_bytes()
+        while time.perf_counter() - started < self.settings.stage_seconds:
+            time.sleep(0.25)
+            peak_rss = max(peak_rss, process_resident_bytes())
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+
+        with self._lock:
+            samples = [s for s in self.samples if s.stage == stage]
+        done = [s for s in samples if not s.error]
+        errors: dict[str, int] = {}
+        for s in samples:
+            if s.error:
+                errors[s.error] = errors.get(s.error, 0) + 1
+        usage = self.memory.usage()
+        return {
+            "name": "load_stage",
+            "params": {"stage": stage, "sessions": sessions, "seconds": wall},
+            "metrics": {
+                "messages": len(samples),
+                "responses_per_s": len(done) / wall,
+                "chars_per_s": sum(s.chars for s in done) / wall,
+                "ttft": summarise([s.ttft for s in done if s.ttft is not None] or [0]),
+                "latency": summarise([s.latency for s in done if s.latency] or [0]),
+                "error_rate": (
+                    (len(samples) - len(done)) / len(samples) if samples else 0
+                ),
+                "errors": errors,
+                "queued_rate": (
+                    sum(s.queued for s in samples) / len(samples) if samples else 0
+                ),
+                "admission_limit": self.engine.admission.limit,
+                "cpu_cores": cpu / wall,  # CPU seconds per second, across all threads
+                "cpu_ms_per_response": cpu / len(done) * 1000 if done else None,
+                "peak_rss_bytes": peak_rss,
+                "session_bytes": usage.text_bytes + usage.attachment_bytes,
+            },
+        }
+
+
+def _stage_summary(result: dict) -> str:
+    m = result["metrics"]
+    return (
+        f"{result['params']['sessions']} sessions, "
+        f"{m['responses_per_s']:.1f} responses/s, "
+        f"TTFT p50 {m['ttft']['p50_ms']:.0f}ms p99 {m['ttft']['p99_ms']:.0f}ms, "
+        f"latency p99 {m['latency']['p99_ms']:.0f}ms, "
+        f"errors {m['error_rate']:.1%}, CPU {m['cpu_cores']:.2f} cores, "
+        f"RSS {m['peak_rss_bytes'] / 2**20:.0f} MiB"
+    )
+
+
+def max_sessions(results: list[dict], ttft_p99_ms: float, error_rate: float) -> int:
+    """The most concurrent sessions for which all stages up to it met the objectives,
+    e.g. to set Cloud Run's concurrency. 0 if none did."""
+    best = 0
+    for result in results:
+        m = result["metrics"]
+        if m["ttft"]["p99_ms"] > ttft_p99_ms or m["error_rate"] > error_rate:
+            break
+        best = result["params"]["sessions"]
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--sessions", default="1,10,25,50,100", help="Per stage")
+    parser.add_argument("--stage-seconds", type=float, default=30.0)
+    parser.add_argument("--think-seconds", type=float, default=2.0)
+    parser.add_argument("--turns", type=int, default=10, help="Messages per session")
+    parser.add_argument("--no-render", action="store_true", help="Skip history reruns")
+    parser.add_argument("--render-window", type=int, default=20)
+    # The app's generation settings
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--user-rate-limit", default="", help='E.g. "10/minute"')
+    parser.add_argument("--no-coalesce", action="store_true")
+    # The fake model
+    parser.add_argument("--first-chunk-latency", type=float, default=0.3)
+    parser.add_argument("--chunk-latency", type=float, default=0.02)
+    parser.add_argument("--chunk-count", type=int, default=50)
+    parser.add_argument("--chunk-chars", type=int, default=20)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-code", type=int, default=503)
+    # Objectives, for the recommended sessions per instance
+    parser.add_argument("--slo-ttft-p99-ms", type=float, default=2000.0)
+    parser.add_argument("--slo-error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    # pylint: disable=import-outside-toplevel
+    from streamlit import config as st_config
+    from streamlit.logger import set_log_level
+
+    # Silence the "missing ScriptRunContext" warnings of bare mode
+    st_config.get_config_options()
+    set_log_level("error")
+
+    settings = LoadSettings(
+        stages=[int(n) for n in args.sessions.split(",")],
+        stage_seconds=args.stage_seconds,
+        think_seconds=args.think_seconds,
+        turns=args.turns,
+        render=not args.no_render,
+        render_window=args.render_window,
+    )
+    fake_settings = FakeStreamSettings(
+        first_chunk_latency=args.first_chunk_latency,
+        chunk_latency=args.chunk_latency,
+        chunk_count=args.chunk_count,
+        chunk_chars=args.chunk_chars,
+        failure_rate=args.failure_rate,
+        failure_code=args.failure_code,
+    )
+    engine = GenerationEngine(
+        max_concurrency=args.concurrency,
+        timeout_seconds=args.timeout,
+        admission=AdmissionController(
+            max_concurrency=args.concurrency, max_queue=args.queue_size
+        ),
+    )
+
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as root:
+        attachment_store = AttachmentStore(root, max_bytes=2**30)
+        load_test = LoadTest(
+            settings,
+            FakeGenaiClient(settings=fake_settings),
+            engine,
+            RateLimiter(user_limits=args.user_rate_limit),
+            attachment_store,
+            MemoryAccountant(attachment_store=attachment_store),
+            None if args.no_coalesce else FlushPolicy(),
+        )
+        results = load_test.run()
+    recommended = max_sessions(results, args.slo_ttft_p99_ms, args.slo_error_rate)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "duration_s": time.perf_counter() - started,
+            "settings": {**settings.__dict__, **fake_settings.__dict__},
+            "generation": {
+                "concurrency": args.concurrency,
+                "queue_size": args.queue_size,
+                "timeout": args.timeout,
+                "user_rate_limit": args.user_rate_limit,
+            },
+        },
+        "max_sessions_within_slo": recommended,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    logger.info(
+        f"Wrote {len(results)} load stages to {args.output}. "
+        f"Most sessions within p99 TTFT {args.slo_ttft_p99_ms:.0f}ms and "
+        f"{args.slo_error_rate:.1%} errors: {recommended or 'none'}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Accounting of the memory held by chat sessions, per session and across the process.
+
+Each session holds the text of its messages, and its `HistoryBuilder` holds the bytes
+of the attachments it has converted. The attachment store's local files count too, since
+/tmp is held in memory on Cloud Run. When a session exceeds its cap, its oldest attachments
+are spilled: released from memory, and read back from the store when they're next sent.
+When the process exceeds its cap, the largest sessions are spilled first, and then the least
+recently used attachments are evicted from the store, and then the preprocessor's cached
+results."""
+
+import os
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from attachments import AttachmentStore
+from config import logger
+from metrics import counter, gauge, histogram
+
+if TYPE_CHECKING:
+    from history import HistoryBuilder
+    from preprocess import AttachmentPreprocessor
+
+# Bytes, from a short text-only chat up to a session with several large attachments
+BYTE_BUCKETS = tuple(2**n for n in range(10, 31, 2))  # 1 KiB to 1 GiB
+
+session_memory_bytes = histogram(
+    "rickbot_session_memory_bytes",
+    "Bytes held by a session, after each response.",
+    buckets=BYTE_BUCKETS,
+)
+memory_released_bytes = counter(
+    "rickbot_memory_released_bytes_total",
+    "Bytes of attachments released to stay within the memory caps.",
+    ("action",),
+)
+
+
+def process_resident_bytes() -> int:
+    """The resident memory of this process, or 0 if it can't be read (Linux only)."""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+@dataclass(frozen=True)
+class MemoryUsage:
+    """Bytes held, in total or by one session."""
+
+    sessions: int
+    text_bytes: int  # Message text
+    attachment_bytes: int  # Attachments held by history builders
+    store_bytes: int  # Attachments in the local attachment store
+    cache_bytes: int = 0  # Preprocessed attachments in the preprocessor's cache
+
+    @property
+    def total_bytes(self) -> int:
+        return (
+            self.text_bytes
+            + self.attachment_bytes
+            + self.store_bytes
+            + self.cache_bytes
+        )
+
+
+class _Session:
+    def __init__(self, builder: "HistoryBuilder | None"):
+        self.builder = weakref.ref(builder) if builder else None
+        self.messages = 0  # Messages whose text has been counted
+        self.text_bytes = 0
+
+    @property
+    def attachment_bytes(self) -> int:
+        builder = self.builder() if self.builder else None
+        return builder.held_bytes if builder else 0
+
+
+class MemoryAccountant:
+    """Tracks the bytes held by each session, and enforces per-session and
+    process-wide caps by spilling and evicting attachments. Safe to share between sessions.
+    """
+
+    def __init__(
+        self,
+        session_max_bytes: int = 0,
+        max_bytes: int = 0,
+        attachment_store: AttachmentStore | None = None,
+        preprocessor: "AttachmentPreprocessor | None" = None,
+    ):
+        """
+        Args:
+            session_max_bytes (int): Attachment bytes a session may hold in memory.
+                0 means unlimited.
+            max_bytes (int): Bytes all sessions and the attachment store may hold together.
+                0 means unlimited.
+            attachment_store (AttachmentStore, optional): The shared attachment store.
+            preprocessor (AttachmentPreprocessor, optional): Caches preprocessed attachments.
+        """
+        self.session_max_bytes = session_max_bytes
+        self.max_bytes = max_bytes
+        self.attachment_store = attachment_store
+        self.preprocessor = preprocessor
+        self._sessions: dict[str, _Session] = {}
+        self._lock = threading.Lock()
+        gauge(
+            "rickbot_memory_sessions",
+            "Sessions being tracked.",
+            function=lambda: len(self._sessions),
+        )
+        gauge(
+            "rickbot_memory_text_bytes",
+            "Bytes of message text held by all sessions.",
+            function=lambda: self.usage().text_bytes,
+        )
+        gauge(
+            "rickbot_memory_attachment_bytes",
+            "Bytes of attachments held in memory by all sessions.",
+            function=lambda: self.usage().attachment_bytes,
+        )
+        gauge(
+            "rickbot_memory_total_bytes",
+            "Bytes held by all sessions, the local attachment store and the preprocessor cache.",
+            function=lambda: self.usage().total_bytes,
+        )
+        gauge(
+            "rickbot_process_resident_bytes",
+            "Resident memory of the process.",
+            function=process_resident_bytes,
+        )
+
+    def _session(self, session_id: str, builder) -> _Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            current = session.builder() if session and session.builder else None
+            if session is None or (builder is not None and current is not builder):
+                session = _Session(builder)
+                self._sessions[session_id] = session
+                if builder is not None:  # Forget the session once its state is gone
+                    weakref.finalize(builder, self._forget, session_id, session)
+            return session
+
+    def _forget(self, session_id: str, session: _Session):
+        with self._lock:
+            if self._sessions.get(session_id) is session:
+                del self._sessions[session_id]
+
+    def update(
+        self,
+        session_id: str,
+        messages: list[dict],
+        builder: "HistoryBuilder | None" = None,
+    ) -> MemoryUsage:
+        """Account for a session's messages and history, e.g. after each response,
+        and spill or evict attachments if a cap is exceeded.
+
+        Args:
+            session_id (str): Identifies the session.
+            messages (list[dict]): The session's chat history.
+            builder (HistoryBuilder, optional): The session's history builder.
+
+        Returns:
+            MemoryUsage: The session's usage, after enforcing the caps.
+        """
+        session = self._session(session_id, builder)
+        if len(messages) < session.messages:  # The history was replaced
+            session.messages = session.text_bytes = 0
+        for message in messages[session.messages :]:
+            session.text_bytes += len(message["content"].encode("utf-8"))
+        session.messages = len(messages)
+
+        if builder and self.session_max_bytes:
+            released = builder.spill(self.session_max_bytes)
+            memory_released_bytes.inc(released, action="session_spill")
+        if self.max_bytes:
+            self._enforce_max_bytes()
+
+        usage = MemoryUsage(1, session.text_bytes, session.attachment_bytes, 0)
+        session_memory_bytes.observe(usage.total_bytes)
+        return usage
+
+    def _enforce_max_bytes(self):
+        excess = self.usage().total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+
+        # Spill the sessions holding the most attachments first...
+        with self._lock:
+            sessions = sorted(
+                self._sessions.values(), key=lambda s: s.attachment_bytes, reverse=True
+            )
+        for session in sessions:
+            if excess <= 0:
+                break
+            builder = session.builder() if session.builder else None
+            if builder:
+                released = builder.spill()
+                memory_released_bytes.inc(released, action="global_spill")
+                excess -= released
+
+        # ... then evict the least recently used attachments from the store
+        if excess > 0 and self.attachment_store:
+            evicted = self.attachment_store.shrink(
+                max(0, self.attachment_store.total_bytes - excess)
+            )
+            memory_released_bytes.inc(evicted, action="store_evict")
+            excess -= evicted
+
+        # ... and finally the preprocessor's cached results
+        if excess > 0 and self.preprocessor:
+            evicted = self.preprocessor.shrink(
+                max(0, self.preprocessor.cache_bytes - excess)
+            )
+            memory_released_bytes.inc(evicted, action="preprocess_evict")
+            excess -= evicted
+
+        if excess > 0:
+            logger.warning(
+                f"Sessions hold {self.usage().total_bytes:,} bytes, "
+                f"over the {self.max_bytes:,} byte cap, after releasing attachments."
+            )
+
+    def usage(self, session_id: str | None = None) -> MemoryUsage:
+        """Current usage of one session, or in total across all sessions."""
+        with self._lock:
+            if session_id is not None:
+                session = self._sessions.get(session_id)
+                sessions = [session] if session else []
+            else:
+                sessions = list(self._sessions.values())
+        store_bytes = (
+            self.attachment_store.total_bytes
+            if self.attachment_store and session_id is None
+            else 0
+        )
+        cache_bytes = (
+            self.preprocessor.cache_bytes
+            if self.preprocessor and session_id is None
+            else 0
+        )
+        return MemoryUsage(
+            sessions=len(sessions),
+            text_bytes=sum(s.text_bytes for s in sessions),
+            attachment_bytes=sum(s.attachment_bytes for s in sessions),
+            store_bytes=store_bytes,
+            cache_bytes=cache_bytes,
+        )
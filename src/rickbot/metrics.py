@@ -0,0 +1,382 @@
+"""Latency instrumentation and metrics for Rickbot.
+
+Timings on the hot path are recorded as labelled histograms, and counts as counters.
+Metrics are exported in the Prometheus text format, which can be scraped by Prometheus,
+Google Cloud Managed Service for Prometheus, or an OpenTelemetry collector."""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import AsyncIterator, Callable, Iterator
+
+from config import logger
+
+# Seconds. Spans from a few ms (config, history) up to long streamed responses
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.label_names, key)} {value}"
+                for key, value in self._values.items()
+            ]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, optionally read from a function when exported."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        function: Callable[[], float] | None = None,
+    ):
+        super().__init__(name, description, labels)
+        self._values: dict[LabelValues, float] = {}
+        self._function = function
+
+    @property
+    def function(self) -> Callable[[], float] | None:
+        """The function the value is read from, if any."""
+        return self._function
+
+    def bind(self, function: Callable[[], float]):
+        """Read the value from this function when exported, instead of any previous one."""
+        self._function = function
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> list[str]:
+        if self._function:
+            return [f"{self.name} {self._function()}"]
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.label_names, key)} {value}"
+                for key, value in self._values.items()
+            ]
+
+
+class Histogram(_Metric):
+    """A distribution of observations, in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # Label values -> [count per bucket, plus +Inf], sum
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(
+                    (*self.buckets, "+Inf"), counts, strict=True
+                ):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total[0]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Holds all metrics, and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Register a metric, or return the existing metric with the same name.
+        A function gauge registered again is rebound to the new function, so that it
+        reads the latest instance of whatever it measures, e.g. after a cache is cleared.
+
+        Raises:
+            ValueError: If a different kind of metric, or one with different labels,
+                is already registered with the same name.
+        """
+        with self._lock:
+            existing = self._metrics.setdefault(metric.name, metric)
+            if existing is metric:
+                return metric
+            if (
+                type(existing) is not type(metric)
+                or existing.label_names != metric.label_names
+            ):
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            if (
+                isinstance(existing, Gauge)
+                and isinstance(metric, Gauge)
+                and metric.function
+            ):
+                existing.bind(metric.function)
+            return existing
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines += metric.header() + metric.samples()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+    return registry.register(Counter(name, description, labels))  # type: ignore
+
+
+def gauge(
+    name: str,
+    description: str,
+    labels: tuple[str, ...] = (),
+    function: Callable[[], float] | None = None,
+) -> Gauge:
+    return registry.register(Gauge(name, description, labels, function))  # type: ignore
+
+
+def histogram(
+    name: str,
+    description: str,
+    labels: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = LATENCY_BUCKETS,
+) -> Histogram:
+    return registry.register(Histogram(name, description, labels, buckets))  # type: ignore
+
+
+# --- Hot path metrics ---
+span_seconds = histogram(
+    "rickbot_span_seconds",
+    "Duration of instrumented operations.",
+    ("span", "personality", "model"),
+)
+time_to_first_chunk_seconds = histogram(
+    "rickbot_time_to_first_chunk_seconds",
+    "Time from sending a request to receiving the first response chunk.",
+    ("personality", "model"),
+)
+stream_seconds = histogram(
+    "rickbot_stream_seconds",
+    "Total time to stream a response.",
+    ("personality", "model"),
+)
+stream_chunks = histogram(
+    "rickbot_stream_chunks",
+    "Number of chunks streamed by the model for a response, before coalescing.",
+    ("model",),
+    buckets=COUNT_BUCKETS,
+)
+stream_writes = histogram(
+    "rickbot_stream_writes",
+    "Number of text chunks written for a response, after any coalescing.",
+    ("personality", "model"),
+    buckets=COUNT_BUCKETS,
+)
+stream_errors = counter(
+    "rickbot_stream_errors_total",
+    "Responses that failed.",
+    ("personality", "model"),
+)
+rate_limit_rejections = counter(
+    "rickbot_rate_limit_rejections_total", "Requests rejected by the rate limiter."
+)
+
+
+@contextmanager
+def span(name: str, **labels: str) -> Iterator[None]:
+    """Time an operation, recording it in the span histogram and the debug log."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        span_seconds.observe(elapsed, span=name, **labels)
+        logger.debug(f"span={name} seconds={elapsed:.4f} {labels}")
+
+
+def instrument_stream(
+    stream: Iterator[str], personality: str, model: str
+) -> Iterator[str]:
+    """Record time to first chunk, total streaming time and the number of chunks written
+    for a response stream."""
+    start = time.perf_counter()
+    chunks = 0
+    try:
+        for chunk in stream:
+            if chunks == 0:
+                time_to_first_chunk_seconds.observe(
+                    time.perf_counter() - start, personality=personality, model=model
+                )
+            chunks += 1
+            yield chunk
+    except Exception:
+        stream_errors.inc(personality=personality, model=model)
+        raise
+    elapsed = time.perf_counter() - start
+    stream_seconds.observe(elapsed, personality=personality, model=model)
+    stream_writes.observe(chunks, personality=personality, model=model)
+    logger.debug(
+        f"stream personality={personality} model={model} "
+        f"seconds={elapsed:.3f} writes={chunks}"
+    )
+
+
+async def instrument_astream(
+    stream: AsyncIterator[str], personality: str, model: str
+) -> AsyncIterator[str]:
+    """Like `instrument_stream`, for an async response stream."""
+    start = time.perf_counter()
+    chunks = 0
+    try:
+        async for chunk in stream:
+            if chunks == 0:
+                time_to_first_chunk_seconds.observe(
+                    time.perf_counter() - start, personality=personality, model=model
+                )
+            chunks += 1
+            yield chunk
+    except Exception:
+        stream_errors.inc(personality=personality, model=model)
+        raise
+    elapsed = time.perf_counter() - start
+    stream_seconds.observe(elapsed, personality=personality, model=model)
+    stream_writes.observe(chunks, personality=personality, model=model)
+
+
+def instrument_fan_out(
+    stream: Iterator[tuple[int, str]], labels: list[tuple[str, str]]
+) -> Iterator[tuple[int, str]]:
+    """Like `instrument_stream`, for concurrent responses tagged with their index.
+
+    Args:
+        stream (Iterator[tuple[int, str]]): The tagged response chunks.
+        labels (list[tuple[str, str]]): The personality and model of each response.
+    """
+    start = time.perf_counter()
+    chunks = [0] * len(labels)
+    finished = [start] * len(labels)
+    for index, chunk in stream:
+        personality, model = labels[index]
+        if chunks[index] == 0:
+            time_to_first_chunk_seconds.observe(
+                time.perf_counter() - start, personality=personality, model=model
+            )
+        chunks[index] += 1
+        finished[index] = time.perf_counter()
+        yield index, chunk
+    for (personality, model), count, end in zip(labels, chunks, finished):
+        if count:
+            stream_seconds.observe(end - start, personality=personality, model=model)
+            stream_writes.observe(count, personality=personality, model=model)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass  # Don't log every scrape
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serve /metrics on this port, from a background thread."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="rickbot-metrics", daemon=True
+    ).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
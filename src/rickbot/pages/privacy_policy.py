@@ -13,22 +13,22 @@ This Privacy Policy describes how Rickbot ("we," "us," or "our") collects, uses,
 
 **1. Information We Do Not Collect**
 
-Rickbot is designed with your privacy in mind. We do not collect, store, or process any personal data, prompts, or responses from your interactions with the chatbot. All conversations are ephemeral and are not retained on our servers or any third-party services.
+Rickbot is designed with your privacy in mind. We do not collect personal data from your interactions with the chatbot. Conversations are held only for the duration of your session, and are not retained on our servers. Uploaded attachments are held temporarily, as described below.
 
 **2. How Your Data is Handled (Ephemeral)**
 
 When you interact with Rickbot:
-*   **Prompts**: Your input prompts are sent to the Google Gemini API for processing. These prompts are used solely to generate a response and are not stored by Rickbot.
-*   **Responses**: The responses generated by the Google Gemini API are displayed to you in real-time. These responses are not stored by Rickbot.
-*   **Attachments**: If you upload files (images, videos, etc.), they are temporarily processed for the current interaction with the Google Gemini API and are not stored by Rickbot after the interaction.
+*   **Prompts**: Your input prompts are sent to the Google Gemini API for processing. These prompts are used solely to generate a response and are not stored by Rickbot, except as described for common opening questions below.
+*   **Responses**: The responses generated by the Google Gemini API are displayed to you in real-time. These responses are not stored by Rickbot beyond your session, with one exception. Depending on how Rickbot is deployed, the response to a common opening question (such as "Who are you?"), asked as the first message of a conversation without an attachment, may be held in the server's memory for up to an hour, together with the question's text, so that it can be reused for anyone asking the same question. These are not linked to you, and responses that use Google Search are never held.
+*   **Attachments**: If you upload files (images, videos, etc.), they may be downscaled or trimmed, and are then held temporarily on the Rickbot server's local storage, so that they don't have to be uploaded again with each message. They are identified only by a fingerprint of their contents, not by who uploaded them. They are deleted when space is needed, and when the server restarts. Depending on how Rickbot is deployed, attachments may also be uploaded to a Google Cloud Storage bucket, so that the Google Gemini API can read them from there. They are deleted from the bucket automatically after a retention period.
 
 **3. Third-Party Services**
 
-Rickbot utilizes the Google Gemini API for its core functionality. Your prompts and attachments are sent to this API for processing. Please refer to Google's privacy policy for information on how they handle data.
+Rickbot utilizes the Google Gemini API for its core functionality. Your prompts and attachments are sent to this API for processing. Attachments may also be held in Google Cloud Storage, as described above. Please refer to Google's privacy policy for information on how they handle data.
 
 **4. Rate Limiting**
 
-To ensure fair usage and prevent abuse, Rickbot implements a simple in-memory rate limiting mechanism. This mechanism tracks the number of requests from a session within a given time frame. This data is not personally identifiable and is not stored persistently.
+To ensure fair usage and prevent abuse, Rickbot implements a rate limiting mechanism. This mechanism counts the number of requests from each logged-in account (or, if not logged in, each session) within a given time frame. These counts may be held in a shared cache so that limits apply across all Rickbot servers. They expire automatically and are not stored persistently.
 
 **5. Changes to This Privacy Policy**
 
@@ -39,5 +39,5 @@ We may update our Privacy Policy from time to time. We will notify you of any ch
 If you have any questions about this Privacy Policy, please contact the developer via the GitHub repository linked on the main page.
 
 ---
-*Last updated: June 26, 2025*
+*Last updated: October 18, 2026*
 """)
@@ -1,19 +1,128 @@
-"""Configure personalities for Rickbot"""
+"""Configure personalities for Rickbot.
+
+The personalities are held in a registry, whose contents can be replaced atomically
+when the personalities are reloaded. Modules hold the registry itself, so they always see
+the current personalities. A request in progress keeps the `Personality` it started with.
+"""
 
 import os
-from dataclasses import dataclass, field
-import yaml  # pyyaml
-from config import logger, SCRIPT_DIR
-from utils import retrieve_secret
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+from bundle import PERSONALITIES_FILE, SYSTEM_PROMPTS_DIR, read_bundle
+from config import logger, Config, SCRIPT_DIR
+from utils import prefetch_secrets, retrieve_secret_version
+
+GROUNDING_POLICIES = ("always", "never", "auto")
+
+# Prompts retrieved from Secret Manager are cached on disk, along with their secret version.
+# Only this process's user can read them. Set from the config by `configure_prompt_cache`.
+PROMPT_CACHE_DIR = Path(Config.prompt_cache_dir)
+PROMPT_CACHE_TTL = Config.prompt_cache_ttl  # Seconds
+
+
+def configure_prompt_cache(directory: str, ttl_seconds: int):
+    """Set where prompts from Secret Manager are cached on disk, and for how long."""
+    global PROMPT_CACHE_DIR, PROMPT_CACHE_TTL  # pylint: disable=global-statement
+    PROMPT_CACHE_DIR = Path(directory)
+    PROMPT_CACHE_TTL = ttl_seconds
 
 
 def get_avatar(name: str) -> str:
     return str(SCRIPT_DIR / f"media/{name}.png")
 
 
+def _read_cached_prompt(name: str) -> str | None:
+    """Read a prompt from the disk cache, if it hasn't expired."""
+    prompt_file = PROMPT_CACHE_DIR / f"{name}.txt"
+    version_file = PROMPT_CACHE_DIR / f"{name}.version"
+    try:
+        if time.time() - prompt_file.stat().st_mtime > PROMPT_CACHE_TTL:
+            return None
+        prompt = prompt_file.read_text(encoding="utf-8")
+        version = version_file.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    logger.info(f"Using cached system prompt for {name}, version {version}.")
+    return prompt
+
+
+def _write_private(path: Path, text: str):
+    """Write a file that only this user can read, replacing any existing file atomically."""
+    temp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp, path)
+    except OSError:
+        temp.unlink(missing_ok=True)
+        raise
+
+
+def _write_cached_prompt(name: str, prompt: str, version: str):
+    """Cache a prompt on disk, recording its secret version."""
+    try:
+        PROMPT_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # In case it already existed, e.g. in a shared /tmp
+        PROMPT_CACHE_DIR.chmod(0o700)
+        version_file = PROMPT_CACHE_DIR / f"{name}.version"
+        if version_file.exists():
+            previous = version_file.read_text(encoding="utf-8").strip()
+            if previous != version:
+                logger.info(
+                    f"System prompt for {name} updated: {previous} -> {version}"
+                )
+        _write_private(PROMPT_CACHE_DIR / f"{name}.txt", prompt)
+        _write_private(version_file, version)
+    except OSError as e:
+        logger.warning(f"Unable to cache system prompt for {name}: {e}")
+
+
+def load_system_prompt(name: str, prompts_dir: Path = SYSTEM_PROMPTS_DIR) -> str:
+    """Load the system prompt for a personality.
+
+    The prompt is read from the system_prompts folder. If it doesn't exist there,
+    we use the disk cache, or retrieve it from Secret Manager.
+
+    Raises:
+        ValueError: If the prompt can't be found locally or retrieved from Secret Manager.
+    """
+    name = name.lower()
+    system_prompt_file = prompts_dir / f"{name}.txt"
+    if os.path.exists(system_prompt_file):
+        with open(system_prompt_file, "r", encoding="utf-8") as f:
+            return f.read()
+
+    cached_prompt = _read_cached_prompt(name)
+    if cached_prompt is not None:
+        return cached_prompt
+
+    logger.info(
+        f"Unable to find {system_prompt_file}. Attempting to retrieve from Secret Manager."
+    )
+    secret_name = f"{name}-system-prompt"
+    try:
+        google_project = os.environ.get("GOOGLE_CLOUD_PROJECT")
+        prompt, version = retrieve_secret_version(google_project, secret_name)  # type: ignore
+        logger.info(f"Successfully retrieved '{secret_name}', version {version}.")
+    except Exception as e:
+        logger.warning(f"Unable to retrieve '{secret_name}' from Secret Manager.")
+        raise ValueError(
+            f"{system_prompt_file} not found and could not access '{secret_name}' from Secret Manager: {e}"
+        ) from e
+
+    _write_cached_prompt(name, prompt, version)
+    return prompt
+
+
 @dataclass(unsafe_hash=True)
 class Personality:
-    """Configuration for a given personality"""
+    """Configuration for a given personality.
+    The system instruction is loaded lazily, on first use."""
 
     name: str
     menu_name: str
@@ -22,43 +131,92 @@ class Personality:
     welcome: str
     prompt_question: str
     temperature: float
+    model: str = ""  # The model for this personality. Empty for the default model
+    fast_model: str = ""  # A cheaper, faster model for simple prompts, if any
+    grounding: str = "always"  # Google Search grounding: always, never or auto
     avatar: str = field(init=False)
-    system_instruction: str = field(init=False)
+    # Incremented when the personality is reloaded, so caches keyed on it are not reused
+    revision: int = field(init=False, default=0)
+    _system_instruction: str | None = field(
+        init=False, default=None, compare=False, repr=False
+    )
+    _lock: threading.Lock = field(
+        init=False, default_factory=threading.Lock, compare=False, repr=False
+    )
 
     def __post_init__(self) -> None:
         self.avatar = get_avatar(self.name.lower())
-
-        # Retrieve the prompt from the system_prompts folder
-        # If the prompt doesn't exist, try retrieving from Secret Manager
-        system_prompt_file = (
-            SCRIPT_DIR / "data/system_prompts" / f"{self.name.lower()}.txt"
-        )
-        if os.path.exists(system_prompt_file):
-            with open(system_prompt_file, "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        else:
-            logger.info(
-                f"Unable to find {system_prompt_file}. Attempting to retrieve from Secret Manager."
+        if self.grounding not in GROUNDING_POLICIES:
+            raise ValueError(
+                f"Invalid grounding '{self.grounding}' for {self.name}. "
+                f"Expected one of {GROUNDING_POLICIES}."
             )
-            try:
-                google_project = os.environ.get("GOOGLE_CLOUD_PROJECT")
-                secret_name = f"{self.name.lower()}-system-prompt"
-                self.system_instruction = retrieve_secret(google_project, secret_name)  # type: ignore
-                logger.info("Successfully retrieved.")
-            except Exception as e:
-                logger.warning(
-                    f"Unable to retrieve '{secret_name}' from Secret Manager."
-                )
-                raise ValueError(
-                    f"{system_prompt_file} not found and could not access '{secret_name}' from Secret Manager: {e}"
-                ) from e
+
+    @property
+    def system_instruction(self) -> str:
+        """The system prompt for this personality, loaded on first use.
+
+        Raises:
+            ValueError: If the prompt can't be loaded.
+        """
+        if self._system_instruction is None:
+            with self._lock:  # Only load once, even if several sessions ask at once
+                if self._system_instruction is None:
+                    self._system_instruction = load_system_prompt(self.name)
+        return self._system_instruction
+
+    @property
+    def is_loaded(self) -> bool:
+        """Whether the system prompt has been loaded."""
+        return self._system_instruction is not None
+
+    @property
+    def definition(self) -> dict[str, Any]:
+        """The attributes this personality was defined with, e.g. in personalities.yaml."""
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.init}
 
     def __repr__(self) -> str:
         return self.name
 
 
+class PersonalityRegistry(Mapping[str, Personality]):
+    """The personalities, by name. Reads see either the old or the new personalities,
+    never a mix, while they are being replaced."""
+
+    def __init__(self, peeps: dict[str, Personality]):
+        self._peeps = dict(peeps)
+
+    def __getitem__(self, name: str) -> Personality:
+        return self._peeps[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._peeps)
+
+    def __len__(self) -> int:
+        return len(self._peeps)
+
+    def keys(self):  # type: ignore[override]
+        return self._peeps.keys()
+
+    def values(self):  # type: ignore[override]
+        return self._peeps.values()
+
+    def items(self):  # type: ignore[override]
+        return self._peeps.items()
+
+    def snapshot(self) -> dict[str, Personality]:
+        """A copy of the current personalities."""
+        return dict(self._peeps)
+
+    def replace(self, peeps: dict[str, Personality]):
+        """Swap in a new set of personalities, atomically."""
+        self._peeps = dict(peeps)
+
+
 def load_personalities(yaml_file: str) -> dict[str, Personality]:
     """Load personalities from a YAML file."""
+    import yaml  # pylint: disable=import-outside-toplevel
+
     peeps: dict[str, Personality] = {}
     with open(yaml_file, "r", encoding="utf-8") as f:
         peep_data = yaml.safe_load(f)
@@ -68,5 +226,39 @@ def load_personalities(yaml_file: str) -> dict[str, Personality]:
     return peeps
 
 
-# Load personalities from the YAML file
-personalities = load_personalities(str(SCRIPT_DIR / "data/personalities.yaml"))
+def load_bundled_personalities(bundle: dict) -> dict[str, Personality]:
+    """Load personalities from a prebuilt bundle, along with their bundled prompts."""
+    # pylint: disable=protected-access
+    prompts = bundle["prompts"]
+    peeps: dict[str, Personality] = {}
+    for this_peep in bundle["personalities"]:
+        personality = Personality(**this_peep)
+        personality._system_instruction = prompts.get(personality.name.lower())
+        peeps[personality.name] = personality
+    return peeps
+
+
+def prefetch_system_prompts(peeps: Iterable[Personality]):
+    """Retrieve the system prompts that aren't available locally from Secret Manager,
+    concurrently and in the background, without blocking the caller.
+    A personality that is used before its prompt has been prefetched waits for that prompt only.
+    """
+    secret_ids = [
+        f"{p.name.lower()}-system-prompt"
+        for p in peeps
+        if not p.is_loaded
+        and not (SYSTEM_PROMPTS_DIR / f"{p.name.lower()}.txt").exists()
+        and not (PROMPT_CACHE_DIR / f"{p.name.lower()}.txt").exists()
+    ]
+    if secret_ids:
+        prefetch_secrets(os.environ.get("GOOGLE_CLOUD_PROJECT", ""), secret_ids)
+
+
+# Load personalities from the prebuilt bundle if it's up to date, else from the YAML file
+_bundle = read_bundle()
+personalities = PersonalityRegistry(
+    load_bundled_personalities(_bundle)
+    if _bundle
+    else load_personalities(str(PERSONALITIES_FILE))
+)
+prefetch_system_prompts(personalities.values())
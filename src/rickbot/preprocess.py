@@ -0,0 +1,270 @@
+"""Preprocessing of uploaded attachments, before they are stored and sent to the model.
+
+Images are downscaled and re-encoded, losslessly unless they were already lossy JPEGs.
+Videos and audio are trimmed and re-encoded with ffmpeg, and PDFs are limited to a number
+of pages with pypdf. Both are installed in the container image.
+Work is done in a bounded worker pool, and results are cached by content hash,
+so the same upload is only processed once. The cache is bounded by its total bytes.
+Videos are only re-encoded if a trim or a maximum height is configured. If preprocessing
+takes too long, the original attachment is used, and the result is cached for next time.
+"""
+
+import io
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+
+from PIL import Image, ImageOps  # Installed with Streamlit
+
+from attachments import content_digest
+from config import logger
+from metrics import counter, gauge, span
+
+preprocess_bytes_in = counter(
+    "rickbot_preprocess_bytes_in_total", "Attachment bytes before preprocessing."
+)
+preprocess_bytes_out = counter(
+    "rickbot_preprocess_bytes_out_total", "Attachment bytes after preprocessing."
+)
+
+
+@dataclass
+class PreprocessSettings:
+    """What to do to each kind of attachment. 0 disables a step."""
+
+    image_max_px: int = 1536  # Longest side of images
+    image_quality: int = 85  # JPEG quality
+    media_max_seconds: int = 0  # Trim videos and audio to this length
+    video_max_height: int = 0  # E.g. 720
+    pdf_max_pages: int = 0
+
+
+@dataclass(frozen=True)
+class Preprocessed:
+    """A preprocessed attachment."""
+
+    data: bytes
+    mime_type: str
+    original_bytes: int
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - len(self.data)
+
+
+def preprocess_image(data: bytes, settings: PreprocessSettings) -> tuple[bytes, str]:
+    """Downscale an image. JPEGs are re-encoded as JPEG, and other images, such as
+    screenshots and diagrams, as lossless PNG."""
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)  # Phone photos are often rotated
+        if settings.image_max_px:
+            image.thumbnail((settings.image_max_px, settings.image_max_px))
+        buffer = io.BytesIO()
+        if original.format not in ("JPEG", "MPO"):  # MPO is a multi-picture JPEG
+            image.save(buffer, format="PNG", optimize=True)
+            return buffer.getvalue(), "image/png"
+        image.convert("RGB").save(
+            buffer, format="JPEG", quality=settings.image_quality, optimize=True
+        )
+        return buffer.getvalue(), "image/jpeg"
+
+
+def preprocess_media(
+    data: bytes, mime_type: str, settings: PreprocessSettings
+) -> tuple[bytes, str]:
+    """Trim and re-encode a video or audio file with ffmpeg.
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails.
+    """
+    is_video = mime_type.startswith("video/")
+    args = ["-t", str(settings.media_max_seconds)] if settings.media_max_seconds else []
+    if is_video:
+        if settings.video_max_height:
+            args += ["-vf", f"scale=-2:'min({settings.video_max_height},ih)'"]
+        args += ["-c:v", "libx264", "-preset", "veryfast", "-crf", "28"]
+        args += ["-c:a", "aac", "-b:a", "64k", "-movflags", "+faststart"]
+        suffix, out_mime = ".mp4", "video/mp4"
+    else:
+        args += ["-vn", "-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k"]
+        suffix, out_mime = ".mp3", "audio/mpeg"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source, target = Path(tmp, "in"), Path(tmp, f"out{suffix}")
+        source.write_bytes(data)
+        subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", str(source)]
+            + args
+            + [str(target)],
+            check=True,
+            capture_output=True,
+            timeout=300,
+        )
+        return target.read_bytes(), out_mime
+
+
+def preprocess_pdf(data: bytes, settings: PreprocessSettings) -> bytes:
+    """Keep only the first pages of a PDF. Requires pypdf."""
+    from pypdf import PdfReader, PdfWriter  # pylint: disable=import-outside-toplevel
+
+    reader = PdfReader(io.BytesIO(data))
+    if len(reader.pages) <= settings.pdf_max_pages:
+        return data
+    writer = PdfWriter()
+    for page in reader.pages[: settings.pdf_max_pages]:
+        writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def _has_pypdf() -> bool:
+    try:
+        import pypdf  # pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        return False
+    return True
+
+
+class AttachmentPreprocessor:
+    """Preprocesses attachments in a worker pool, caching results by content hash.
+    Safe to share between sessions. If a step fails, the original attachment is used."""
+
+    def __init__(
+        self,
+        settings: PreprocessSettings | None = None,
+        max_workers: int = 2,
+        cache_size: int = 64,
+        cache_max_bytes: int = 64 * 1024 * 1024,
+        wait_seconds: float = 60,
+    ):
+        """
+        Args:
+            settings (PreprocessSettings, optional): What to do to each kind of attachment.
+            max_workers (int): Attachments processed concurrently, across all sessions.
+            cache_size (int): Number of preprocessed attachments to keep.
+            cache_max_bytes (int): Bytes of preprocessed attachments to keep.
+            wait_seconds (float): How long to wait for an attachment to be preprocessed,
+                before using the original.
+        """
+        self.settings = settings or PreprocessSettings()
+        self.cache_size = cache_size
+        self.cache_max_bytes = cache_max_bytes
+        self.wait_seconds = wait_seconds
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="preprocess"
+        )
+        self._cache: OrderedDict[tuple[str, str], Future[Preprocessed]] = OrderedDict()
+        self._sizes: dict[tuple[str, str], int] = {}  # Bytes of completed results
+        self.cache_bytes = 0
+        self._lock = threading.Lock()
+        self.has_ffmpeg = shutil.which("ffmpeg") is not None
+        self.has_pypdf = _has_pypdf()
+        gauge(
+            "rickbot_preprocess_cache_bytes",
+            "Bytes of preprocessed attachments held in the cache.",
+            function=lambda: self.cache_bytes,
+        )
+        media = self.settings.media_max_seconds or self.settings.video_max_height
+        if media and not self.has_ffmpeg:
+            logger.warning("ffmpeg not found. Videos and audio won't be preprocessed.")
+        if self.settings.pdf_max_pages and not self.has_pypdf:
+            logger.warning("pypdf not installed. PDFs won't be preprocessed.")
+
+    def submit(self, data: bytes, mime_type: str) -> Future[Preprocessed]:
+        """Start preprocessing an attachment, or return the cached result."""
+        key = (content_digest(data), mime_type)
+        with self._lock:
+            future = self._cache.get(key)
+            if future is not None:
+                self._cache.move_to_end(key)
+                return future
+            future = self._executor.submit(self._process, data, mime_type)
+            self._cache[key] = future
+            self._evict(self.cache_max_bytes)
+        future.add_done_callback(partial(self._completed, key))
+        return future
+
+    def _completed(self, key: tuple[str, str], future: Future[Preprocessed]):
+        if future.cancelled() or future.exception():
+            return
+        with self._lock:
+            if self._cache.get(key) is future:  # Not already evicted
+                self._sizes[key] = len(future.result().data)
+                self.cache_bytes += self._sizes[key]
+                self._evict(self.cache_max_bytes)
+
+    def _evict(self, max_bytes: int) -> int:
+        """Evict the least recently used results, while the cache is over its limits.
+        Called with the lock held."""
+        released = 0
+        while self._cache and (
+            len(self._cache) > self.cache_size or self.cache_bytes > max_bytes
+        ):
+            key, _ = self._cache.popitem(last=False)
+            size = self._sizes.pop(key, 0)
+            self.cache_bytes -= size
+            released += size
+        return released
+
+    def shrink(self, max_bytes: int) -> int:
+        """Evict cached results until the cache holds at most max_bytes.
+
+        Returns:
+            int: The bytes released.
+        """
+        with self._lock:
+            return self._evict(max_bytes)
+
+    def process(self, data: bytes, mime_type: str) -> Preprocessed:
+        """Preprocess an attachment, waiting for the result. If it takes too long,
+        the original is returned, and the result is cached once it's ready."""
+        try:
+            return self.submit(data, mime_type).result(timeout=self.wait_seconds)
+        except FutureTimeoutError:
+            logger.warning(
+                f"Preprocessing a {mime_type} attachment took over {self.wait_seconds}s. "
+                "Using the original."
+            )
+            return Preprocessed(data, mime_type, original_bytes=len(data))
+
+    def _process(self, data: bytes, mime_type: str) -> Preprocessed:
+        with span("attachment_preprocess"):
+            try:
+                new_data, new_mime = self._transform(data, mime_type)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.warning(f"Unable to preprocess {mime_type} attachment: {e}")
+                new_data, new_mime = data, mime_type
+
+        if len(new_data) >= len(data):  # Not worth it
+            new_data, new_mime = data, mime_type
+        result = Preprocessed(new_data, new_mime, original_bytes=len(data))
+        preprocess_bytes_in.inc(len(data))
+        preprocess_bytes_out.inc(len(new_data))
+        if result.saved_bytes:
+            logger.info(
+                f"Preprocessed {mime_type} attachment: {len(data):,} -> "
+                f"{len(new_data):,} bytes ({new_mime}), "
+                f"saved {result.saved_bytes / len(data):.0%}"
+            )
+        return result
+
+    def _transform(self, data: bytes, mime_type: str) -> tuple[bytes, str]:
+        settings = self.settings
+        if mime_type.startswith("image/"):
+            return preprocess_image(data, settings)
+        if mime_type.startswith(("video/", "audio/")) and self.has_ffmpeg:
+            is_video = mime_type.startswith("video/")
+            if settings.media_max_seconds or (is_video and settings.video_max_height):
+                return preprocess_media(data, mime_type, settings)
+        if mime_type == "application/pdf" and settings.pdf_max_pages:
+            if self.has_pypdf:
+                return preprocess_pdf(data, settings), mime_type
+        return data, mime_type
@@ -0,0 +1,147 @@
+"""Gemini context caching of personality system prompts.
+
+When enabled, each personality's system prompt and tools are held in a server-side
+cached content entry, per model and with or without grounding, so we don't pay full
+input tokens and prefill for them on every turn.
+Entries are created on first use, have their TTL extended shortly before they expire,
+and if caching isn't available (e.g. the prompt is below the model's minimum cacheable size)
+we fall back to sending the system prompt with each request."""
+
+import threading
+import time
+from dataclasses import dataclass
+
+from google.genai.types import (
+    CreateCachedContentConfig,
+    Part,
+    UpdateCachedContentConfig,
+)
+
+from agent import MODEL, get_tools
+from config import logger
+from personality import Personality
+
+
+@dataclass
+class _CacheEntry:
+    name: str  # Resource name of the cached content
+    expires_at: float  # time.monotonic() at which the server will expire the entry
+
+
+class SystemPromptCache:
+    """Creates and reuses a server-side cached content entry per personality, model
+    and grounding.
+    Safe to share between sessions."""
+
+    def __init__(
+        self,
+        ttl_seconds: int = 3600,
+        refresh_margin_seconds: int = 300,
+        retry_after_seconds: int = 600,
+    ):
+        """
+        Args:
+            ttl_seconds (int): TTL requested for each cached content entry.
+            refresh_margin_seconds (int): Extend the TTL when an entry is this close to expiring.
+            retry_after_seconds (int): After caching fails, how long to wait before trying again.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = min(refresh_margin_seconds, ttl_seconds // 2)
+        self.retry_after_seconds = retry_after_seconds
+        self._entries: dict[tuple, _CacheEntry] = {}
+        self._unavailable_until: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _ttl(self) -> str:
+        return f"{self.ttl_seconds}s"
+
+    def get(
+        self,
+        client,
+        personality: Personality,
+        model: str = MODEL,
+        grounded: bool = True,
+    ) -> str | None:
+        """Returns the name of the cached content for this personality,
+        creating or refreshing it as required, or None if caching isn't available.
+
+        Args:
+            client (genai.Client): The authenticated Vertex AI client.
+            personality (Personality): The personality whose system prompt is cached.
+            model (str): Cached content can only be used with the model it was created for.
+            grounded (bool): Whether the cached content includes the Google Search tool.
+        """
+        key = (personality.name, model, grounded)
+        now = time.monotonic()
+
+        entry = self._entries.get(key)
+        if entry and now < entry.expires_at - self.refresh_margin_seconds:
+            return entry.name  # Fast path, without taking the lock
+
+        if now < self._unavailable_until.get(key, 0):
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)  # Another session may have beaten us to it
+            if entry and now < entry.expires_at - self.refresh_margin_seconds:
+                return entry.name
+
+            try:
+                if entry and now < entry.expires_at:
+                    entry = self._refresh(client, personality, key, entry)
+                else:
+                    entry = self._create(client, personality, key)
+                self._entries[key] = entry
+                return entry.name
+            except Exception as e:
+                logger.warning(
+                    f"Context caching unavailable for {personality.name} on {model}. "
+                    f"Sending system prompt with each request. {e}"
+                )
+                self._entries.pop(key, None)
+                self._unavailable_until[key] = now + self.retry_after_seconds
+                return None
+
+    def _create(self, client, personality: Personality, key: tuple) -> _CacheEntry:
+        _, model, grounded = key
+        suffix = "" if grounded else "-ungrounded"
+        cached = client.caches.create(
+            model=model,
+            config=CreateCachedContentConfig(
+                display_name=f"rickbot-{personality.name.lower()}{suffix}",
+                system_instruction=Part.from_text(text=personality.system_instruction),
+                tools=get_tools() if grounded else None,
+                ttl=self._ttl,
+            ),
+        )
+        logger.info(f"Created cached content {cached.name} for {personality.name}")
+        return _CacheEntry(
+            name=cached.name, expires_at=time.monotonic() + self.ttl_seconds
+        )
+
+    def _refresh(
+        self, client, personality: Personality, key: tuple, entry: _CacheEntry
+    ) -> _CacheEntry:
+        try:
+            client.caches.update(
+                name=entry.name, config=UpdateCachedContentConfig(ttl=self._ttl)
+            )
+        except Exception as e:
+            logger.info(
+                f"Unable to refresh cached content {entry.name}. Recreating. {e}"
+            )
+            return self._create(client, personality, key)
+        logger.debug(f"Refreshed cached content {entry.name}")
+        return _CacheEntry(
+            name=entry.name, expires_at=time.monotonic() + self.ttl_seconds
+        )
+
+    def invalidate(self, personality_name: str):
+        """Forget the cached content for a personality, so that it is recreated on next use.
+        The old entry is left to expire on the server."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == personality_name]:
+                del self._entries[key]
+            for key in [k for k in self._unavailable_until if k[0] == personality_name]:
+                del self._unavailable_until[key]
@@ -0,0 +1,210 @@
+"""Rate limiting of model requests, per user and globally, and per-user token budgets.
+
+Limits are held in storage given by a `limits` storage URI. Use `memory://` for a single
+instance (and in tests), or a shared store such as `redis://host:6379` or
+`memcached://host:11211` so that limits apply across all instances of the service.
+The clients for these are installed with the `limits[redis,memcached]` extras.
+Token budgets are charged after each response, with the tokens it actually used. Once a
+budget is used up, the user's requests are rejected until the window frees up.
+If the storage can't be used, limits are held in memory instead, and only apply per instance.
+"""
+
+import threading
+from typing import TYPE_CHECKING
+
+from config import logger
+from metrics import rate_limit_rejections
+
+if TYPE_CHECKING:
+    from limits import RateLimitItem
+    from limits.storage import Storage
+    from limits.strategies import RateLimiter as LimitsStrategy
+
+KEY_PREFIX = "rickbot"
+
+
+def _create_strategy(storage) -> "LimitsStrategy":
+    """Use the most accurate strategy that the storage supports."""
+    # pylint: disable=import-outside-toplevel
+    from limits.strategies import (
+        FixedWindowRateLimiter,
+        MovingWindowRateLimiter,
+        SlidingWindowCounterRateLimiter,
+    )
+
+    for strategy in (
+        MovingWindowRateLimiter,
+        SlidingWindowCounterRateLimiter,
+        FixedWindowRateLimiter,
+    ):
+        try:
+            return strategy(storage)
+        except NotImplementedError:
+            continue
+    raise ValueError(f"No rate limiting strategy supported by {type(storage).__name__}")
+
+
+def _create_storage(storage_uri: str) -> "Storage":
+    """The storage for this URI, checked to be usable, or else in-memory storage."""
+    # pylint: disable=import-outside-toplevel
+    from limits.storage import storage_from_string
+
+    scheme = storage_uri.split(":", 1)[0]  # The URI may include a password
+    try:
+        storage = storage_from_string(storage_uri)
+        if not storage.check():
+            raise ConnectionError(f"Unable to connect to {scheme} storage")
+        return storage
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error(
+            f"Unable to use {scheme} rate limit storage. Falling back to memory://, "
+            f"so limits only apply to this instance. {e}"
+        )
+        return storage_from_string("memory://")
+
+
+class RateLimiter:
+    """Applies per-user limits and a global limit to model requests.
+    The storage is connected on first use, so that `limits` isn't imported at startup.
+    """
+
+    def __init__(
+        self,
+        storage_uri: str = "memory://",
+        global_limit: str = "",
+        user_limits: str = "",
+        token_limits: str = "",
+    ):
+        """
+        Args:
+            storage_uri (str): A `limits` storage URI, e.g. memory:// or redis://host:6379
+            global_limit (str): Limit across all users, e.g. "120/minute". Empty for no limit.
+            user_limits (str): Limits for each user, e.g. "10/minute;100/hour". Empty for no limit.
+            token_limits (str): Token budgets for each user, e.g. "100000/hour".
+                Empty for no budget.
+        """
+        self.storage_uri = storage_uri
+        self._global_limit = global_limit
+        self._user_limits = user_limits
+        self._token_limits = token_limits
+        self._strategy: "LimitsStrategy | None" = None
+        self.global_limit: "RateLimitItem | None" = None
+        self.user_limits: "list[RateLimitItem]" = []
+        self.token_limits: "list[RateLimitItem]" = []
+        self.rejections = 0
+        self._lock = threading.Lock()
+
+    def _setup(self):
+        # pylint: disable=import-outside-toplevel
+        from limits import parse, parse_many
+
+        self.global_limit = parse(self._global_limit) if self._global_limit else None
+        self.user_limits = parse_many(self._user_limits) if self._user_limits else []
+        self.token_limits = parse_many(self._token_limits) if self._token_limits else []
+        self._strategy = _create_strategy(_create_storage(self.storage_uri))
+        logger.info(
+            f"Rate limiter using {type(self._strategy.storage).__name__} "
+            f"with {type(self._strategy).__name__}. "
+            f"Global: {self._global_limit or 'none'}, "
+            f"per user: {self._user_limits or 'none'}, "
+            f"tokens per user: {self._token_limits or 'none'}"
+        )
+
+    def connect(self):
+        """Connect to the storage now, rather than on first use."""
+        _ = self.strategy
+
+    @property
+    def strategy(self) -> "LimitsStrategy":
+        """The `limits` strategy, created on first use."""
+        if self._strategy is None:
+            with self._lock:
+                if self._strategy is None:
+                    self._setup()
+        return self._strategy  # type: ignore
+
+    def _limits_for(
+        self, identity: str
+    ) -> "list[tuple[RateLimitItem, tuple[str, ...]]]":
+        checks = [(limit, (KEY_PREFIX, "user", identity)) for limit in self.user_limits]
+        if self.global_limit:
+            checks.append((self.global_limit, (KEY_PREFIX, "global")))
+        return checks
+
+    def _token_keys(self, identity: str) -> tuple[str, ...]:
+        return (KEY_PREFIX, "tokens", identity)
+
+    def hit(self, identity: str, cost: int = 1) -> bool:
+        """Record a request from this user, if it is within all limits,
+        and the user has token budget left.
+
+        Args:
+            identity (str): Identifies the user, e.g. their email address or session ID.
+            cost (int): How much of each limit the request uses.
+
+        Returns:
+            bool: True if the request is allowed, False if it is rate limited.
+        """
+        strategy = self.strategy
+        checks = self._limits_for(identity)
+        try:
+            # Test every limit first, so a rejected request doesn't use up the others
+            allowed = (
+                all(
+                    strategy.test(limit, *self._token_keys(identity))
+                    for limit in self.token_limits
+                )
+                and all(
+                    strategy.test(limit, *keys, cost=cost) for limit, keys in checks
+                )
+                and all(strategy.hit(limit, *keys, cost=cost) for limit, keys in checks)
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning(f"Rate limit storage unavailable. Allowing request. {e}")
+            return True
+
+        if not allowed:
+            self.rejections += 1
+            rate_limit_rejections.inc()
+            logger.debug(f"Rate limited: {identity}")
+        return allowed
+
+    def charge_tokens(self, identity: str, tokens: int):
+        """Charge the tokens used by a response to the user's token budgets.
+        A response may take a budget past its limit, in which case the budget is
+        used up, and the user's next requests are rejected."""
+        if not tokens:
+            return
+        strategy = self.strategy
+        keys = self._token_keys(identity)
+        try:
+            for limit in self.token_limits:
+                remaining = strategy.get_window_stats(limit, *keys).remaining
+                if remaining:
+                    strategy.hit(limit, *keys, cost=min(tokens, remaining))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning(f"Rate limit storage unavailable. Tokens not charged. {e}")
+
+    def tokens_remaining(self, identity: str) -> int | None:
+        """The user's smallest remaining token budget, or None if there are no budgets."""
+        if not self._token_limits:
+            return None
+        strategy = self.strategy
+        try:
+            return min(
+                strategy.get_window_stats(limit, *self._token_keys(identity)).remaining
+                for limit in self.token_limits
+            )
+        except Exception:  # pylint: disable=broad-exception-caught
+            return None
+
+
+def create_rate_limiter(config) -> RateLimiter:
+    """The rate limiter for this configuration. The Streamlit app and the API use the
+    same limits and keys, so they share limits when the storage is shared."""
+    return RateLimiter(
+        storage_uri=config.rate_limit_storage_uri,
+        global_limit=f"{config.rate_limit}/minute" if config.rate_limit else "",
+        user_limits=config.user_rate_limit,
+        token_limits=config.user_token_limit,
+    )
@@ -0,0 +1,265 @@
+"""Retries, hedging and regional failover for model streams.
+
+A request is retried with jittered exponential backoff if it fails with a transient error
+before its first chunk arrives. Once the first chunk has been received, errors are not
+retried, since the response is already being shown. Each retry goes to the next client
+in an ordered `ClientPool`, e.g. one per region, skipping clients that keep failing.
+Optionally, if the first chunk is slow to arrive, a hedged request is sent to the next
+client, and whichever responds first is used."""
+
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable
+
+from config import logger
+from metrics import counter, gauge
+
+RETRYABLE_CODES = frozenset((408, 429, 500, 502, 503, 504))
+
+generation_retries = counter(
+    "rickbot_generation_retries_total", "Requests retried after a transient error."
+)
+generation_hedges = counter(
+    "rickbot_generation_hedges_total", "Hedged requests sent.", ("client",)
+)
+client_healthy = gauge(
+    "rickbot_client_healthy",
+    "Whether a client is in use (1) or cooling down (0).",
+    ("client",),
+)
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Whether an error is transient, and the request may succeed if retried."""
+    # Imported here, as they're only needed once a request has been made
+    import httpx  # pylint: disable=import-outside-toplevel
+    from google.genai.errors import APIError  # pylint: disable=import-outside-toplevel
+
+    if isinstance(e, APIError):
+        return e.code in RETRYABLE_CODES
+    return isinstance(e, (httpx.TransportError, ConnectionError))
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How requests are retried and hedged."""
+
+    max_attempts: int = 3
+    base_delay: float = 0.5  # Seconds before the first retry, doubling each time
+    max_delay: float = 8.0
+    hedge_after: float = 0  # Seconds without a first chunk before hedging. 0 = never
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter backoff before this retry (attempt 1 is the first retry)."""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+
+class _Entry:
+    def __init__(self, name: str, client):
+        self.name = name
+        self.client = client
+        self.failures = 0  # Consecutive transient failures
+        self.unhealthy_until = 0.0
+
+
+class ClientPool:
+    """An ordered list of clients, e.g. the primary region and then fallback regions,
+    with health tracking. A client that fails repeatedly is skipped for a cooldown period.
+    Safe to share between sessions."""
+
+    def __init__(
+        self,
+        clients: list[tuple[str, Any]],
+        failure_threshold: int = 3,
+        cooldown_seconds: float = 30,
+    ):
+        """
+        Args:
+            clients (list[tuple[str, genai.Client]]): Names (e.g. regions) and clients, in order of preference.
+            failure_threshold (int): Consecutive transient failures before a client is skipped.
+            cooldown_seconds (float): How long an unhealthy client is skipped for.
+        """
+        self._entries = [_Entry(name, client) for name, client in clients]
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        for entry in self._entries:
+            client_healthy.set(1, client=entry.name)
+
+    @classmethod
+    def single(cls, client) -> "ClientPool":
+        """A pool of one client, which can be retried but not failed over."""
+        return cls([("default", client)])
+
+    @property
+    def first(self) -> _Entry:
+        """The preferred client."""
+        return self._entries[0]
+
+    def candidates(self) -> list[_Entry]:
+        """Clients in the order they should be tried: healthy ones first."""
+        now = time.monotonic()
+        healthy = [e for e in self._entries if e.unhealthy_until <= now]
+        return healthy + [e for e in self._entries if e.unhealthy_until > now]
+
+    def healthy(self, name: str) -> bool:
+        """Whether the named client is currently in use."""
+        entry = next(e for e in self._entries if e.name == name)
+        return entry.unhealthy_until <= time.monotonic()
+
+    def record_success(self, entry: _Entry):
+        with self._lock:
+            if entry.unhealthy_until:
+                logger.info(f"Client {entry.name} has recovered.")
+                client_healthy.set(1, client=entry.name)
+            entry.failures = 0
+            entry.unhealthy_until = 0.0
+
+    def record_failure(self, entry: _Entry):
+        with self._lock:
+            entry.failures += 1
+            if entry.failures >= self.failure_threshold:
+                if entry.unhealthy_until <= time.monotonic():
+                    logger.warning(
+                        f"Client {entry.name} failed {entry.failures} times. "
+                        f"Skipping it for {self.cooldown_seconds}s."
+                    )
+                entry.unhealthy_until = time.monotonic() + self.cooldown_seconds
+                client_healthy.set(0, client=entry.name)
+
+
+async def _close(stream):
+    aclose = getattr(stream, "aclose", None)
+    if aclose:
+        await aclose()
+
+
+async def _first_chunk(
+    pool: ClientPool, entry: _Entry, failed: set, model: str, contents, config
+) -> tuple[Any, AsyncIterator]:
+    """Start a stream on this client and wait for its first chunk, which is None
+    if the response is empty. If it fails, the client is added to `failed`."""
+    try:
+        stream = await entry.client.aio.models.generate_content_stream(
+            model=model, contents=contents, config=config
+        )
+        try:
+            first = await anext(stream, None)
+        except BaseException:
+            await _close(stream)
+            raise
+    except Exception as e:
+        failed.add(entry)
+        if is_retryable(e):
+            pool.record_failure(entry)
+        raise
+    pool.record_success(entry)
+    return first, stream
+
+
+async def _attempt(
+    pool: ClientPool,
+    policy: RetryPolicy,
+    failed: set,
+    model: str,
+    contents,
+    configs: tuple,
+) -> tuple[Any, AsyncIterator]:
+    """One attempt, hedged to the next client if the first chunk is slow.
+    Clients that have already failed this request are tried last."""
+    candidates = pool.candidates()
+    candidates = [e for e in candidates if e not in failed] + [
+        e for e in candidates if e in failed
+    ]
+
+    def start(entry: _Entry) -> asyncio.Task:
+        config = configs[0] if entry is pool.first else configs[1]
+        return asyncio.create_task(
+            _first_chunk(pool, entry, failed, model, contents, config)
+        )
+
+    tasks = [start(candidates[0])]
+    winner = None
+    try:
+        if not policy.hedge_after or len(candidates) < 2:
+            winner = tasks[0]
+            return await winner
+
+        done, _ = await asyncio.wait(tasks, timeout=policy.hedge_after)
+        if not done:
+            hedge = candidates[1]
+            generation_hedges.inc(client=hedge.name)
+            logger.debug(
+                f"No response after {policy.hedge_after}s. Hedging to {hedge.name}."
+            )
+            tasks.append(start(hedge))
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result()
+        raise tasks[0].exception() or tasks[-1].exception()  # type: ignore
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                await _close(task.result()[1])  # The slower of two responses
+
+
+async def open_stream(
+    pool: ClientPool,
+    policy: RetryPolicy,
+    model: str,
+    contents,
+    config,
+    fallback_config=None,
+    on_error: Callable[[BaseException], None] | None = None,
+) -> tuple[Any, AsyncIterator]:
+    """Start a model stream, retrying transient errors until the first chunk arrives.
+
+    Args:
+        pool (ClientPool): The clients to use, in order of preference.
+        policy (RetryPolicy): How to retry and hedge.
+        model (str): The model to use.
+        contents (list[Content]): The conversation history.
+        config (GenerateContentConfig): The configuration for the model.
+        fallback_config (GenerateContentConfig, optional): The configuration for any client
+            other than the first, e.g. without context caching, which is regional.
+        on_error (Callable, optional): Called with the error of each failed attempt,
+            e.g. to observe throttling.
+
+    Returns:
+        tuple: The first chunk (None if the response is empty), and the stream of the
+            remaining chunks.
+
+    Raises:
+        Exception: The last error, if all attempts fail or the error isn't transient.
+    """
+    configs = (config, fallback_config or config)
+    failed: set[_Entry] = set()
+    for attempt in range(policy.max_attempts):
+        try:
+            return await _attempt(pool, policy, failed, model, contents, configs)
+        except Exception as e:
+            if on_error:
+                on_error(e)
+            if not is_retryable(e) or attempt + 1 >= policy.max_attempts:
+                raise
+            delay = policy.backoff(attempt + 1)
+            generation_retries.inc()
+            logger.warning(f"Generation failed: {e}. Retrying in {delay:.2f}s.")
+            await asyncio.sleep(delay)
+    raise AssertionError("Unreachable")
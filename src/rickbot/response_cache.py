@@ -0,0 +1,152 @@
+"""Cache of responses to repeated opening prompts.
+
+Lots of users open with the same prompt, such as "who are you?", for the same personality.
+Responses to first-turn, attachment-free prompts are cached by personality, temperature bucket,
+model and normalised prompt, with LRU and TTL eviction. Grounded responses aren't cached,
+since they may be about current events. Cached responses are replayed as a stream
+of chunks, so they render just like a response from the model."""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator
+
+from config import logger
+from metrics import counter
+from personality import Personality
+
+REPLAY_CHUNK_CHARS = 40
+
+response_cache_hits = counter(
+    "rickbot_response_cache_hits_total", "Response cache hits."
+)
+response_cache_misses = counter(
+    "rickbot_response_cache_misses_total", "Response cache misses."
+)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalise_prompt(prompt: str) -> str:
+    """Normalise case, punctuation and whitespace, so that trivially different prompts match."""
+    prompt = _PUNCTUATION.sub("", prompt.lower())
+    return _WHITESPACE.sub(" ", prompt).strip()
+
+
+class ResponseCache:
+    """An LRU and TTL cache of responses to opening prompts. Safe to share between sessions."""
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: int = 3600):
+        """
+        Args:
+            max_entries (int): Least recently used responses are evicted beyond this number.
+            ttl_seconds (int): How long a response remains in the cache.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def key_for(
+        personality: Personality,
+        chat_history: list[dict],
+        model: str,
+        grounded: bool = False,
+    ) -> tuple | None:
+        """The cache key for this request, or None if the response shouldn't be cached.
+        Only the first prompt in a conversation, without an attachment or grounding,
+        is cacheable."""
+        if grounded or len(chat_history) != 1:
+            return None
+        message = chat_history[0]
+        if message["role"] != "user" or message.get("attachment"):
+            return None
+        prompt = normalise_prompt(message["content"])
+        if not prompt:
+            return None
+        return (
+            personality.name,
+            round(personality.temperature, 1),
+            model,
+            grounded,
+            prompt,
+        )
+
+    def get(self, key: tuple) -> str | None:
+        """The cached response for this key, if present and not expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() < entry[0]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                response_cache_hits.inc()
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            response_cache_misses.inc()
+            return None
+
+    def put(self, key: tuple, response: str):
+        """Cache a response."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, personality_name: str):
+        """Forget the cached responses of a personality, e.g. after its prompt changes."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == personality_name]:
+                del self._entries[key]
+
+    @staticmethod
+    def replay(response: str) -> Iterator[str]:
+        """Replay a cached response as a stream of chunks."""
+        for i in range(0, len(response), REPLAY_CHUNK_CHARS):
+            yield response[i : i + REPLAY_CHUNK_CHARS]
+
+    def stream(
+        self, key: tuple | None, response_stream: Iterator[str]
+    ) -> Iterator[str]:
+        """Stream the cached response for this key if there is one.
+        Otherwise stream the model's response, caching it once it completes.
+
+        Args:
+            key (tuple | None): From key_for(). If None, the response is not cached.
+            response_stream (Iterator[str]): The model's response stream.
+                Since this is a lazy generator, no request is made on a cache hit.
+
+        Yields:
+            str: Response text chunks.
+        """
+        if key is None:
+            yield from response_stream
+            return
+
+        cached = self.get(key)
+        if cached is not None:
+            logger.debug(f"Response cache hit. Hit rate: {self.hit_rate:.0%}")
+            yield from self.replay(cached)
+            return
+
+        chunks = []
+        for chunk in response_stream:
+            chunks.append(chunk)
+            yield chunk
+        if chunks:  # Only cache responses that streamed to completion
+            self.put(key, "".join(chunks))
@@ -0,0 +1,82 @@
+"""Routing of prompts to a personality's strong or fast model.
+
+Short, attachment-free chit-chat is sent to the personality's fast model, if it has one.
+Anything with attachments, or that looks complex, goes to its main model.
+Each decision is counted by reason, so that the thresholds can be tuned
+against the latency metrics, which are labelled by model."""
+
+import re
+from dataclasses import dataclass
+
+from config import logger
+from metrics import counter
+from personality import Personality
+
+# Prompts that ask for reasoning, analysis or code deserve the stronger model
+COMPLEX_PATTERN = re.compile(
+    r"```|\b(explain|why|how (does|do|can|would)|compare|analy[sz]e|calculate|"
+    r"code|debug|step[- ]by[- ]step|prove|summari[sz]e|translate|write|plan|design)\b",
+    re.IGNORECASE,
+)
+
+route_decisions = counter(
+    "rickbot_route_decisions_total",
+    "Model routing decisions.",
+    ("personality", "model", "reason"),
+)
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """The model chosen for a prompt, and why."""
+
+    model: str
+    reason: str
+
+    @property
+    def is_fast(self) -> bool:
+        return self.reason == "chit_chat"
+
+
+class ModelRouter:
+    """Chooses the model for each prompt with cheap local heuristics."""
+
+    def __init__(self, max_chars: int = 200, context_messages: int = 6):
+        """
+        Args:
+            max_chars (int): Longest prompt that can be sent to the fast model.
+            context_messages (int): Recent messages checked for attachments.
+        """
+        self.max_chars = max_chars
+        self.context_messages = context_messages
+
+    def route(
+        self,
+        personality: Personality,
+        model: str,
+        prompt: str,
+        chat_history: list[dict],
+    ) -> RouteDecision:
+        """Choose the model for the latest prompt.
+
+        Args:
+            personality (Personality): The personality responding.
+            model (str): The personality's main model.
+            prompt (str): The latest prompt.
+            chat_history (list[dict]): The session's messages, ending with the latest prompt.
+        """
+        recent = chat_history[-self.context_messages :]
+        if not personality.fast_model:
+            reason = "no_fast_model"
+        elif any(message.get("attachment") for message in recent):
+            reason = "attachment"
+        elif len(prompt) > self.max_chars:
+            reason = "long_prompt"
+        elif COMPLEX_PATTERN.search(prompt):
+            reason = "complex"
+        else:
+            model, reason = personality.fast_model, "chit_chat"
+
+        route_decisions.inc(personality=personality.name, model=model, reason=reason)
+        logger.debug(f"Routed prompt for {personality.name} to {model}: {reason}")
+        return RouteDecision(model=model, reason=reason)
@@ -0,0 +1,80 @@
+"""Timing of the application's cold start.
+
+The app script marks each phase of its first run in this process: importing modules,
+creating the shared resources, and rendering the first page. The timings are reported once,
+in the log and as a gauge, along with whether the Gen AI SDK has been imported yet."""
+
+import importlib
+import sys
+import threading
+import time
+
+_START = time.perf_counter()
+
+from config import logger  # pylint: disable=wrong-import-position
+from metrics import gauge  # pylint: disable=wrong-import-position
+
+startup_seconds = gauge(
+    "rickbot_startup_seconds",
+    "Seconds from the start of the app script's first run to the end of each phase.",
+    ("phase",),
+)
+
+
+class StartupTimer:
+    """Records the end of each startup phase, during the first run of the app script."""
+
+    def __init__(self, start: float):
+        self.start = start
+        self.marks: dict[str, float] = {}
+        self.reported = False
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str):
+        """Record the end of a phase, unless the startup has already been reported."""
+        with self._lock:
+            if not self.reported:
+                self.marks.setdefault(phase, time.perf_counter() - self.start)
+
+    def report(self) -> dict[str, float] | None:
+        """Log the startup timings, the first time this is called.
+
+        Returns:
+            dict[str, float] | None: Seconds to the end of each phase, or None if the
+                startup has already been reported.
+        """
+        with self._lock:
+            if self.reported:
+                return None
+            self.reported = True
+
+        for phase, seconds in self.marks.items():
+            startup_seconds.set(seconds, phase=phase)
+        timings = ", ".join(f"{phase} {s:.3f}s" for phase, s in self.marks.items())
+        logger.info(
+            f"Startup: {timings}. "
+            f"Gen AI SDK imported: {'google.genai' in sys.modules}"
+        )
+        return self.marks
+
+    @staticmethod
+    def prewarm(modules: list[str]):
+        """Import these modules in a background thread."""
+
+        def run():
+            started = time.perf_counter()
+            try:
+                for module in modules:
+                    importlib.import_module(module)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.warning(f"Unable to prewarm {module}: {e}")
+                return
+            logger.info(
+                f"Prewarmed {', '.join(modules)} "
+                f"in {time.perf_counter() - started:.3f}s"
+            )
+
+        threading.Thread(target=run, name="rickbot-prewarm", daemon=True).start()
+
+
+startup = StartupTimer(_START)
@@ -0,0 +1,162 @@
+"""Token accounting, from the usage metadata of model responses.
+
+Every turn resends the system prompt and the history, so input tokens grow with each turn.
+Each response's usage is recorded by personality and model, and split into the system prompt,
+the rest of the prompt, context cache hits, output and thinking. The system prompt's token
+count is counted once per personality, prompt version and model, and then reused.
+Usage is also charged to the user's token budgets, if any are configured."""
+
+import hashlib
+import threading
+from dataclasses import dataclass
+
+from config import logger
+from metrics import counter, histogram
+from personality import Personality
+from rate_limit import RateLimiter
+
+TOKEN_BUCKETS = tuple(2**n for n in range(8, 22))  # 256 to 2M tokens
+
+tokens_total = counter(
+    "rickbot_tokens_total",
+    "Tokens used by model requests, by kind.",
+    ("personality", "model", "kind"),
+)
+request_tokens = histogram(
+    "rickbot_request_tokens",
+    "Total tokens used by each model request.",
+    ("personality", "model"),
+    buckets=TOKEN_BUCKETS,
+)
+
+
+@dataclass(frozen=True)
+class TokenUsage:
+    """Tokens used by one request, or summed over several."""
+
+    prompt: int = 0  # Input tokens, including the system prompt and history
+    system_prompt: int = 0  # Of the input tokens, those of the system prompt
+    cached: int = 0  # Of the input tokens, those served from a context cache
+    output: int = 0
+    thoughts: int = 0
+    requests: int = 0
+
+    @property
+    def total(self) -> int:
+        return self.prompt + self.output + self.thoughts
+
+    def __add__(self, other: "TokenUsage") -> "TokenUsage":
+        return TokenUsage(
+            prompt=self.prompt + other.prompt,
+            system_prompt=self.system_prompt + other.system_prompt,
+            cached=self.cached + other.cached,
+            output=self.output + other.output,
+            thoughts=self.thoughts + other.thoughts,
+            requests=self.requests + other.requests,
+        )
+
+    @classmethod
+    def from_metadata(cls, metadata, system_prompt: int = 0) -> "TokenUsage":
+        """The usage reported by a response's `usage_metadata`."""
+        prompt = metadata.prompt_token_count or 0
+        return cls(
+            prompt=prompt,
+            system_prompt=min(system_prompt, prompt),
+            cached=metadata.cached_content_token_count or 0,
+            output=metadata.candidates_token_count or 0,
+            thoughts=metadata.thoughts_token_count or 0,
+            requests=1,
+        )
+
+
+class SystemPromptTokens:
+    """Counts the tokens in each personality's system prompt, once per prompt version
+    and model. Safe to share between sessions."""
+
+    def __init__(self):
+        self._counts: dict[tuple[str, str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, client, personality: Personality, model: str) -> int:
+        """The token count of the personality's system prompt, for this model.
+        Estimated from its length if the model can't count it."""
+        prompt = personality.system_instruction
+        key = (personality.name, model, hashlib.sha256(prompt.encode()).hexdigest())
+        with self._lock:
+            if key in self._counts:
+                return self._counts[key]
+
+        try:
+            tokens = client.models.count_tokens(
+                model=model, contents=prompt
+            ).total_tokens
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning(f"Unable to count system prompt tokens for {model}: {e}")
+            tokens = None
+        if tokens is None:
+            from history import (  # pylint: disable=import-outside-toplevel
+                estimate_tokens,
+            )
+
+            tokens = estimate_tokens(prompt)
+        logger.debug(f"{personality.name} system prompt: {tokens} tokens on {model}")
+        with self._lock:
+            self._counts[key] = tokens
+        return tokens
+
+
+class TokenAccountant:
+    """Records the token usage of responses, and charges it to users' token budgets.
+    Safe to share between sessions."""
+
+    def __init__(
+        self,
+        system_prompt_tokens: SystemPromptTokens | None = None,
+        rate_limiter: RateLimiter | None = None,
+    ):
+        """
+        Args:
+            system_prompt_tokens (SystemPromptTokens, optional): Cached system prompt counts.
+            rate_limiter (RateLimiter, optional): Holds the users' token budgets.
+        """
+        self.system_prompt_tokens = system_prompt_tokens or SystemPromptTokens()
+        self.rate_limiter = rate_limiter
+
+    def record(
+        self,
+        client,
+        personality: Personality,
+        model: str,
+        metadata,
+        identity: str = "",
+    ) -> TokenUsage:
+        """Account for a response's usage metadata.
+
+        Args:
+            client (genai.Client): For counting the system prompt's tokens, once.
+            personality (Personality): The personality that responded.
+            model (str): The model that responded.
+            metadata (GenerateContentResponseUsageMetadata): The response's usage.
+            identity (str, optional): The user, to charge their token budget.
+
+        Returns:
+            TokenUsage: The request's usage.
+        """
+        usage = TokenUsage.from_metadata(
+            metadata, self.system_prompt_tokens.count(client, personality, model)
+        )
+        labels = {"personality": personality.name, "model": model}
+        tokens_total.inc(usage.system_prompt, kind="system_prompt", **labels)
+        tokens_total.inc(usage.prompt - usage.system_prompt, kind="history", **labels)
+        tokens_total.inc(usage.cached, kind="cached", **labels)
+        tokens_total.inc(usage.output, kind="output", **labels)
+        tokens_total.inc(usage.thoughts, kind="thoughts", **labels)
+        request_tokens.observe(usage.total, **labels)
+        if self.rate_limiter and identity:
+            self.rate_limiter.charge_tokens(identity, usage.total)
+        logger.debug(
+            f"Tokens for {personality.name} on {model}: {usage.prompt} in "
+            f"({usage.system_prompt} system prompt, {usage.cached} cached), "
+            f"{usage.output} out, {usage.thoughts} thinking"
+        )
+        return usage
@@ -1,6 +1,166 @@
 """Utility functions"""
 
-from google.cloud import secretmanager
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Protocol
+
+from config import logger
+
+
+class SecretBackend(Protocol):
+    """Somewhere secrets can be read from."""
+
+    def access(self, name: str) -> tuple[str, str]:
+        """Return the payload and version number of the secret version with this resource name."""
+        ...  # pylint: disable=unnecessary-ellipsis
+
+
+class SecretManagerBackend:
+    """Reads secrets from Google Secret Manager, using one client shared by all callers."""
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google.cloud import (  # pylint: disable=import-outside-toplevel
+                        secretmanager,
+                    )
+
+                    self._client = secretmanager.SecretManagerServiceClient()
+        return self._client
+
+    def access(self, name: str) -> tuple[str, str]:
+        response = self.client.access_secret_version(request={"name": name})
+        payload = response.payload.data.decode("UTF-8")
+        return payload, response.name.rsplit("/", 1)[-1]
+
+
+class FakeSecretBackend:
+    """An in-memory secret backend, for local development and tests."""
+
+    def __init__(
+        self, secrets: dict[str, str] | None = None, default: str | None = None
+    ):
+        """
+        Args:
+            secrets (dict[str, str]): Secret payloads, keyed by secret ID.
+            default (str, optional): Payload of any other secret. If None, other secrets aren't found.
+        """
+        self.secrets = dict(secrets or {})
+        self.default = default
+        self.calls = 0
+
+    def access(self, name: str) -> tuple[str, str]:
+        self.calls += 1
+        secret_id = name.split("/")[3]
+        if secret_id in self.secrets:
+            return self.secrets[secret_id], "1"
+        if self.default is not None:
+            return self.default, "1"
+        raise KeyError(f"Secret {name} not found")
+
+
+class SecretCache:
+    """Caches secrets read from a backend, including failures, for a limited time."""
+
+    def __init__(
+        self,
+        backend: SecretBackend,
+        ttl_seconds: int = 3600,
+        negative_ttl_seconds: int = 60,
+    ):
+        """
+        Args:
+            backend (SecretBackend): Where secrets are read from.
+            ttl_seconds (int): How long to cache secrets.
+            negative_ttl_seconds (int): How long to cache failures to read a secret.
+        """
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        # name -> when it was read, and the secret or the error
+        self._entries: dict[str, tuple[float, tuple[str, str] | Exception]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str) -> tuple[str, str]:
+        """Return the payload and version of the secret version with this resource name.
+
+        Raises:
+            Exception: The backend's exception, if the secret can't be read.
+        """
+        # Concurrent callers for the same secret wait for a single read
+        with self._lock_for(name):
+            entry = self._entries.get(name)
+            if entry is None or self._expired(entry):
+                try:
+                    entry = (time.monotonic(), self.backend.access(name))
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    entry = (time.monotonic(), e)
+                self._entries[name] = entry
+
+        if isinstance(entry[1], Exception):
+            raise entry[1]
+        return entry[1]
+
+    def _expired(self, entry: tuple[float, tuple[str, str] | Exception]) -> bool:
+        read_at, value = entry
+        ttl = (
+            self.negative_ttl_seconds
+            if isinstance(value, Exception)
+            else self.ttl_seconds
+        )
+        return time.monotonic() >= read_at + ttl
+
+    def prefetch(self, names: Iterable[str], max_workers: int = 8):
+        """Read these secrets concurrently in the background, without blocking the caller."""
+        executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="secret-prefetch"
+        )
+        for name in names:
+            executor.submit(self._prefetch_one, name)
+        executor.shutdown(wait=False)
+
+    def _prefetch_one(self, name: str):
+        try:
+            self.get(name)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning(f"Unable to prefetch secret {name}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Secrets are read as personalities are imported, before the config is loaded.
+# The config's TTLs are applied by `configure_secret_cache`, including to secrets already read.
+_secret_cache = SecretCache(SecretManagerBackend())
+
+
+def configure_secret_cache(ttl_seconds: int, negative_ttl_seconds: int):
+    """Set how long secrets, and failures to read them, are cached."""
+    _secret_cache.ttl_seconds = ttl_seconds
+    _secret_cache.negative_ttl_seconds = negative_ttl_seconds
+
+
+def set_secret_backend(backend: SecretBackend, **cache_args):
+    """Replace the secret backend, e.g. with a FakeSecretBackend."""
+    global _secret_cache  # pylint: disable=global-statement
+    _secret_cache = SecretCache(backend, **cache_args)
+
+
+def secret_version_name(project_id: str, secret_id: str, version_id: str = "latest"):
+    return f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
 
 
 def retrieve_secret(project_id: str, secret_id: str, version_id: str = "latest") -> str:
@@ -8,8 +168,22 @@ def retrieve_secret(project_id: str, secret_id: str, version_id: str = "latest")
     Access the payload for the given secret version and return it.
     The calling service account must have the 'Secret Manager Secret Accessor' role.
     """
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
-    response = client.access_secret_version(request={"name": name})
-    payload = response.payload.data.decode("UTF-8")
+    payload, _ = retrieve_secret_version(project_id, secret_id, version_id)
     return payload
+
+
+def retrieve_secret_version(
+    project_id: str, secret_id: str, version_id: str = "latest"
+) -> tuple[str, str]:
+    """
+    Access the payload for the given secret version.
+    Returns the payload and the version it was read from, e.g. "3" when asking for "latest".
+    """
+    return _secret_cache.get(secret_version_name(project_id, secret_id, version_id))
+
+
+def prefetch_secrets(project_id: str, secret_ids: Iterable[str]):
+    """Read the latest versions of these secrets concurrently in the background."""
+    _secret_cache.prefetch(
+        secret_version_name(project_id, secret_id) for secret_id in secret_ids
+    )
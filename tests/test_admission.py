@@ -0,0 +1,149 @@
+"""Fair admission of model streams, and adaptive concurrency."""
+
+import asyncio
+
+import pytest
+from google.genai.errors import ClientError, ServerError
+
+import admission
+from admission import AdmissionController, QueueFullError
+
+
+def error(code: int):
+    error_class = ClientError if code < 500 else ServerError
+    return error_class(code, {"error": {"code": code, "message": "Injected"}})
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_admits_up_to_the_limit_then_queues():
+    async def run():
+        controller = AdmissionController(max_concurrency=2)
+        await controller.acquire("rick")
+        await controller.acquire("rick")
+        waiting = asyncio.create_task(controller.acquire("rick"))
+        await asyncio.sleep(0)
+        assert (controller.active, controller.queued) == (2, 1)
+        controller.release()
+        await waiting
+        assert (controller.active, controller.queued) == (2, 0)
+
+    asyncio.run(run())
+
+
+def test_users_take_turns():
+    admitted = []
+
+    async def request(controller, user, name):
+        await controller.acquire(user)
+        admitted.append(name)
+        await asyncio.sleep(0)
+        controller.release()
+
+    async def run():
+        controller = AdmissionController(max_concurrency=1)
+        await controller.acquire("holder")
+        tasks = [
+            asyncio.create_task(request(controller, user, name))
+            for user, name in [
+                ("rick", "rick-1"),
+                ("rick", "rick-2"),
+                ("rick", "rick-3"),
+                ("morty", "morty-1"),
+                ("summer", "summer-1"),
+            ]
+        ]
+        await asyncio.sleep(0)
+        controller.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert admitted == ["rick-1", "morty-1", "summer-1", "rick-2", "rick-3"]
+
+
+def test_reports_queue_position_taking_turns():
+    statuses = []
+
+    async def run():
+        controller = AdmissionController(max_concurrency=1, report_interval=60)
+        await controller.acquire("holder")
+        tasks = [asyncio.create_task(controller.acquire("rick")) for _ in range(2)]
+        await asyncio.sleep(0)
+        tasks.append(
+            asyncio.create_task(controller.acquire("morty", on_queued=statuses.append))
+        )
+        await asyncio.sleep(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert controller.queued == 0
+
+    asyncio.run(run())
+    assert statuses[0].position == 1  # Behind rick's first request only
+    assert statuses[0].eta_seconds is None  # No slot has been released yet
+
+
+def test_rejects_requests_when_the_queue_is_full():
+    async def run():
+        controller = AdmissionController(max_concurrency=1, max_queue=1)
+        await controller.acquire("rick")
+        waiting = asyncio.create_task(controller.acquire("rick"))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await controller.acquire("morty")
+        waiting.cancel()
+
+    asyncio.run(run())
+
+
+def test_halves_limit_when_throttled(clock):
+    controller = AdmissionController(max_concurrency=32, decrease_cooldown=5)
+    controller.record_error(error(429))
+    assert controller.limit == 16
+    controller.record_error(error(429))  # The same burst of 429s
+    assert controller.limit == 16
+    clock.now += 5
+    controller.record_error(error(429))
+    assert controller.limit == 8
+
+
+def test_ignores_other_errors(clock):
+    controller = AdmissionController(max_concurrency=32)
+    controller.record_error(error(503))
+    controller.record_error(error(400))
+    assert controller.limit == 32
+
+
+def test_limit_never_falls_below_minimum(clock):
+    controller = AdmissionController(max_concurrency=8, min_concurrency=3)
+    for _ in range(5):
+        controller.record_error(error(429))
+        clock.now += 10
+    assert controller.limit == 3
+
+
+def test_limit_grows_back_by_one_per_window(clock):
+    controller = AdmissionController(max_concurrency=20)
+    controller.record_error(error(429))
+    assert controller.limit == 10
+    for _ in range(10):
+        controller.record_success()
+    assert controller.limit == 10  # Not quite a full window yet
+    controller.record_success()
+    assert controller.limit == 11
+    for _ in range(1000):
+        controller.record_success()
+    assert controller.limit == 20
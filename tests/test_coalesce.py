@@ -0,0 +1,108 @@
+"""Coalescing of streamed chunks, by time and size."""
+
+import asyncio
+import time
+
+import pytest
+
+import coalesce
+from coalesce import ChunkCoalescer, FlushPolicy
+from engine import GenerationEngine
+from fake_client import FakeGenaiClient, FakeStreamSettings, fake_texts, make_chunk
+
+POLICY = FlushPolicy(min_interval=0.1, max_interval=0.5, ramp_chars=1000, max_chars=50)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(coalesce.time, "monotonic", clock)
+    return clock
+
+
+def test_first_chunk_is_flushed_immediately(clock):
+    coalescer = ChunkCoalescer(POLICY)
+    assert coalescer.add("Wubba ") == "Wubba "
+    assert coalescer.time_to_flush() is None
+
+
+def test_buffers_chunks_until_interval_elapses(clock):
+    coalescer = ChunkCoalescer(POLICY)
+    coalescer.add("Wubba ")
+    assert coalescer.add("lubba ") is None
+    assert coalescer.add("dub ") is None
+    assert coalescer.time_to_flush() == pytest.approx(0.1, abs=0.01)
+    clock.now += 0.2
+    assert coalescer.add("dub") == "lubba dub dub"
+    assert (coalescer.chunks_in, coalescer.flushes_out) == (4, 2)
+
+
+def test_flushes_when_buffer_is_full(clock):
+    coalescer = ChunkCoalescer(POLICY)
+    coalescer.add("Wubba ")
+    assert coalescer.add("x" * 30) is None
+    assert coalescer.add("y" * 20) == "x" * 30 + "y" * 20
+
+
+def test_interval_grows_with_response_length(clock):
+    coalescer = ChunkCoalescer(POLICY)
+    assert coalescer.interval == pytest.approx(0.1)
+    coalescer.add("x" * 500)
+    assert coalescer.interval == pytest.approx(0.3)
+    clock.now += 1
+    coalescer.add("x" * 500)
+    assert coalescer.interval == pytest.approx(0.5)
+
+
+def test_coalesced_stream_keeps_all_text(clock):
+    chunks = [f"chunk {i} " for i in range(20)]
+    flushed = list(coalesce.coalesce(iter(chunks), POLICY))
+    assert "".join(flushed) == "".join(chunks)
+    assert len(flushed) < len(chunks)
+
+
+def test_engine_coalesces_the_fake_stream():
+    settings = FakeStreamSettings(first_chunk_latency=0, chunk_latency=0)
+    engine = GenerationEngine(max_concurrency=1)
+    flushed = list(
+        engine.stream(FakeGenaiClient(settings), "model", [], None, flush_policy=POLICY)
+    )
+    assert "".join(flushed) == "".join(fake_texts(settings))
+    assert len(flushed) < settings.chunk_count
+
+
+class _StallingClient:
+    """A client whose responses stall after their second chunk."""
+
+    def __init__(self):
+        self.aio = self
+        self.models = self
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        async def stream():
+            yield make_chunk("Wubba ")
+            yield make_chunk("lubba ")
+            await asyncio.sleep(1)
+            yield make_chunk("dub dub")
+
+        return stream()
+
+
+def test_engine_flushes_buffered_text_while_the_model_stalls():
+    engine = GenerationEngine(max_concurrency=1)
+    start = time.monotonic()
+    arrivals = []
+    for text in engine.stream(
+        _StallingClient(), "model", [], None, flush_policy=POLICY
+    ):
+        arrivals.append((text, time.monotonic() - start))
+    assert [text for text, _ in arrivals] == ["Wubba ", "lubba ", "dub dub"]
+    assert arrivals[1][1] < 0.5  # Flushed during the stall, not with the next chunk
@@ -0,0 +1,111 @@
+"""Incremental, budgeted building of the history sent to the model."""
+
+import pytest
+
+from attachments import AttachmentStore
+from history import HistoryBuilder, estimate_tokens
+
+
+@pytest.fixture
+def store(tmp_path) -> AttachmentStore:
+    return AttachmentStore(tmp_path, max_bytes=10 * 1024 * 1024)
+
+
+def chat(turns: int, text: str = "x" * 400) -> list[dict]:
+    """Alternating user and assistant messages, of 100 tokens each."""
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{text}{i}"}
+        for i in range(turns)
+    ]
+
+
+def texts(contents) -> list[str]:
+    return [content.parts[0].text for content in contents]
+
+
+def test_converts_each_message_once():
+    history = chat(3)
+    builder = HistoryBuilder()
+    first = builder.build(history)
+    history.append({"role": "user", "content": "Another"})
+    second = builder.build(history)
+    assert len(second) == 4
+    assert all(a is b for a, b in zip(first, second))
+    assert builder.tokens == 3 * estimate_tokens(history[0]["content"]) + 2
+
+
+def test_skips_other_roles():
+    history = [{"role": "system", "content": "Hidden"}, *chat(2)]
+    assert texts(HistoryBuilder().build(history)) == texts(
+        HistoryBuilder().build(chat(2))
+    )
+
+
+def test_drops_oldest_turns_over_token_budget():
+    history = chat(7)
+    builder = HistoryBuilder(max_tokens=350)
+    contents = builder.build(history)
+    assert texts(contents) == [m["content"] for m in history[4:]]
+    assert contents[0].role == "user"
+    assert builder.tokens <= 350
+
+
+def test_always_sends_the_latest_turn():
+    builder = HistoryBuilder(max_tokens=10)
+    history = chat(3)
+    assert texts(builder.build(history)) == [history[-1]["content"]]
+
+
+def test_trimming_is_permanent():
+    history = chat(5)
+    builder = HistoryBuilder(max_tokens=350)
+    assert len(builder.build(history)) == 3
+    builder.max_tokens = 0
+    history.append({"role": "assistant", "content": "Done"})
+    assert len(builder.build(history)) == 4
+
+
+def test_strips_oldest_attachments_before_dropping_turns(store):
+    image = store.put(b"\x89PNG" + b"\0" * 4000, "image/png")
+    history = [
+        {"role": "user", "content": "Look", "attachment": image},
+        {"role": "assistant", "content": "Nice"},
+        {"role": "user", "content": "And this", "attachment": image},
+    ]
+    builder = HistoryBuilder(max_bytes=6000, attachment_store=store)
+    contents = builder.build(history)
+    assert texts(contents) == ["Look", "Nice", "And this"]
+    assert [len(content.parts) for content in contents] == [1, 1, 2]
+    assert builder.size_bytes <= 6000
+
+
+def test_replaced_history_is_rebuilt():
+    builder = HistoryBuilder()
+    builder.build(chat(4))
+    generation = builder.generation
+    assert len(builder.build(chat(2))) == 2
+    assert builder.generation == generation + 1
+
+
+def test_summary_replaces_the_messages_it_covers():
+    history = chat(6)
+    builder = HistoryBuilder()
+    builder.build(history)
+    builder.set_summary(
+        "Rick and Morty talked.", covers=4, generation=builder.generation
+    )
+    contents = builder.build(history)
+    assert len(contents) == 3
+    assert contents[0].parts[0].text.endswith("Rick and Morty talked.")
+    assert builder.summarised == 4
+
+
+def test_spilled_attachments_are_read_back_from_the_store(store):
+    image = store.put(b"\x89PNG" + b"\0" * 4000, "image/png")
+    history = [{"role": "user", "content": "Look", "attachment": image}]
+    builder = HistoryBuilder(attachment_store=store)
+    builder.build(history)
+    assert builder.spill() == image.size
+    assert builder.held_bytes == 0
+    (content,) = builder.build(history)
+    assert content.parts[1].inline_data.data == store.get(image)
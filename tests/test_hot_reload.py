@@ -0,0 +1,133 @@
+"""Hot reloading of changed personalities and local system prompts."""
+
+import os
+
+import pytest
+import yaml
+
+import personality
+import utils
+from hot_reload import PersonalityReloader
+from personality import PersonalityRegistry, load_personalities
+from utils import FakeSecretBackend, SecretCache
+
+
+def definition(name: str, temperature: float = 1.0) -> dict:
+    return {
+        "name": name,
+        "menu_name": name,
+        "title": f"I'm {name}",
+        "overview": f"{name}'s overview",
+        "welcome": "Hello",
+        "prompt_question": "What?",
+        "temperature": temperature,
+    }
+
+
+class Sources:
+    """Personalities and their prompts in a temporary directory."""
+
+    def __init__(self, root):
+        self.yaml_file = root / "personalities.yaml"
+        self.prompts_dir = root / "system_prompts"
+        self.prompts_dir.mkdir()
+        self._mtime = 1_000_000_000_000_000_000
+
+    def _touch(self, path):
+        self._mtime += 1_000_000_000  # Distinct, whatever the file system's resolution
+        os.utime(path, ns=(self._mtime, self._mtime))
+
+    def write_personalities(self, *definitions: dict):
+        self.yaml_file.write_text(yaml.safe_dump(list(definitions)), encoding="utf-8")
+        self._touch(self.yaml_file)
+
+    def write_prompt(self, name: str, prompt: str):
+        path = self.prompts_dir / f"{name.lower()}.txt"
+        path.write_text(prompt, encoding="utf-8")
+        self._touch(path)
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch) -> Sources:
+    # Prompts that aren't found locally are never found in the prompt cache or secrets
+    monkeypatch.setattr(personality, "PROMPT_CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(utils, "_secret_cache", SecretCache(FakeSecretBackend()))
+    sources = Sources(tmp_path)
+    sources.write_personalities(definition("Rick"), definition("Yoda"))
+    sources.write_prompt("Rick", "Wubba lubba dub dub")
+    sources.write_prompt("Yoda", "Do or do not")
+    return sources
+
+
+@pytest.fixture
+def registry(sources) -> PersonalityRegistry:
+    return PersonalityRegistry(load_personalities(str(sources.yaml_file)))
+
+
+@pytest.fixture
+def reloader(sources, registry) -> PersonalityReloader:
+    return PersonalityReloader(registry, sources.yaml_file, sources.prompts_dir)
+
+
+def test_nothing_changed(reloader, registry):
+    before = registry.snapshot()
+    assert reloader.check() == []
+    assert registry.snapshot() == before
+
+
+def test_reloads_only_the_personality_whose_prompt_changed(sources, reloader, registry):
+    rick, yoda = registry["Rick"], registry["Yoda"]
+    sources.write_prompt("Rick", "Wubba lubba dub dub!")
+    assert reloader.check() == ["Rick"]
+    assert registry["Rick"] is not rick
+    assert registry["Rick"].system_instruction == "Wubba lubba dub dub!"
+    assert registry["Rick"].revision > rick.revision
+    assert registry["Yoda"] is yoda
+
+
+def test_reloads_only_the_personality_whose_definition_changed(
+    sources, reloader, registry
+):
+    yoda = registry["Yoda"]
+    sources.write_personalities(definition("Rick", temperature=0.5), definition("Yoda"))
+    assert reloader.check() == ["Rick"]
+    assert registry["Rick"].temperature == 0.5
+    assert registry["Yoda"] is yoda
+
+
+def test_adds_and_removes_personalities(sources, reloader, registry):
+    sources.write_prompt("Morty", "Aw geez")
+    sources.write_personalities(definition("Rick"), definition("Morty"))
+    assert sorted(reloader.check()) == ["Morty", "Yoda"]
+    assert list(registry) == ["Rick", "Morty"]
+
+
+def test_keeps_personalities_when_the_file_is_broken(sources, reloader, registry):
+    before = registry.snapshot()
+    sources.yaml_file.write_text("- name: [", encoding="utf-8")
+    sources.write_prompt("Rick", "Changed")  # Not reloaded with a broken file
+    assert reloader.check() == []
+    assert registry.snapshot() == before
+    sources.write_personalities(definition("Rick", temperature=0.5), definition("Yoda"))
+    assert reloader.check() == ["Rick"]
+
+
+def test_keeps_old_version_when_its_prompt_cant_be_loaded(sources, reloader, registry):
+    yoda = registry["Yoda"]
+    (sources.prompts_dir / "yoda.txt").unlink()
+    sources.write_personalities(definition("Rick"), definition("Yoda", temperature=0.5))
+    assert reloader.check() == []
+    assert registry["Yoda"] is yoda
+
+
+def test_callbacks_are_told_what_changed(sources, reloader):
+    calls = []
+
+    def fail(_):
+        raise RuntimeError("Injected failure")
+
+    reloader.on_reload(fail)
+    reloader.on_reload(calls.append)
+    sources.write_prompt("Yoda", "Do, or do not")
+    assert reloader.check() == ["Yoda"]
+    assert calls == [["Yoda"]]
@@ -0,0 +1,38 @@
+"""Metrics and their export in the Prometheus text format."""
+
+import pytest
+
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_escapes_label_values():
+    registry = Registry()
+    errors = registry.register(Counter("errors_total", "Errors.", ("error",)))
+    errors.inc(error='Bad "quote" in C:\\path\nand a new line')
+    assert (
+        'errors_total{error="Bad \\"quote\\" in C:\\\\path\\nand a new line"} 1'
+        in registry.render().splitlines()
+    )
+
+
+def test_registering_again_returns_the_existing_metric():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests."))
+    assert registry.register(Counter("requests_total", "Requests.")) is requests
+    with pytest.raises(ValueError):
+        registry.register(Histogram("requests_total", "Requests."))
+
+
+def test_function_gauge_is_rebound_when_registered_again():
+    registry = Registry()
+    gauge = registry.register(Gauge("cache_bytes", "Bytes.", function=lambda: 1))
+    assert (
+        registry.register(Gauge("cache_bytes", "Bytes.", function=lambda: 2)) is gauge
+    )
+    assert "cache_bytes 2" in registry.render().splitlines()
+
+
+def test_bind_replaces_the_function():
+    gauge = Gauge("cache_bytes", "Bytes.")
+    gauge.bind(lambda: 3)
+    assert gauge.samples() == ["cache_bytes 3"]
@@ -0,0 +1,129 @@
+"""Context caching of system prompts, with the fake client's caches."""
+
+import pytest
+
+import prompt_cache
+from agent import get_model_config
+from fake_client import FakeGenaiClient
+from personality import personalities
+from prompt_cache import SystemPromptCache
+
+RICK = personalities["Rick"]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(prompt_cache.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def client(monkeypatch) -> FakeGenaiClient:
+    """A fake client whose cache calls are recorded."""
+    client = FakeGenaiClient()
+    client.calls = []
+    create, update = client.caches.create, client.caches.update
+
+    def record(name, method):
+        def call(**kwargs):
+            client.calls.append(name)
+            return method(**kwargs)
+
+        return call
+
+    monkeypatch.setattr(client.caches, "create", record("create", create))
+    monkeypatch.setattr(client.caches, "update", record("update", update))
+    return client
+
+
+def fail(**_):
+    raise RuntimeError("Injected failure")
+
+
+def test_creates_then_reuses_entry(clock, client):
+    cache = SystemPromptCache(ttl_seconds=3600, refresh_margin_seconds=300)
+    name = cache.get(client, RICK, "model")
+    assert name
+    clock.now += 3000
+    assert cache.get(client, RICK, "model") == name
+    assert client.calls == ["create"]
+
+
+def test_entries_are_per_model_and_grounding(clock, client):
+    cache = SystemPromptCache()
+    names = {
+        cache.get(client, RICK, "model-a"),
+        cache.get(client, RICK, "model-b"),
+        cache.get(client, RICK, "model-a", grounded=False),
+    }
+    assert len(names) == 3
+    assert client.calls == ["create"] * 3
+
+
+def test_refreshes_ttl_before_expiry(clock, client):
+    cache = SystemPromptCache(ttl_seconds=3600, refresh_margin_seconds=300)
+    name = cache.get(client, RICK, "model")
+    clock.now += 3400  # Within the refresh margin
+    assert cache.get(client, RICK, "model") == name
+    clock.now += 3400  # The refresh extended the TTL
+    assert cache.get(client, RICK, "model") == name
+    assert client.calls == ["create", "update", "update"]
+
+
+def test_recreates_entry_after_expiry(clock, client):
+    cache = SystemPromptCache(ttl_seconds=3600)
+    name = cache.get(client, RICK, "model")
+    clock.now += 3600
+    assert cache.get(client, RICK, "model") != name
+    assert client.calls == ["create", "create"]
+
+
+def test_recreates_entry_when_refresh_fails(clock, client, monkeypatch):
+    cache = SystemPromptCache(ttl_seconds=3600, refresh_margin_seconds=300)
+    name = cache.get(client, RICK, "model")
+    monkeypatch.setattr(client.caches, "update", fail)
+    clock.now += 3400
+    new_name = cache.get(client, RICK, "model")
+    assert new_name and new_name != name
+    assert client.calls == ["create", "create"]
+
+
+def test_falls_back_to_system_prompt_when_caching_fails(clock, client, monkeypatch):
+    monkeypatch.setattr(client.caches, "create", fail)
+    cache = SystemPromptCache(retry_after_seconds=600)
+    config = get_model_config(client, RICK, cache, "model")
+    assert config.cached_content is None
+    assert config.system_instruction
+
+
+def test_retries_caching_after_a_while(clock, client, monkeypatch):
+    create = client.caches.create
+    monkeypatch.setattr(client.caches, "create", fail)
+    cache = SystemPromptCache(retry_after_seconds=600)
+    assert cache.get(client, RICK, "model") is None
+    monkeypatch.setattr(client.caches, "create", create)
+    assert cache.get(client, RICK, "model") is None  # Not retried yet
+    clock.now += 600
+    assert cache.get(client, RICK, "model")
+
+
+def test_uses_cached_content_when_available(clock, client):
+    config = get_model_config(client, RICK, SystemPromptCache(), "model")
+    assert config.cached_content
+    assert config.system_instruction is None
+
+
+def test_invalidate_recreates_entry(clock, client):
+    cache = SystemPromptCache()
+    name = cache.get(client, RICK, "model")
+    cache.invalidate("Rick")
+    assert cache.get(client, RICK, "model") != name
@@ -0,0 +1,42 @@
+"""Per-user and global rate limits, on in-memory storage."""
+
+from rate_limit import RateLimiter
+
+
+def test_each_user_has_their_own_limits():
+    limiter = RateLimiter(user_limits="2/minute;3/hour")
+    assert [limiter.hit("user:rick") for _ in range(3)] == [True, True, False]
+    assert limiter.hit("user:morty")
+    assert limiter.rejections == 1
+
+
+def test_longer_limits_apply_too():
+    limiter = RateLimiter(user_limits="5/minute;2/hour")
+    assert [limiter.hit("user:rick") for _ in range(3)] == [True, True, False]
+
+
+def test_global_limit_applies_across_users():
+    limiter = RateLimiter(global_limit="2/minute", user_limits="5/minute")
+    assert limiter.hit("user:rick")
+    assert limiter.hit("user:morty")
+    assert not limiter.hit("user:summer")
+
+
+def test_rejected_requests_dont_use_up_other_limits():
+    limiter = RateLimiter(global_limit="3/minute", user_limits="1/minute")
+    assert limiter.hit("user:rick")
+    assert not limiter.hit("user:rick")
+    assert not limiter.hit("user:rick")
+    assert limiter.hit("user:morty")
+    assert limiter.hit("user:summer")
+
+
+def test_no_limits_allows_everything():
+    limiter = RateLimiter()
+    assert all(limiter.hit("user:rick") for _ in range(100))
+
+
+def test_unusable_storage_falls_back_to_memory():
+    limiter = RateLimiter("redis://localhost:1", user_limits="1/minute")
+    assert limiter.hit("user:rick")
+    assert not limiter.hit("user:rick")
@@ -0,0 +1,126 @@
+"""Retries, hedging and mid-stream failures, with the fake client's failure injection."""
+
+import asyncio
+import time
+
+import pytest
+from google.genai.errors import ClientError, ServerError
+
+from engine import GenerationEngine
+from fake_client import FakeGenaiClient, FakeStreamSettings, make_chunk
+from resilience import ClientPool, RetryPolicy, generation_hedges, open_stream
+
+NO_BACKOFF = RetryPolicy(max_attempts=3, base_delay=0)
+
+
+def fake_client(**settings) -> FakeGenaiClient:
+    return FakeGenaiClient(
+        FakeStreamSettings(
+            **{"first_chunk_latency": 0.01, "chunk_latency": 0, **settings}
+        )
+    )
+
+
+async def read_all(first, stream) -> list[str]:
+    chunks = [first]
+    async for chunk in stream:
+        chunks.append(chunk)
+    return [chunk.text for chunk in chunks]
+
+
+def test_retries_transient_errors_before_first_chunk():
+    client = fake_client(failures=2, failure_code=503, chunk_count=3)
+
+    async def run():
+        first, stream = await open_stream(
+            ClientPool.single(client), NO_BACKOFF, "model", [], None
+        )
+        return await read_all(first, stream)
+
+    assert len(asyncio.run(run())) == 3
+    assert client.requests == 3
+
+
+def test_gives_up_after_max_attempts():
+    client = fake_client(failures=5, failure_code=503)
+    with pytest.raises(ServerError):
+        asyncio.run(
+            open_stream(ClientPool.single(client), NO_BACKOFF, "model", [], None)
+        )
+    assert client.requests == NO_BACKOFF.max_attempts
+
+
+def test_does_not_retry_client_errors():
+    client = fake_client(failures=1, failure_code=400)
+    with pytest.raises(ClientError):
+        asyncio.run(
+            open_stream(ClientPool.single(client), NO_BACKOFF, "model", [], None)
+        )
+    assert client.requests == 1
+
+
+def test_fails_over_to_the_next_client():
+    primary = fake_client(failures=5, failure_code=503)
+    fallback = fake_client()
+    pool = ClientPool([("primary", primary), ("fallback", fallback)])
+
+    async def run():
+        first, stream = await open_stream(pool, NO_BACKOFF, "model", [], None)
+        await stream.aclose()
+        return first
+
+    assert asyncio.run(run()) is not None
+    assert (primary.requests, fallback.requests) == (1, 1)
+
+
+class _FailsAfterFirstChunk:
+    """A client whose responses fail after their first chunk."""
+
+    def __init__(self):
+        self.requests = 0
+        self.aio = self
+        self.models = self
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        self.requests += 1
+
+        async def stream():
+            yield make_chunk("Wubba lubba ")
+            raise ServerError(503, {"error": {"code": 503, "message": "Injected"}})
+
+        return stream()
+
+
+def test_does_not_retry_after_first_chunk():
+    client = _FailsAfterFirstChunk()
+    engine = GenerationEngine(max_concurrency=1, retry_policy=NO_BACKOFF)
+    chunks = []
+    with pytest.raises(ServerError):
+        for chunk in engine.stream(client, "model", [], None):
+            chunks.append(chunk)
+    assert chunks == ["Wubba lubba "]
+    assert client.requests == 1
+
+
+def test_hedges_slow_first_chunk_and_cancels_the_loser():
+    slow = fake_client(first_chunk_latency=5)
+    fast = fake_client()
+    pool = ClientPool([("slow", slow), ("fast", fast)])
+    policy = RetryPolicy(max_attempts=1, hedge_after=0.05)
+    hedges = generation_hedges.value(client="fast")
+
+    async def run():
+        start = time.perf_counter()
+        first, stream = await open_stream(pool, policy, "model", [], None)
+        elapsed = time.perf_counter() - start
+        await stream.aclose()
+        await asyncio.sleep(0)
+        others = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        return first, elapsed, others
+
+    first, elapsed, others = asyncio.run(run())
+    assert first is not None
+    assert elapsed < 1  # The fast client's response was used
+    assert not others  # The slow request was cancelled
+    assert (slow.requests, fast.requests) == (1, 1)
+    assert generation_hedges.value(client="fast") == hedges + 1
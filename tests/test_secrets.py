@@ -0,0 +1,111 @@
+"""Caching of secrets, with the fake secret backend."""
+
+import threading
+import time
+
+import pytest
+from google.cloud import secretmanager
+
+import utils
+from utils import FakeSecretBackend, SecretCache, SecretManagerBackend
+
+RICK = "projects/p/secrets/rick-system-prompt/versions/latest"
+MISSING = "projects/p/secrets/missing/versions/latest"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(utils.time, "monotonic", clock)
+    return clock
+
+
+def test_caches_secrets_until_ttl_expires(clock):
+    backend = FakeSecretBackend({"rick-system-prompt": "Wubba lubba dub dub"})
+    cache = SecretCache(backend, ttl_seconds=3600)
+    assert cache.get(RICK) == ("Wubba lubba dub dub", "1")
+    clock.now += 3599
+    cache.get(RICK)
+    assert backend.calls == 1
+    clock.now += 1
+    cache.get(RICK)
+    assert backend.calls == 2
+
+
+def test_caches_failures_for_negative_ttl(clock):
+    backend = FakeSecretBackend()
+    cache = SecretCache(backend, ttl_seconds=3600, negative_ttl_seconds=60)
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            cache.get(MISSING)
+    assert backend.calls == 1
+    backend.secrets["missing"] = "Found it"
+    clock.now += 60
+    assert cache.get(MISSING) == ("Found it", "1")
+    assert backend.calls == 2
+
+
+def test_configured_ttls_apply_to_secrets_already_read(clock, monkeypatch):
+    backend = FakeSecretBackend(default="Prompt")
+    monkeypatch.setattr(utils, "_secret_cache", SecretCache(backend, ttl_seconds=3600))
+    assert utils.retrieve_secret("p", "rick-system-prompt") == "Prompt"
+    utils.configure_secret_cache(ttl_seconds=60, negative_ttl_seconds=10)
+    clock.now += 60
+    utils.retrieve_secret("p", "rick-system-prompt")
+    assert backend.calls == 2
+
+
+def test_concurrent_reads_of_a_secret_share_one_request():
+    class SlowBackend(FakeSecretBackend):
+        def access(self, name):
+            time.sleep(0.1)
+            return super().access(name)
+
+    backend = SlowBackend(default="Prompt")
+    cache = SecretCache(backend)
+    threads = [threading.Thread(target=cache.get, args=(RICK,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert backend.calls == 1
+
+
+def test_secret_manager_client_is_shared(monkeypatch):
+    created = []
+
+    class Client:
+        def __init__(self):
+            time.sleep(0.05)  # So that threads overlap
+            created.append(self)
+
+    monkeypatch.setattr(secretmanager, "SecretManagerServiceClient", Client)
+    backend = SecretManagerBackend()
+    threads = [
+        threading.Thread(target=getattr, args=(backend, "client")) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    assert backend.client is created[0]
+
+
+def test_prefetch_reads_secrets_in_the_background():
+    backend = FakeSecretBackend(default="Prompt")
+    cache = SecretCache(backend)
+    cache.prefetch([RICK, MISSING])
+    deadline = time.monotonic() + 5
+    while backend.calls < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    cache.get(RICK)
+    assert backend.calls == 2
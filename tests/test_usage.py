@@ -0,0 +1,95 @@
+"""Token accounting and per-user token budgets, with the fake client."""
+
+from google.genai.types import GenerateContentResponseUsageMetadata
+
+from fake_client import FakeGenaiClient
+from history import estimate_tokens
+from personality import personalities
+from rate_limit import RateLimiter
+from usage import SystemPromptTokens, TokenAccountant, TokenUsage
+
+RICK = personalities["Rick"]
+
+
+def usage_metadata(prompt=5000, cached=0, output=300, thoughts=0):
+    return GenerateContentResponseUsageMetadata(
+        prompt_token_count=prompt,
+        cached_content_token_count=cached or None,
+        candidates_token_count=output,
+        thoughts_token_count=thoughts or None,
+    )
+
+
+def test_token_budget_is_charged_and_enforced():
+    limiter = RateLimiter(token_limits="1000/hour")
+    assert limiter.hit("user:rick")
+    limiter.charge_tokens("user:rick", 600)
+    assert limiter.tokens_remaining("user:rick") == 400
+    assert limiter.hit("user:rick")
+    limiter.charge_tokens("user:rick", 600)  # Takes the budget past its limit
+    assert limiter.tokens_remaining("user:rick") == 0
+    assert not limiter.hit("user:rick")
+    assert limiter.tokens_remaining("user:morty") == 1000
+    assert limiter.hit("user:morty")
+
+
+def test_no_token_budgets():
+    limiter = RateLimiter()
+    limiter.charge_tokens("user:rick", 10**9)
+    assert limiter.tokens_remaining("user:rick") is None
+    assert limiter.hit("user:rick")
+
+
+def test_usage_is_split_by_kind():
+    usage = TokenUsage.from_metadata(
+        usage_metadata(prompt=5000, cached=2048, output=300, thoughts=100),
+        system_prompt=2048,
+    )
+    assert (usage.prompt, usage.system_prompt, usage.cached) == (5000, 2048, 2048)
+    assert usage.total == 5400
+    assert (usage + usage).requests == 2
+
+
+def test_system_prompt_share_never_exceeds_prompt():
+    usage = TokenUsage.from_metadata(usage_metadata(prompt=100), system_prompt=2048)
+    assert usage.system_prompt == 100
+
+
+def test_system_prompt_is_counted_once_per_model():
+    client = FakeGenaiClient()
+    calls = []
+    count_tokens = client.models.count_tokens
+
+    def counting(**kwargs):
+        calls.append(kwargs["model"])
+        return count_tokens(**kwargs)
+
+    client.models.count_tokens = counting
+    counts = SystemPromptTokens()
+    tokens = counts.count(client, RICK, "model-a")
+    assert tokens == estimate_tokens(RICK.system_instruction)
+    assert counts.count(client, RICK, "model-a") == tokens
+    counts.count(client, RICK, "model-b")
+    assert calls == ["model-a", "model-b"]
+
+
+def test_system_prompt_is_estimated_when_counting_fails():
+    client = FakeGenaiClient()
+
+    def fail(**_):
+        raise RuntimeError("Injected failure")
+
+    client.models.count_tokens = fail
+    tokens = SystemPromptTokens().count(client, RICK, "model")
+    assert tokens == estimate_tokens(RICK.system_instruction)
+
+
+def test_accountant_charges_the_users_budget():
+    limiter = RateLimiter(token_limits="10000/hour")
+    accountant = TokenAccountant(rate_limiter=limiter)
+    usage = accountant.record(
+        FakeGenaiClient(), RICK, "model", usage_metadata(), identity="user:rick"
+    )
+    assert usage.total == 5300
+    assert limiter.tokens_remaining("user:rick") == 4700
+    assert limiter.tokens_remaining("user:morty") == 10000